@@ -0,0 +1,470 @@
+import collections
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import perf
+
+
+class Rollup:
+    # счетчики из emergency_rollup: (месторождение, тип, год) -> [кол-во, ущерб];
+    # таблица маленькая (месторождения x типы x годы), поэтому держим ее в памяти
+    # и фильтры применяем к ней, а не к emergency_occurrence
+
+    def __init__(self, cells=None) -> None:
+        self.cells = cells if cells is not None else {}
+        # растет при каждом изменении, по нему можно проверять кэши расчетов
+        self.version = 0
+        # тип происшествия -> {месторождение: кол-во} за все годы (для карты);
+        # сбрасывается при каждом изменении
+        self.totals = {}
+        # (версия, фильтр) -> Trends для графиков
+        self.trends = {}
+
+    @classmethod
+    @perf.instrument("query.rollup")
+    def load(cls, engine):
+        # SQLAlchemy нужен только здесь: без него модуль импортируется
+        # быстро и не задерживает показ главного окна
+        from sqlalchemy import text
+
+        from database import session
+
+        cells = {}
+
+        with session(engine) as s:
+
+            query = """
+            SELECT mestorozdenie_id, emergency_type_id, year, amount, injured_amount
+            FROM emergency_rollup
+            """
+
+            rows = s.execute(text(query))
+            for r in rows:
+                cells[(r.mestorozdenie_id, r.emergency_type_id, r.year)] = [r.amount, r.injured_amount]
+
+        return cls(cells)
+
+    @staticmethod
+    def key(row):
+        # ячейка, в которую попадает строка происшествия; None - ни в какую
+        return (row.mestorozdenie_id, row.emergency_type_id, row.year)
+
+    def apply(self, old, new):
+        # точечное обновление после записи, то же, что делают триггеры в базе
+        self.version += 1
+        self.totals.clear()
+        self.trends.clear()
+        key = self.key(old) if old is not None else None
+        if key is not None:
+            values = self.cells.get(key)
+            if values is not None:
+                values[0] -= 1
+                values[1] -= old.injured_amount or 0
+                if values[0] <= 0:
+                    del self.cells[key]
+
+        key = self.key(new) if new is not None else None
+        if key is not None:
+            values = self.cells.setdefault(key, [0, 0])
+            values[0] += 1
+            values[1] += new.injured_amount or 0
+
+    def select(self, deposit_id=0, emergency_type_id=0, deposit_ids=None, period=None):
+        # period - (первый год, последний год) включительно, None - все годы
+        for (mestorozdenie_id, type_id, year), values in self.cells.items():
+            if deposit_id and mestorozdenie_id != deposit_id:
+                continue
+            if deposit_ids is not None and mestorozdenie_id not in deposit_ids:
+                continue
+            if emergency_type_id and type_id != emergency_type_id:
+                continue
+            if period is not None and not period[0] <= year <= period[1]:
+                continue
+            yield mestorozdenie_id, type_id, year, values
+
+    def count_by_deposits(self, deposit_id=0, emergency_type_id=0, deposit_ids=None, period=None):
+        # {месторождение: {год: кол-во происшествий}}
+        data_by_deposits = {}
+        for mestorozdenie_id, _, year, (amount, _) in self.select(deposit_id, emergency_type_id, deposit_ids, period):
+            items = data_by_deposits.setdefault(mestorozdenie_id, {})
+            items[year] = items.get(year, 0) + amount
+        return data_by_deposits
+
+    def injured_by_deposits(self, deposit_id=0, emergency_type_id=0, period=None):
+        # {месторождение: {год: сумма ущерба}}
+        data_by_deposits = {}
+        for mestorozdenie_id, _, year, (_, injured) in self.select(deposit_id, emergency_type_id, period=period):
+            items = data_by_deposits.setdefault(mestorozdenie_id, {})
+            items[year] = items.get(year, 0) + injured
+        return data_by_deposits
+
+    def totals_by_deposit(self, emergency_type_id=0):
+        # {месторождение: кол-во происшествий за все годы}
+        totals = self.totals.get(emergency_type_id)
+        if totals is None:
+            totals = self.totals[emergency_type_id] = {}
+            for mestorozdenie_id, _, _, (amount, _) in self.select(0, emergency_type_id):
+                totals[mestorozdenie_id] = totals.get(mestorozdenie_id, 0) + amount
+        return totals
+
+    def trends_by_deposits(self, deposit_id=0, emergency_type_id=0, deposit_ids=None, **options):
+        # тренды по тем же рядам, что и count_by_deposits (options - ее
+        # дополнительные параметры, например шаг у PeriodRollup); результат
+        # хранится, пока не изменится версия данных, так что переключение
+        # фильтров туда и обратно не пересчитывает его заново
+        key = (
+            self.version, deposit_id, emergency_type_id,
+            frozenset(deposit_ids) if deposit_ids is not None else None,
+            tuple(sorted(options.items())),
+        )
+        if key not in self.trends:
+            if len(self.trends) >= TRENDS_CACHE_SIZE:
+                self.trends.clear()
+            self.trends[key] = trends(self.count_by_deposits(deposit_id, emergency_type_id, deposit_ids, **options))
+        return self.trends[key]
+
+
+# шаг времени графиков -> число периодов в году. Период - целое число:
+# год, year * 4 + (квартал - 1) или year * 12 + (месяц - 1), поэтому
+# соседние периоды отличаются на 1 при любом шаге и ряды по кварталам
+# и месяцам считаются теми же функциями, что и по годам (в том числе trends)
+GRANULARITIES = {"year": 1, "quarter": 4, "month": 12}
+
+
+def month_number(occurred_at):
+    # 'YYYY-MM...' (emergency_rollup_month.month или occurred_at) -> номер месяца
+    return int(occurred_at[:4]) * 12 + int(occurred_at[5:7]) - 1
+
+
+def period_x(period, granularity="year"):
+    # положение периода на оси времени в годах: 2015 Q2 -> 2015.25
+    return period / GRANULARITIES[granularity]
+
+
+def period_label(period, granularity="year"):
+    per_year = GRANULARITIES[granularity]
+    if per_year == 1:
+        return str(period)
+    year, part = divmod(period, per_year)
+    if granularity == "quarter":
+        return f"{part + 1} кв. {year}"
+    return f"{part + 1:02d}.{year}"
+
+
+class PeriodRollup(Rollup):
+    # счетчики из emergency_rollup_month: (месторождение, тип, номер месяца)
+    # -> [кол-во, ущерб]; кварталы и годы складываются из месяцев при запросе.
+    # Строки, у которых известен только год (записанные до миграции 8),
+    # здесь не учитываются - годовые графики строит Rollup
+
+    @classmethod
+    @perf.instrument("query.rollup")
+    def load(cls, engine):
+        from sqlalchemy import text
+
+        from database import session
+
+        cells = {}
+
+        with session(engine) as s:
+
+            query = """
+            SELECT mestorozdenie_id, emergency_type_id, month, amount, injured_amount
+            FROM emergency_rollup_month
+            """
+
+            rows = s.execute(text(query))
+            for r in rows:
+                cells[(r.mestorozdenie_id, r.emergency_type_id, month_number(r.month))] = [r.amount, r.injured_amount]
+
+        return cls(cells)
+
+    @staticmethod
+    def key(row):
+        if row.occurred_at is None:
+            return None
+        return (row.mestorozdenie_id, row.emergency_type_id, month_number(row.occurred_at))
+
+    def count_by_deposits(self, deposit_id=0, emergency_type_id=0, deposit_ids=None, period=None, granularity="month"):
+        # {месторождение: {период: кол-во происшествий}}; period - годы, как у Rollup
+        months = 12 // GRANULARITIES[granularity]
+        if period is not None:
+            period = (period[0] * 12, period[1] * 12 + 11)
+
+        data_by_deposits = {}
+        for mestorozdenie_id, _, month, (amount, _) in self.select(deposit_id, emergency_type_id, deposit_ids, period):
+            items = data_by_deposits.setdefault(mestorozdenie_id, {})
+            key = month // months
+            items[key] = items.get(key, 0) + amount
+        return data_by_deposits
+
+
+# измерения и показатели сводной таблицы; порядок измерений - как в ключе Rollup.cells
+DIMENSIONS = ("deposit", "type", "year")
+MEASURES = ("amount", "injured")
+
+Pivot = collections.namedtuple("Pivot", "rows columns values row_totals column_totals total")
+
+
+class Cube(Rollup):
+    # куб данных: кроме ячеек (месторождение, тип, год) заранее посчитаны все
+    # группировки по меньшему числу измерений - по паре, по одному и общий итог.
+    # Каждое изменение обновляет все группировки сразу, поэтому сводная таблица
+    # по любой паре измерений строится без пересчета по ячейкам
+
+    def __init__(self, cells=None) -> None:
+        super().__init__(cells)
+        # кортеж номеров измерений -> {значения измерений: [кол-во, ущерб]};
+        # группировка по всем трем измерениям - это сами cells
+        self.cuboids = {
+            dims: {}
+            for size in range(len(DIMENSIONS))
+            for dims in itertools.combinations(range(len(DIMENSIONS)), size)
+        }
+        for key, (amount, injured) in self.cells.items():
+            self.add(key, amount, injured)
+
+    def add(self, key, amount, injured):
+        for dims, cuboid in self.cuboids.items():
+            group = tuple(key[d] for d in dims)
+            values = cuboid.setdefault(group, [0, 0])
+            values[0] += amount
+            values[1] += injured
+            if values[0] <= 0:
+                del cuboid[group]
+
+    def apply(self, old, new):
+        super().apply(old, new)
+        if old is not None:
+            self.add(self.key(old), -1, -(old.injured_amount or 0))
+        if new is not None:
+            self.add(self.key(new), 1, new.injured_amount or 0)
+
+    def cuboid(self, dims):
+        if len(dims) == len(DIMENSIONS):
+            return self.cells
+        return self.cuboids[dims]
+
+    def aggregate(self, dims, measure, fixed):
+        # {значения dims: показатель} с отбором по fixed {номер измерения: значение};
+        # без отбора это просто чтение готовой группировки
+        source = tuple(sorted(set(dims) | set(fixed)))
+        positions = [source.index(d) for d in dims]
+        conditions = [(source.index(d), value) for d, value in fixed.items()]
+
+        result = {}
+        for key, values in self.cuboid(source).items():
+            if any(key[i] != value for i, value in conditions):
+                continue
+            group = tuple(key[i] for i in positions)
+            result[group] = result.get(group, 0) + values[measure]
+        return result
+
+    @perf.instrument("pivot")
+    def pivot(self, rows, columns, measure="amount", **fixed):
+        # сводная таблица: rows и columns - имена измерений из DIMENSIONS,
+        # fixed - отбор по значениям измерений, например deposit=1 (0 - без отбора)
+        if rows == columns:
+            raise ValueError(f"rows and columns must differ: {rows!r}")
+
+        r, c = DIMENSIONS.index(rows), DIMENSIONS.index(columns)
+        m = MEASURES.index(measure)
+        fixed = {DIMENSIONS.index(name): value for name, value in fixed.items() if value}
+
+        values = {(key[0], key[1]): value for key, value in self.aggregate((r, c), m, fixed).items()}
+        row_totals = {key[0]: value for key, value in self.aggregate((r,), m, fixed).items()}
+        column_totals = {key[0]: value for key, value in self.aggregate((c,), m, fixed).items()}
+        total = self.aggregate((), m, fixed).get((), 0)
+
+        return Pivot(sorted(row_totals), sorted(column_totals), values, row_totals, column_totals, total)
+
+
+# расчеты для графиков главного окна; модуль не зависит от Qt, поэтому
+# те же цифры можно получить без графического интерфейса (см. report.py)
+
+def line_points(data_by_deposits):
+    # линейный график: {месторождение: [(год, кол-во), ...]} по возрастанию года
+    return {
+        mestorozdenie_id: sorted(count_by_year.items())
+        for mestorozdenie_id, count_by_year in data_by_deposits.items()
+    }
+
+
+def pie_totals(data_by_deposits):
+    # круговая диаграмма: {месторождение: всего происшествий}
+    return {
+        mestorozdenie_id: sum(count_by_year.values())
+        for mestorozdenie_id, count_by_year in data_by_deposits.items()
+    }
+
+
+def pie_shares(totals):
+    # доли месторождений от общего числа происшествий
+    amount = sum(totals.values())
+    return {mestorozdenie_id: count / amount if amount else 0.0 for mestorozdenie_id, count in totals.items()}
+
+
+def bar_sets(data_by_deposits):
+    # столбчатая диаграмма с накоплением: общие для всех месторождений годы
+    # и {месторождение: [кол-во за каждый год]}
+    years = set()
+    for count_by_year in data_by_deposits.values():
+        years.update(count_by_year)
+    years = sorted(years)
+
+    return years, {
+        mestorozdenie_id: [count_by_year.get(year, 0) for year in years]
+        for mestorozdenie_id, count_by_year in data_by_deposits.items()
+    }
+
+
+def statistics(rollup, deposits, deposit_id=0, emergency_type_id=0, period=None):
+    # все показатели графиков одним словарем, пригодным для JSON
+    data_by_deposits = rollup.count_by_deposits(deposit_id, emergency_type_id, period=period)
+    injured_by_deposits = rollup.injured_by_deposits(deposit_id, emergency_type_id, period)
+    years, bars = bar_sets(data_by_deposits)
+    totals = pie_totals(data_by_deposits)
+    shares = pie_shares(totals)
+
+    return {
+        "deposit_id": deposit_id,
+        "emergency_type_id": emergency_type_id,
+        "period": list(period) if period is not None else None,
+        "years": years,
+        "deposits": [
+            {
+                "id": mestorozdenie_id,
+                "name": deposits[mestorozdenie_id].name if mestorozdenie_id in deposits else None,
+                "total": totals[mestorozdenie_id],
+                "share": shares[mestorozdenie_id],
+                "injured": sum(injured_by_deposits.get(mestorozdenie_id, {}).values()),
+                "by_year": dict(zip(years, bars[mestorozdenie_id])),
+            }
+            for mestorozdenie_id in sorted(data_by_deposits)
+        ],
+    }
+
+
+# тренды: окно скользящего среднего в периодах (годах, кварталах или
+# месяцах) и порог |z|, начиная с которого период месторождения отмечается
+# как аномальный
+TREND_WINDOW = 3
+ANOMALY_Z = 2.0
+# сколько вариантов фильтра хранит Rollup.trends
+TRENDS_CACHE_SIZE = 32
+
+# матрицы месторождения x годы: строка i - deposits[i], колонка j - years[j]
+Trends = collections.namedtuple("Trends", "deposits years counts moving_average change zscores anomalies")
+
+
+def shift(matrix, periods):
+    # сдвиг колонок вправо на periods, освободившиеся колонки - нули
+    result = numpy.zeros_like(matrix)
+    if periods < matrix.shape[1]:
+        result[:, periods:] = matrix[:, :-periods]
+    return result
+
+
+def trends(data_by_deposits, window=TREND_WINDOW, threshold=ANOMALY_Z):
+    # скользящее среднее, изменение к прошлому году и z-оценка каждого года
+    # относительно истории своего месторождения - сразу для всех месторождений
+    # операциями над матрицей. История месторождения начинается с его первого
+    # происшествия, более ранние годы - NaN. Без numpy тренды не считаются (None)
+    if numpy is None:
+        return None
+
+    deposits = sorted(data_by_deposits)
+    all_years = {year for count_by_year in data_by_deposits.values() for year in count_by_year}
+    years = list(range(min(all_years), max(all_years) + 1)) if all_years else []
+
+    counts = numpy.zeros((len(deposits), len(years)))
+    if not years:
+        empty = numpy.zeros((0, 0))
+        return Trends(deposits, years, counts, empty, empty, empty, empty.astype(bool))
+
+    cells = [
+        (row, year - years[0], count)
+        for row, mestorozdenie_id in enumerate(deposits)
+        for year, count in data_by_deposits[mestorozdenie_id].items()
+    ]
+    rows, columns, values = zip(*cells)
+    counts[numpy.array(rows), numpy.array(columns)] = values
+
+    positions = numpy.arange(len(years))
+    first = numpy.argmax(counts > 0, axis=1)
+    known = positions[numpy.newaxis, :] >= first[:, numpy.newaxis]
+    history = numpy.where(known, counts, numpy.nan)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # среднее за последние window лет истории (в начале - за сколько есть)
+        sums = numpy.cumsum(numpy.where(known, counts, 0), axis=1)
+        sizes = numpy.cumsum(known, axis=1)
+        moving_average = (sums - shift(sums, window)) / (sizes - shift(sizes, window))
+
+        change = numpy.full_like(history, numpy.nan)
+        change[:, 1:] = (history[:, 1:] - history[:, :-1]) / history[:, :-1]
+        change[~numpy.isfinite(change)] = numpy.nan
+
+        mean = numpy.nanmean(history, axis=1, keepdims=True)
+        std = numpy.nanstd(history, axis=1, keepdims=True)
+        zscores = numpy.where(std > 0, (history - mean) / std, numpy.where(known, 0.0, numpy.nan))
+
+    anomalies = numpy.abs(numpy.nan_to_num(zscores)) >= threshold
+
+    return Trends(deposits, years, counts, moving_average, change, zscores, anomalies)
+
+
+def anomaly_list(result):
+    # отмеченные годы: [(месторождение, год, кол-во, изменение, z)], сильнейшие первыми
+    rows, columns = numpy.nonzero(result.anomalies)
+    cells = [
+        (
+            result.deposits[row],
+            result.years[column],
+            int(result.counts[row, column]),
+            None if numpy.isnan(result.change[row, column]) else float(result.change[row, column]),
+            float(result.zscores[row, column]),
+        )
+        for row, column in zip(rows.tolist(), columns.tolist())
+    ]
+    return sorted(cells, key=lambda cell: -abs(cell[4]))
+
+
+# ключ "остальных" месторождений после top_deposits (настоящие id начинаются с 1)
+OTHER = 0
+
+
+def top_deposits(data_by_deposits, limit):
+    # оставляет limit месторождений с наибольшим числом происшествий,
+    # остальные складываются в одну группу OTHER
+    if len(data_by_deposits) <= limit:
+        return data_by_deposits
+
+    totals = pie_totals(data_by_deposits)
+    top = sorted(totals, key=totals.get, reverse=True)[:limit]
+
+    result = {mestorozdenie_id: data_by_deposits[mestorozdenie_id] for mestorozdenie_id in top}
+    other = result.setdefault(OTHER, {})
+    for mestorozdenie_id, count_by_year in data_by_deposits.items():
+        if mestorozdenie_id in result:
+            continue
+        for year, count in count_by_year.items():
+            other[year] = other.get(year, 0) + count
+    return result
+
+
+def downsample(points, limit):
+    # прореживание ряда точек до limit: из каждого интервала берется
+    # точка с наибольшим значением, чтобы не потерять пики
+    if len(points) <= limit:
+        return points
+
+    step = len(points) / limit
+    return [
+        max(points[int(i * step):int((i + 1) * step)], key=lambda point: point[1])
+        for i in range(limit)
+    ]
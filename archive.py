@@ -0,0 +1,253 @@
+import argparse
+import os
+import pathlib
+import sqlite3
+import time
+
+import database
+
+# схема раздела архива: те же колонки, что у emergency_occurrence
+# (database.OCCURRENCE_COLUMNS), и индекс по году для выборок по периоду
+PARTITION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.emergency_occurrence (
+    id INTEGER PRIMARY KEY,
+    mestorozdenie_id INTEGER,
+    year INTEGER,
+    injured_amount INTEGER,
+    emergency_type_id INTEGER,
+    comment TEXT,
+    occurred_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS {schema}.emergency_occurrence_year ON emergency_occurrence(year);
+"""
+
+COLUMNS = ", ".join(database.OCCURRENCE_COLUMNS)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def partitions(engine):
+    connection = engine.raw_connection()
+    try:
+        return connection.driver_connection.execute(
+            "SELECT id, path, first_year, last_year, rows, created_at FROM archive_partition ORDER BY id"
+        ).fetchall()
+    finally:
+        connection.close()
+
+
+def archive_before(engine, year, path):
+    # перенос происшествий раньше year в файл-раздел path. Таблица, ее индексы
+    # и полнотекстовый индекс становятся меньше, а сводки по годам и месяцам
+    # сохраняют итоги перенесенных строк, поэтому графики не меняются.
+    # Раздел подключается ко всем новым соединениям (database.attach_partitions)
+    path = str(pathlib.Path(path).resolve())
+    started = time.perf_counter()
+
+    connection = engine.raw_connection()
+    try:
+        db = connection.driver_connection
+        if db.execute("SELECT 1 FROM archive_partition WHERE path = ?", (path,)).fetchone():
+            raise ArchiveError(f"Раздел уже подключен: {path}")
+
+        # SQLite подключает к соединению не больше SQLITE_LIMIT_ATTACHED баз
+        # (обычно 10), а разделы подключаются к каждому соединению. Когда лимит
+        # исчерпан, новый файл не создается и строки дописываются в последний раздел
+        count = db.execute("SELECT COUNT(*) FROM archive_partition").fetchone()[0]
+        if count >= db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+            partition_id, path = db.execute(
+                "SELECT id, path FROM archive_partition ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            schema = f"archive_{partition_id}"
+            if schema not in {row[1] for row in db.execute("PRAGMA database_list")}:
+                raise ArchiveError(f"Раздел не подключен: {path}")
+            created = False
+        else:
+            partition_id, schema = None, "archive_new"
+            created = not os.path.exists(path)
+            db.execute("ATTACH DATABASE ? AS archive_new", (path,))
+
+        try:
+            if partition_id is None:
+                db.executescript(PARTITION_SCHEMA.format(schema="archive_new"))
+                if db.execute("SELECT 1 FROM archive_new.emergency_occurrence LIMIT 1").fetchone():
+                    raise ArchiveError(f"Файл раздела не пуст: {path}")
+
+            # сначала строки копируются в раздел отдельной транзакцией: в режиме
+            # WAL коммит в несколько файлов не атомарен, и при сбое строки могут
+            # оказаться в обоих файлах, но не пропасть. Номера перенесенных строк
+            # запоминаются, в разделе могут быть и строки прошлых переносов
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DROP TABLE IF EXISTS temp.archive_moved")
+                db.execute(
+                    "CREATE TEMP TABLE archive_moved AS SELECT id FROM main.emergency_occurrence WHERE year < ?",
+                    (year,),
+                )
+                db.execute(
+                    f"INSERT INTO {schema}.emergency_occurrence({COLUMNS}) "
+                    f"SELECT {COLUMNS} FROM main.emergency_occurrence WHERE id IN (SELECT id FROM temp.archive_moved)"
+                )
+                first_year, last_year, rows = db.execute(f"""
+                SELECT MIN(year), MAX(year), COUNT(*) FROM {schema}.emergency_occurrence
+                WHERE id IN (SELECT id FROM temp.archive_moved)
+                """).fetchone()
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+            if not rows:
+                raise ArchiveError(f"Нет происшествий раньше {year} года")
+
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # строки могли измениться между транзакциями - тогда перенос отменяется
+                changed = db.execute(f"""
+                SELECT COUNT(*) FROM (
+                    SELECT {COLUMNS} FROM main.emergency_occurrence WHERE year < :year
+                    EXCEPT
+                    SELECT {COLUMNS} FROM {schema}.emergency_occurrence
+                    WHERE id IN (SELECT id FROM temp.archive_moved)
+                )
+                """, {"year": year}).fetchone()[0]
+                remaining = db.execute(
+                    "SELECT COUNT(*) FROM main.emergency_occurrence WHERE year < ?", (year,)
+                ).fetchone()[0]
+                if changed or remaining != rows:
+                    raise ArchiveError("Происшествия изменились во время переноса, повторите его")
+
+                # итоги переносимых строк: триггеры вычтут их из сводок при
+                # удалении, после чего они добавляются обратно
+                db.execute("""
+                CREATE TEMP TABLE archive_rollup AS
+                SELECT mestorozdenie_id, emergency_type_id, year, COUNT(*) AS amount,
+                       IFNULL(SUM(injured_amount), 0) AS injured_amount
+                FROM main.emergency_occurrence
+                WHERE year < ?
+                GROUP BY mestorozdenie_id, emergency_type_id, year
+                """, (year,))
+                db.execute("""
+                CREATE TEMP TABLE archive_rollup_month AS
+                SELECT mestorozdenie_id, emergency_type_id, substr(occurred_at, 1, 7) AS month, COUNT(*) AS amount,
+                       IFNULL(SUM(injured_amount), 0) AS injured_amount
+                FROM main.emergency_occurrence
+                WHERE year < ? AND occurred_at IS NOT NULL
+                GROUP BY mestorozdenie_id, emergency_type_id, month
+                """, (year,))
+
+                # перенос - не удаление: в журнал синхронизации он не попадает,
+                # а ключи строк помечаются, чтобы sync.py не применял к ним
+                # чужие изменения (строк в основной таблице уже нет)
+                db.execute("""
+                UPDATE sync_key SET archived = 1
+                WHERE tbl = 'emergency_occurrence' AND id IN (SELECT id FROM temp.archive_moved)
+                """)
+                db.execute("UPDATE sync_site SET archiving = 1")
+                db.execute("DELETE FROM main.emergency_occurrence WHERE year < ?", (year,))
+                db.execute("UPDATE sync_site SET archiving = 0")
+
+                db.execute("""
+                INSERT INTO emergency_rollup(mestorozdenie_id, emergency_type_id, year, amount, injured_amount)
+                SELECT mestorozdenie_id, emergency_type_id, year, amount, injured_amount
+                FROM temp.archive_rollup
+                WHERE true
+                ON CONFLICT(mestorozdenie_id, emergency_type_id, year) DO UPDATE
+                SET amount = amount + excluded.amount, injured_amount = injured_amount + excluded.injured_amount
+                """)
+                db.execute("""
+                INSERT INTO emergency_rollup_month(mestorozdenie_id, emergency_type_id, month, amount, injured_amount)
+                SELECT mestorozdenie_id, emergency_type_id, month, amount, injured_amount
+                FROM temp.archive_rollup_month
+                WHERE true
+                ON CONFLICT(mestorozdenie_id, emergency_type_id, month) DO UPDATE
+                SET amount = amount + excluded.amount, injured_amount = injured_amount + excluded.injured_amount
+                """)
+                db.execute("DROP TABLE temp.archive_rollup")
+                db.execute("DROP TABLE temp.archive_rollup_month")
+
+                if partition_id is None:
+                    db.execute(
+                        "INSERT INTO archive_partition(path, first_year, last_year, rows) VALUES (?, ?, ?, ?)",
+                        (path, first_year, last_year, rows),
+                    )
+                else:
+                    db.execute(
+                        """
+                        UPDATE archive_partition
+                        SET first_year = MIN(first_year, ?), last_year = MAX(last_year, ?), rows = rows + ?
+                        WHERE id = ?
+                        """,
+                        (first_year, last_year, rows, partition_id),
+                    )
+                db.commit()
+            except Exception:
+                db.rollback()
+                # скопированные строки убираем из раздела, файл можно использовать снова
+                db.execute(
+                    f"DELETE FROM {schema}.emergency_occurrence WHERE id IN (SELECT id FROM temp.archive_moved)"
+                )
+                db.commit()
+                raise
+        except Exception:
+            if partition_id is None:
+                db.execute("DETACH DATABASE archive_new")
+                # файл, созданный этим переносом, не должен остаться пустым разделом
+                if created and os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            db.execute("DROP TABLE IF EXISTS temp.archive_moved")
+
+        if partition_id is None:
+            db.execute("DETACH DATABASE archive_new")
+            # у этого соединения раздел подключается под своим постоянным именем
+            database.attach_partitions(db)
+    finally:
+        connection.close()
+
+    return {
+        "path": path,
+        "appended": partition_id is not None,
+        "first_year": first_year,
+        "last_year": last_year,
+        "rows": rows,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+if __name__ == "__main__":
+    # архив по периодам: старые годы переносятся в отдельные файлы SQLite,
+    # основная база остается небольшой. Разделы подключаются автоматически,
+    # все строки вместе - представление emergency_occurrence_all
+    # (например, exporter.py --archive)
+    parser = argparse.ArgumentParser(description="Архив происшествий по периодам")
+    parser.add_argument("--database", default="database.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    move_parser = commands.add_parser("move", help="перенести старые годы в файл-раздел")
+    move_parser.add_argument("--before", type=int, required=True, help="переносятся годы раньше этого")
+    move_parser.add_argument("--to", required=True, help="файл раздела, например archive/1990-1999.db")
+
+    commands.add_parser("list", help="подключенные разделы")
+
+    args = parser.parse_args()
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+
+    if args.command == "move":
+        os.makedirs(os.path.dirname(os.path.abspath(args.to)), exist_ok=True)
+        result = archive_before(engine, args.before, args.to)
+        if result["appended"]:
+            print("Достигнут предел подключаемых разделов, строки дописаны в последний раздел")
+        print(
+            f"Перенесено строк: {result['rows']} ({result['first_year']}-{result['last_year']}) "
+            f"в {result['path']}, {result['seconds']:.1f} с"
+        )
+    else:
+        for partition_id, path, first_year, last_year, rows, created_at in partitions(engine):
+            print(f"{partition_id}: {first_year}-{last_year}, строк {rows}, {path} ({created_at})")
@@ -0,0 +1,219 @@
+import argparse
+import concurrent.futures
+import html
+import itertools
+import json
+import os
+import sys
+import time
+
+import analytics
+import database
+
+# размер картинок графиков в пикселях (для PDF - в точках страницы)
+CHART_WIDTH = 1000
+CHART_HEIGHT = 600
+CHARTS = ("line", "bar", "pie")
+CHART_TITLES = {"line": "По годам", "bar": "По годам с накоплением", "pie": "Доли месторождений"}
+
+# состояние процесса-исполнителя: соединение с базой, сводка и графики
+# создаются один раз на процесс в init_worker и переиспользуются всеми заданиями
+worker = None
+
+
+class ReportWorker:
+    def __init__(self, path, out, image_format) -> None:
+        # Qt в исполнителях работает без экрана
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PySide2 import QtWidgets
+        from PySide2.QtCharts import QtCharts
+
+        from charts import BarChart, LineChart, PieChart
+
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        self.out = out
+        self.image_format = image_format
+
+        # у каждого процесса свое соединение только для чтения
+        self.engine = database.create_database_engine(database.read_only_url(path))
+        self.rollup = analytics.Rollup.load(self.engine)
+        self.deposits = database.load_mestorozdenie(self.engine)
+
+        self.views = {}
+        self.charts = {}
+        for name, chart_class in zip(CHARTS, (LineChart, BarChart, PieChart)):
+            view = self.views[name] = QtCharts.QChartView()
+            view.resize(CHART_WIDTH, CHART_HEIGHT)
+            self.charts[name] = chart_class(view)
+
+    def render(self, name, path):
+        from PySide2 import QtCore, QtGui
+
+        view = self.views[name]
+        if self.image_format == "png":
+            view.grab().save(path)
+            return
+
+        writer = QtGui.QPdfWriter(path)
+        writer.setPageLayout(QtGui.QPageLayout(
+            QtGui.QPageSize(QtCore.QSizeF(CHART_WIDTH, CHART_HEIGHT), QtGui.QPageSize.Point),
+            QtGui.QPageLayout.Portrait,
+            QtCore.QMarginsF(0, 0, 0, 0),
+        ))
+        painter = QtGui.QPainter(writer)
+        view.render(painter, QtCore.QRectF(painter.viewport()), view.rect())
+        painter.end()
+
+    def run(self, job):
+        from PySide2.QtCharts import QtCharts
+
+        deposit_id, emergency_type_id, period = job
+        started = time.perf_counter()
+
+        data_by_deposits = self.rollup.count_by_deposits(deposit_id, emergency_type_id, period=period)
+        images = {}
+        for name, chart in self.charts.items():
+            chart.update(data_by_deposits, self.deposits)
+            # картинка снимается сразу, анимация бы ее испортила
+            chart.chart.setAnimationOptions(QtCharts.QChart.AnimationOption.NoAnimation)
+            # раскладка осей и легенды пересчитывается в очереди событий
+            self.app.processEvents()
+            images[name] = f"{job_name(job)}_{name}.{self.image_format}"
+            self.render(name, os.path.join(self.out, images[name]))
+
+        return {
+            "statistics": analytics.statistics(self.rollup, self.deposits, deposit_id, emergency_type_id, period),
+            "images": images,
+            "seconds": time.perf_counter() - started,
+            "pid": os.getpid(),
+        }
+
+
+def init_worker(path, out, image_format):
+    global worker
+    worker = ReportWorker(path, out, image_format)
+
+
+def run_job(job):
+    return worker.run(job)
+
+
+def job_name(job):
+    deposit_id, emergency_type_id, period = job
+    years = f"{period[0]}-{period[1]}" if period is not None else "all"
+    return f"d{deposit_id}_t{emergency_type_id}_{years}"
+
+
+def parse_period(value):
+    # "2000-2009" или один год "2015"
+    first, _, last = value.partition("-")
+    try:
+        period = int(first), int(last or first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается период вида 2000-2009: {value!r}")
+    if period[0] > period[1]:
+        raise argparse.ArgumentTypeError(f"начало периода позже конца: {value!r}")
+    return period
+
+
+def make_jobs(deposit_ids, type_ids, periods):
+    # все сочетания (месторождение, тип, период); 0 - все месторождения или все типы
+    return list(itertools.product(deposit_ids, type_ids, periods))
+
+
+def title(job, deposits, emergencyTypes):
+    deposit_id, emergency_type_id, period = job
+    deposit = deposits[deposit_id].name if deposit_id in deposits else "Все месторождения"
+    emergency_type = emergencyTypes[emergency_type_id].name if emergency_type_id in emergencyTypes else "все типы"
+    years = f"{period[0]}-{period[1]}" if period is not None else "все годы"
+    return f"{deposit}, {emergency_type}, {years}"
+
+
+def write_index(path, jobs, results, deposits, emergencyTypes, image_format):
+    # общий отчет: для каждого задания таблица по месторождениям и графики
+    parts = [
+        "<!DOCTYPE html>",
+        '<html><head><meta charset="utf-8"><title>Отчет о происшествиях</title></head><body>',
+        "<h1>Отчет о происшествиях</h1>",
+    ]
+    for job in jobs:
+        stats, images = results[job]["statistics"], results[job]["images"]
+        parts.append(f"<h2>{html.escape(title(job, deposits, emergencyTypes))}</h2>")
+        parts.append(
+            '<table border="1" cellspacing="0" cellpadding="3">'
+            "<tr><th>Месторождение</th><th>Кол-во происшествий</th><th>Доля</th><th>Сумма ущерба</th></tr>"
+        )
+        for deposit in stats["deposits"]:
+            parts.append(
+                f"<tr><td>{html.escape(deposit['name'] or '')}</td><td>{deposit['total']}</td>"
+                f"<td>{deposit['share']:.1%}</td><td>{deposit['injured']}</td></tr>"
+            )
+        parts.append("</table>")
+        for name in CHARTS:
+            src = html.escape(images[name])
+            if image_format == "png":
+                parts.append(f'<p><img src="{src}" alt="{CHART_TITLES[name]}" width="{CHART_WIDTH // 2}"></p>')
+            else:
+                parts.append(f'<p><a href="{src}">{CHART_TITLES[name]}</a></p>')
+    parts.append("</body></html>")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(parts))
+
+
+def generate(path, out, jobs, image_format="png", processes=None, progress=None):
+    # задания раздаются пулу процессов: у каждого процесса свой Qt и свое
+    # соединение с базой, поэтому графики строятся параллельно на всех ядрах
+    os.makedirs(out, exist_ok=True)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=init_worker, initargs=(path, out, image_format),
+    ) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(len(results), len(jobs))
+    return results
+
+
+if __name__ == "__main__":
+    # пакетный отчет: графики и таблицы по каждому сочетанию месторождения,
+    # типа происшествия и периода; итог - index.html и report.json в папке --out
+    parser = argparse.ArgumentParser(description="Пакетный отчет о происшествиях")
+    parser.add_argument("--database", default="database.db")
+    parser.add_argument("--out", default="reports", help="папка отчета")
+    parser.add_argument("--deposit", type=int, action="append", help="id месторождения, 0 - все (по умолчанию - каждое и все)")
+    parser.add_argument("--type", type=int, action="append", help="id типа происшествия, 0 - все (по умолчанию - каждый и все)")
+    parser.add_argument("--period", type=parse_period, action="append", help="годы, например 2000-2009 (по умолчанию - все годы)")
+    parser.add_argument("--format", choices=["png", "pdf"], default="png")
+    parser.add_argument("--processes", type=int, default=None, help="число процессов (по умолчанию - по числу ядер)")
+    args = parser.parse_args()
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+    deposits = database.load_mestorozdenie(engine)
+    emergencyTypes = database.load_emergency_type(engine)
+    # дальше база читается только исполнителями
+    engine.dispose()
+
+    jobs = make_jobs(
+        args.deposit or [0, *deposits],
+        args.type or [0, *emergencyTypes],
+        args.period or [None],
+    )
+
+    def progress(done, total):
+        print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+    started = time.perf_counter()
+    results = generate(args.database, args.out, jobs, args.format, args.processes, progress)
+    elapsed = time.perf_counter() - started
+    print(file=sys.stderr)
+
+    with open(os.path.join(args.out, "report.json"), "w", encoding="utf-8") as f:
+        json.dump([results[job] for job in jobs], f, ensure_ascii=False, indent=2)
+    write_index(os.path.join(args.out, "index.html"), jobs, results, deposits, emergencyTypes, args.format)
+
+    processes = len({result["pid"] for result in results.values()})
+    print(f"Заданий: {len(jobs)}, процессов: {processes}, {elapsed:.1f} с ({len(jobs) / elapsed:.1f} заданий/с)")
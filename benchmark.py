@@ -0,0 +1,288 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import text
+
+import database
+from store import OccurrenceStore
+
+SCHEMA = """
+CREATE TABLE mestorozdenie (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    coord1 FLOAT,
+    coord2 FLOAT
+);
+CREATE TABLE emergency_type (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT
+);
+CREATE TABLE emergency_occurrence (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mestorozdenie_id INTEGER REFERENCES mestorozdenie(id),
+    year INTEGER,
+    injured_amount INTEGER,
+    emergency_type_id INTEGER REFERENCES emergency_type(id),
+    comment TEXT
+);
+"""
+
+TYPE_NAMES = ["Нефтепродуктовыделение", "Взрыв", "Пожар", "Обрушение", "Выброс газа", "Затопление"]
+COMMENTS = ["", "Прорыв нефтепровода", "Пожар на месторождении", "Обрушение кровли", "Выброс метана"]
+
+GENERATE_CHUNK = 100000
+
+
+def generate_database(path, deposits=50, types=6, years=30, incidents=100000, seed=0):
+    # синтетическая база той же схемы, что и database.db. Месторождения
+    # и типы получают разный "вес", чтобы распределение было неравномерным,
+    # как в реальном журнале происшествий
+    rng = random.Random(seed)
+    last_year = datetime.date.today().year
+    first_year = last_year - years + 1
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.executemany(
+        "INSERT INTO mestorozdenie(name, coord1, coord2) VALUES (?, ?, ?)",
+        [(f"Месторождение {i}", rng.uniform(45, 70), rng.uniform(30, 140)) for i in range(1, deposits + 1)],
+    )
+    connection.executemany(
+        "INSERT INTO emergency_type(name) VALUES (?)",
+        [(TYPE_NAMES[i % len(TYPE_NAMES)] + ("" if i < len(TYPE_NAMES) else f" {i}"),) for i in range(types)],
+    )
+
+    deposit_ids = list(range(1, deposits + 1))
+    deposit_weights = [rng.paretovariate(1.5) for _ in deposit_ids]
+    type_ids = list(range(1, types + 1))
+    type_weights = [rng.paretovariate(1.5) for _ in type_ids]
+
+    left = incidents
+    while left > 0:
+        count = min(left, GENERATE_CHUNK)
+        left -= count
+        connection.executemany(
+            "INSERT INTO emergency_occurrence(mestorozdenie_id, year, injured_amount, emergency_type_id, comment) "
+            "VALUES (?, ?, ?, ?, ?)",
+            zip(
+                rng.choices(deposit_ids, deposit_weights, k=count),
+                (rng.randint(first_year, last_year) for _ in range(count)),
+                (int(rng.expovariate(1 / 50000)) for _ in range(count)),
+                rng.choices(type_ids, type_weights, k=count),
+                rng.choices(COMMENTS, k=count),
+            ),
+        )
+        connection.commit()
+
+    connection.close()
+
+    # сводная таблица и индексы строятся миграциями один раз на готовых данных
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{path}")
+    database.migrate(engine)
+    return engine
+
+
+def timed(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {"min_s": min(times), "median_s": statistics.median(times)}
+
+
+def measure(fn):
+    # время - без tracemalloc, он замедляет код с множеством мелких объектов
+    # в разы; пиковая память - отдельным вторым запуском
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_store(engine, count):
+    # сравнение прежнего списка строк SQLAlchemy с колоночным хранилищем:
+    # пиковая память на загрузку и время фильтрации
+    query = text("SELECT * FROM emergency_occurrence LIMIT :n")
+
+    def load_rows():
+        with database.session(engine) as s:
+            return s.execute(query, {"n": count}).all()
+
+    def load_store():
+        with database.session(engine) as s:
+            return OccurrenceStore(s.execute(query, {"n": count}))
+
+    rows, rows_load, rows_peak = measure(load_rows)
+    store, store_load, store_peak = measure(load_store)
+
+    rows_filter = timed(lambda: [r for r in rows if r.mestorozdenie_id == 1 and r.emergency_type_id == 1], 3)["min_s"]
+    store_filter = timed(lambda: store.filter(1, 1), 3)["min_s"]
+
+    return {
+        "rows": len(rows),
+        "before": {"load_s": rows_load, "peak_bytes": rows_peak, "filter_s": rows_filter},
+        "after": {"load_s": store_load, "peak_bytes": store_peak, "filter_s": store_filter},
+    }
+
+
+def bench_queries(engine, page_size):
+    # запрос страницы таблицы для каждого варианта фильтра
+    result = {}
+    for deposit_id in (0, 1):
+        for emergency_type_id in (0, 1):
+            name = f"deposit={deposit_id},type={emergency_type_id}"
+            result[name] = timed(
+                lambda: database.load_occurrence_page(engine, deposit_id, emergency_type_id, None, page_size)
+            )
+    return result
+
+
+def spin(app, condition, timeout=60.0):
+    # крутим цикл событий Qt, пока фоновые запросы не вернут результат
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("benchmark step timed out")
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def bench_gui(engine, pages):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide2.QtWidgets import QApplication
+
+    import main
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    result = {}
+
+    # запуск: от создания окна до первой отрисовки, первой страницы таблицы
+    # и готовых графиков
+    started = time.perf_counter()
+    window = main.MainWindow(engine)
+    window.show()
+    spin(app, lambda: window.model.rowCount() > 0 and window.refresh.inputs.get("bar") is not None)
+    result["startup_s"] = time.perf_counter() - started
+    result["first_paint_s"] = window.first_paint_at - started
+    result["first_page_s"] = window.first_page_at - started
+
+    # заполнение модели: синхронная подгрузка страниц, как при прокрутке
+    model = window.model
+
+    def populate():
+        model.setFilter(0, 0)
+        spin(app, lambda: not model.fetching)
+        for _ in range(pages):
+            if not model.has_more:
+                break
+            # ключ страницы - как у ItemsModel.fetchMore (queries.SORT_KEYS)
+            last = model.items[-1]
+            model.fetching = True
+            model.appendPage(database.load_occurrence_page(
+                engine, model.deposit_id, model.emergency_type_id,
+                (model.SORT_VALUES["year"](last), last.id), model.PAGE_SIZE,
+            ))
+
+    result["populate"] = timed(populate, repeat=3)
+    result["populate"]["rows"] = model.rowCount()
+
+    window.prepare_charts()
+    for name in ("draw_line_chart", "draw_pie_chart", "draw_bar_chart"):
+        result[name] = timed(getattr(window, name))
+
+    # запись и точечное обновление таблицы и сводки
+    deposit_id = next(iter(window.deposits))
+    type_id = next(iter(window.emergencyTypes))
+    data = {"deposit_id": deposit_id, "type_id": type_id, "year": 2000, "injured": 1, "comment": "benchmark"}
+    inserted = []
+
+    def add():
+        change = database.insert_occurrence(engine, data)
+        window.on_data_changed(change)
+        inserted.append(change[1].id)
+
+    def edit():
+        window.on_data_changed(database.update_occurrence(engine, inserted[-1], dict(data, injured=2)))
+
+    def remove():
+        window.on_data_changed(database.delete_occurrence(engine, inserted.pop()))
+
+    result["add"] = timed(add)
+    result["edit"] = timed(edit)
+    result["remove"] = timed(remove)
+
+    window.close()
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры производительности на синтетических данных")
+    parser.add_argument("--deposits", type=int, default=50)
+    parser.add_argument("--types", type=int, default=6)
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--incidents", type=int, default=100000, help="до 10 млн строк")
+    parser.add_argument("--pages", type=int, default=50, help="сколько страниц подгрузить в модель")
+    parser.add_argument("--store-rows", type=int, default=0, help="сравнить хранилище строк на N строках")
+    parser.add_argument("--database", help="путь к синтетической базе (по умолчанию - временный файл)")
+    parser.add_argument("--no-gui", action="store_true", help="только замеры без окна")
+    parser.add_argument("--output", help="файл для результатов JSON")
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+    started = time.perf_counter()
+    engine = generate_database(path, args.deposits, args.types, args.years, args.incidents)
+    results = {
+        "version": git_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": {
+            "deposits": args.deposits,
+            "types": args.types,
+            "years": args.years,
+            "incidents": args.incidents,
+        },
+        "generate_s": time.perf_counter() - started,
+        "queries": bench_queries(engine, 200),
+    }
+
+    if not args.no_gui:
+        results["gui"] = bench_gui(engine, args.pages)
+    if args.store_rows:
+        results["store"] = bench_store(engine, args.store_rows)
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
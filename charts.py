@@ -0,0 +1,280 @@
+import math
+
+from PySide2 import QtCore, QtGui, QtWidgets
+from PySide2.QtCharts import QtCharts
+
+import analytics
+
+# сколько месторождений рисовать отдельно, остальные идут одной группой
+TOP_DEPOSITS = 10
+# больше точек в ряду линейного графика не рисуем, ряд прореживается
+MAX_POINTS = 200
+# выше этого числа точек/столбцов/секторов анимация и подписи выключаются
+ANIMATION_LIMIT = 300
+LABEL_LIMIT = 100
+# не больше стольких делений на оси времени
+MAX_TICKS = 10
+
+# подписи оси времени и подсказок для шагов analytics.GRANULARITIES
+AXIS_TITLES = {"year": "Год", "quarter": "Год (по кварталам)", "month": "Год (по месяцам)"}
+WINDOW_UNITS = {"year": "г.", "quarter": "кв.", "month": "мес."}
+PREVIOUS_PERIOD = {"year": "к прошлому году", "quarter": "к прошлому кварталу", "month": "к прошлому месяцу"}
+FLAGGED_TITLES = {
+    "year": "* - год с аномальными значениями",
+    "quarter": "* - квартал с аномальными значениями",
+    "month": "* - месяц с аномальными значениями",
+}
+
+
+def deposit_name(deposits, mestorozdenie_id):
+    if mestorozdenie_id == analytics.OTHER:
+        return "Остальные"
+    if mestorozdenie_id in deposits:
+        return deposits[mestorozdenie_id].name
+    return f"#{mestorozdenie_id}"
+
+
+class ChartManager:
+    # график создается один раз и дальше обновляется на месте: ряды
+    # переиспользуются по id месторождения, новые добавляются, лишние удаляются
+
+    def __init__(self, view) -> None:
+        self.view = view
+        self.chart = QtCharts.QChart()
+        self.series = {}
+        self.view.setChart(self.chart)
+
+    def set_animated(self, size):
+        if size > ANIMATION_LIMIT:
+            self.chart.setAnimationOptions(QtCharts.QChart.AnimationOption.NoAnimation)
+        else:
+            self.chart.setAnimationOptions(QtCharts.QChart.AnimationOption.SeriesAnimations)
+
+
+class LineChart(ChartManager):
+    def __init__(self, view) -> None:
+        super().__init__(view)
+
+        self.axisX = QtCharts.QValueAxis()
+        self.axisX.setTitleText("Год")
+        self.axisX.setLabelFormat("%i")
+        self.chart.addAxis(self.axisX, QtCore.Qt.AlignBottom)
+
+        self.axisY = QtCharts.QValueAxis()
+        self.axisY.setTitleText("Кол-во происшествий")
+        self.axisY.setLabelFormat("%i")
+        self.chart.addAxis(self.axisY, QtCore.Qt.AlignLeft)
+
+        # поверх рядов: скользящее среднее пунктиром того же цвета
+        # и отметки аномальных лет (analytics.trends)
+        self.averages = {}
+        self.anomalies = QtCharts.QScatterSeries()
+        self.anomalies.setName("Аномалии")
+        self.anomalies.setColor(QtGui.QColor("#d62728"))
+        self.anomalies.setMarkerSize(11)
+        self.anomalies.hovered.connect(self.on_anomaly_hovered)
+        self.chart.addSeries(self.anomalies)
+        self.anomalies.attachAxis(self.axisX)
+        self.anomalies.attachAxis(self.axisY)
+        # (x, кол-во) -> текст подсказки
+        self.anomaly_tips = {}
+
+    def set_time_range(self, first, last, granularity):
+        # ось в годах с запасом в один период по краям; границы и деления
+        # выровнены по целым годам, чтобы подписи "%i" не повторялись
+        margin = 1 / analytics.GRANULARITIES[granularity]
+        low = math.floor(analytics.period_x(first, granularity) - margin)
+        high = math.ceil(analytics.period_x(last, granularity) + margin)
+        step = max(1, math.ceil((high - low) / MAX_TICKS))
+        ticks = math.ceil((high - low) / step)
+        self.axisX.setRange(low, low + ticks * step)
+        self.axisX.setTickCount(ticks + 1)
+
+    def update(self, data_by_deposits, deposits, trends=None, granularity="year"):
+        data = analytics.top_deposits(data_by_deposits, TOP_DEPOSITS)
+        points_by_deposits = {
+            mestorozdenie_id: analytics.downsample(points, MAX_POINTS)
+            for mestorozdenie_id, points in analytics.line_points(data).items()
+        }
+        size = sum(len(points) for points in points_by_deposits.values())
+
+        for mestorozdenie_id in list(self.series):
+            if mestorozdenie_id not in points_by_deposits:
+                self.chart.removeSeries(self.series.pop(mestorozdenie_id))
+
+        for mestorozdenie_id, points in points_by_deposits.items():
+            series = self.series.get(mestorozdenie_id)
+            if series is None:
+                series = self.series[mestorozdenie_id] = QtCharts.QLineSeries()
+                self.chart.addSeries(series)
+                series.attachAxis(self.axisX)
+                series.attachAxis(self.axisY)
+
+            series.setName(deposit_name(deposits, mestorozdenie_id))
+            # точки на линии видны, пока их немного
+            series.setPointsVisible(size <= LABEL_LIMIT)
+            series.replace([
+                QtCore.QPointF(analytics.period_x(period, granularity), count) for period, count in points
+            ])
+
+        periods = [period for points in points_by_deposits.values() for period, _ in points]
+        counts = [count for points in points_by_deposits.values() for _, count in points]
+        self.axisX.setTitleText(AXIS_TITLES[granularity])
+        if periods:
+            self.set_time_range(min(periods), max(periods), granularity)
+            self.axisY.setRange(0, max(counts) + 10)
+
+        self.update_trends(points_by_deposits, deposits, trends, granularity)
+        self.set_animated(size)
+
+    def update_trends(self, points_by_deposits, deposits, trends, granularity="year"):
+        # тренды посчитаны по всем месторождениям, на графике - только по
+        # нарисованным отдельно; "остальных" в trends нет
+        rows = {}
+        if trends is not None:
+            rows = {
+                mestorozdenie_id: row
+                for row, mestorozdenie_id in enumerate(trends.deposits)
+                if mestorozdenie_id in points_by_deposits
+            }
+
+        for mestorozdenie_id in list(self.averages):
+            if mestorozdenie_id not in rows:
+                self.chart.removeSeries(self.averages.pop(mestorozdenie_id))
+
+        tips = {}
+        for mestorozdenie_id, row in rows.items():
+            average = self.averages.get(mestorozdenie_id)
+            if average is None:
+                average = self.averages[mestorozdenie_id] = QtCharts.QLineSeries()
+                self.chart.addSeries(average)
+                average.attachAxis(self.axisX)
+                average.attachAxis(self.axisY)
+                for marker in self.chart.legend().markers(average):
+                    marker.setVisible(False)
+
+            pen = QtGui.QPen(self.series[mestorozdenie_id].color(), 1, QtCore.Qt.DashLine)
+            average.setPen(pen)
+            average.setName(
+                f"{deposit_name(deposits, mestorozdenie_id)}: среднее за {analytics.TREND_WINDOW} {WINDOW_UNITS[granularity]}"
+            )
+            average.replace([
+                QtCore.QPointF(analytics.period_x(period, granularity), value)
+                for period, value in zip(trends.years, trends.moving_average[row].tolist())
+                if value == value
+            ])
+
+            for column in trends.anomalies[row].nonzero()[0].tolist():
+                period, count = trends.years[column], trends.counts[row, column]
+                change = trends.change[row, column]
+                tips[(analytics.period_x(period, granularity), count)] = (
+                    f"{deposit_name(deposits, mestorozdenie_id)}, {analytics.period_label(period, granularity)}: {count:.0f}"
+                    + ("" if change != change else f" ({change:+.0%} {PREVIOUS_PERIOD[granularity]})")
+                    + f", z = {trends.zscores[row, column]:+.2f}"
+                )
+
+        self.anomaly_tips = tips
+        self.anomalies.replace([QtCore.QPointF(x, count) for x, count in tips])
+        for marker in self.chart.legend().markers(self.anomalies):
+            marker.setVisible(trends is not None)
+
+        if trends is None:
+            self.chart.setTitle("")
+        else:
+            # число - по всем месторождениям, а не только нарисованным
+            self.chart.setTitle(f"Аномалий: {int(trends.anomalies.sum())} (|z| ≥ {analytics.ANOMALY_Z:g})")
+
+    def on_anomaly_hovered(self, point, state):
+        if state:
+            tip = self.anomaly_tips.get((point.x(), point.y()))
+            if tip:
+                QtWidgets.QToolTip.showText(QtGui.QCursor.pos(), tip)
+        else:
+            QtWidgets.QToolTip.hideText()
+
+
+class PieChart(ChartManager):
+    def __init__(self, view) -> None:
+        super().__init__(view)
+        self.pie = QtCharts.QPieSeries()
+        self.chart.addSeries(self.pie)
+
+    def update(self, data_by_deposits, deposits):
+        totals = analytics.pie_totals(analytics.top_deposits(data_by_deposits, TOP_DEPOSITS))
+
+        for mestorozdenie_id in list(self.series):
+            if mestorozdenie_id not in totals:
+                self.pie.remove(self.series.pop(mestorozdenie_id))
+
+        for mestorozdenie_id, count in totals.items():
+            pie_slice = self.series.get(mestorozdenie_id)
+            if pie_slice is None:
+                pie_slice = self.series[mestorozdenie_id] = self.pie.append(deposit_name(deposits, mestorozdenie_id), count)
+            else:
+                pie_slice.setValue(count)
+            pie_slice.setLabel(deposit_name(deposits, mestorozdenie_id))
+
+        self.pie.setLabelsVisible(len(totals) <= LABEL_LIMIT)
+        self.set_animated(len(totals))
+
+
+class BarChart(ChartManager):
+    def __init__(self, view) -> None:
+        super().__init__(view)
+
+        self.bars = QtCharts.QHorizontalStackedBarSeries()
+        self.bars.setLabelsPrecision(20)
+        self.bars.setLabelsFormat("@value")
+        self.chart.addSeries(self.bars)
+
+        self.axisX = QtCharts.QValueAxis()
+        self.axisX.setLabelFormat("%i")
+        self.chart.addAxis(self.axisX, QtCore.Qt.AlignBottom)
+        self.bars.attachAxis(self.axisX)
+
+        self.axisY = QtCharts.QBarCategoryAxis()
+        self.chart.addAxis(self.axisY, QtCore.Qt.AlignLeft)
+        self.bars.attachAxis(self.axisY)
+
+    def update(self, data_by_deposits, deposits, trends=None, granularity="year"):
+        periods, bars = analytics.bar_sets(analytics.top_deposits(data_by_deposits, TOP_DEPOSITS))
+        size = len(periods) * len(bars)
+
+        for mestorozdenie_id in list(self.series):
+            if mestorozdenie_id not in bars:
+                self.bars.remove(self.series.pop(mestorozdenie_id))
+
+        for mestorozdenie_id, values in bars.items():
+            bar_set = self.series.get(mestorozdenie_id)
+            if bar_set is None:
+                bar_set = self.series[mestorozdenie_id] = QtCharts.QBarSet(deposit_name(deposits, mestorozdenie_id))
+                bar_set.setLabelColor("#000")
+                bar_set.append(values)
+                self.bars.append(bar_set)
+            elif bar_set.count() == len(values):
+                for i, value in enumerate(values):
+                    if bar_set.at(i) != value:
+                        bar_set.replace(i, value)
+            else:
+                # периоды поменялись - значения набора заменяем целиком
+                bar_set.remove(0, bar_set.count())
+                bar_set.append(values)
+
+            # месторождение могли переименовать (обновление справочников)
+            name = deposit_name(deposits, mestorozdenie_id)
+            if bar_set.label() != name:
+                bar_set.setLabel(name)
+
+        # периоды, в которых у какого-либо месторождения аномалия, помечаются "*"
+        flagged = set()
+        if trends is not None:
+            flagged = {trends.years[column] for column in trends.anomalies.any(axis=0).nonzero()[0].tolist()}
+        self.axisY.setCategories([
+            analytics.period_label(period, granularity) + (" *" if period in flagged else "") for period in periods
+        ])
+        self.chart.setTitle(FLAGGED_TITLES[granularity] if flagged else "")
+        totals = [sum(column) for column in zip(*bars.values())]
+        self.axisX.setRange(0, max(totals) if totals else 1)
+
+        self.bars.setLabelsVisible(size <= LABEL_LIMIT)
+        self.set_animated(size)
@@ -0,0 +1,1050 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import urllib.parse
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import geo
+import perf
+from queries import SORT_KEYS, occurrence_query, search_query
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = "sqlite+pysqlite:///database.db"
+
+# настройки соединения с SQLite, применяются к каждому новому соединению пула:
+# WAL позволяет читать базу, пока в нее пишут, а synchronous=NORMAL в режиме
+# WAL безопасен и заметно ускоряет коммиты
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    # отрицательное значение - размер в КиБ, т.е. 64 МиБ
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+def read_only_url(path):
+    # SQLite открывает файл только для чтения (mode=ro): такие соединения
+    # не мешают другим процессам писать в базу и сами ничего не изменят
+    uri = urllib.parse.quote(pathlib.Path(path).resolve().as_posix(), safe="/:")
+    return f"sqlite+pysqlite:///file:{uri}?mode=ro&uri=true"
+
+
+def create_database_engine(url=DATABASE_URL, echo=None):
+    # вывод всех SQL-запросов включается только явно, через ACCIDENTS_SQL_ECHO=1
+    if echo is None:
+        echo = os.environ.get("ACCIDENTS_SQL_ECHO") == "1"
+
+    engine = create_engine(
+        url,
+        echo=echo,
+        poolclass=QueuePool,
+        pool_size=5,
+        max_overflow=5,
+        connect_args={
+            # соединения пула переходят между потоками DataLoader
+            "check_same_thread": False,
+            # сколько секунд ждать, пока другой процесс держит блокировку
+            "timeout": 30,
+            # кэш подготовленных выражений sqlite3 на соединение
+            "cached_statements": 256,
+        },
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+        attach_partitions(dbapi_connection)
+
+    return engine
+
+
+# колонки emergency_occurrence в порядке таблицы; у разделов архива те же
+OCCURRENCE_COLUMNS = (
+    "id", "mestorozdenie_id", "year", "injured_amount", "emergency_type_id", "comment", "occurred_at",
+)
+
+
+def attach_partitions(dbapi_connection):
+    # файлы-разделы архива (archive.py) подключаются к соединению как
+    # archive_<id>, а временное представление emergency_occurrence_all
+    # объединяет текущие строки со всем архивом. Обычные запросы читают
+    # только main.emergency_occurrence и архив не затрагивают
+    exists = dbapi_connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_partition'"
+    ).fetchone()
+    if not exists:
+        return
+
+    columns = ", ".join(OCCURRENCE_COLUMNS)
+    sources = [f"SELECT {columns} FROM main.emergency_occurrence"]
+    attached = {row[1] for row in dbapi_connection.execute("PRAGMA database_list")}
+
+    for partition_id, path in dbapi_connection.execute("SELECT id, path FROM archive_partition ORDER BY id").fetchall():
+        schema = f"archive_{partition_id}"
+        if schema not in attached:
+            if not os.path.exists(path):
+                logger.warning("archive partition not found: %s", path)
+                continue
+            try:
+                dbapi_connection.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+            except sqlite3.OperationalError as e:
+                # например, разделов больше SQLITE_LIMIT_ATTACHED: соединение
+                # остается рабочим, в представлении нет только этого раздела
+                logger.warning("archive partition not attached: %s: %s", path, e)
+                continue
+        sources.append(f"SELECT {columns} FROM {schema}.emergency_occurrence")
+
+    dbapi_connection.execute("DROP VIEW IF EXISTS temp.emergency_occurrence_all")
+    dbapi_connection.execute("CREATE TEMP VIEW emergency_occurrence_all AS " + " UNION ALL ".join(sources))
+
+
+# по одной сессии на поток для каждого engine: сессия переиспользуется
+# между вызовами, а соединение после выхода из with возвращается в пул
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def session(engine):
+    with sessions_lock:
+        factory = sessions.get(engine)
+        if factory is None:
+            factory = sessions[engine] = scoped_session(sessionmaker(engine))
+    return factory()
+
+
+# колонки, которые переносит синхронизация (sync.py); ссылки на справочники
+# передаются не локальными id, а глобальными ключами строк из sync_key
+SYNC_COLUMNS = {
+    "mestorozdenie": ("name", "coord1", "coord2"),
+    "emergency_type": ("name",),
+    "emergency_occurrence": (
+        "mestorozdenie_id", "year", "injured_amount", "emergency_type_id", "comment", "occurred_at",
+    ),
+}
+SYNC_REFERENCES = {"mestorozdenie_id": "mestorozdenie", "emergency_type_id": "emergency_type"}
+
+
+def sync_values(columns, row):
+    # аргументы json_object для строки журнала: колонки row, ссылки - uid
+    return ", ".join(
+        f"'{column}', (SELECT uid FROM sync_key WHERE tbl = '{SYNC_REFERENCES[column]}' AND id = {row}.{column})"
+        if column in SYNC_REFERENCES else f"'{column}', {row}.{column}"
+        for column in columns
+    )
+
+
+def sync_hash(value):
+    # короткий хэш содержимого строки для ключей миграции 7 (sync_backfill)
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:16]
+
+
+def sync_backfill(table, columns, natural=False):
+    # строки, которые были в базе до миграции 7: ключ по содержимому и запись
+    # "I" в журнале. Базы, обновленные из одного файла, получают одинаковые
+    # ключи, и при первом обмене строки не дублируются. Справочники
+    # (natural=True) сопоставляются по всем колонкам (название, координаты)
+    # независимо от id; происшествие - по id и содержимому, поэтому разные
+    # происшествия под одним id в копиях, которые велись отдельно, остаются
+    # разными строками. Одинаковые строки справочника внутри одной базы
+    # получают ключ по содержимому только у меньшего id, остальные - по id базы
+    site = "(SELECT site FROM sync_site)"
+    stamp = f"1, {site}, strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+    if natural:
+        keys = f"""
+    INSERT OR IGNORE INTO sync_key(tbl, uid, id, version, origin, changed_at)
+    SELECT '{table}', 'base:' || sync_hash(json_array({', '.join(columns)})), MIN(id), {stamp}
+    FROM {table}
+    GROUP BY {', '.join(columns)};
+    """
+    else:
+        keys = f"""
+    INSERT OR IGNORE INTO sync_key(tbl, uid, id, version, origin, changed_at)
+    SELECT '{table}', 'base:' || t.id || ':' || sync_hash(json_object({sync_values(columns, "t")})), t.id, {stamp}
+    FROM {table} AS t;
+    """
+
+    return keys + f"""
+    INSERT OR IGNORE INTO sync_key(tbl, uid, id, version, origin, changed_at)
+    SELECT '{table}', {site} || ':' || id, id, {stamp}
+    FROM {table};
+
+    INSERT INTO change_log(tbl, uid, op, data, version, origin, changed_at)
+    SELECT '{table}', k.uid, 'I', json_object({sync_values(columns, "t")}), k.version, k.origin, k.changed_at
+    FROM {table} AS t
+    JOIN sync_key AS k ON k.tbl = '{table}' AND k.id = t.id
+    ORDER BY t.id;
+    """
+
+
+def sync_triggers(table, columns=None, when=""):
+    # триггеры журнала изменений (миграции 7 и 8). Свои изменения получают
+    # метку этой базы (версия строки + 1, время, site); при применении чужих
+    # изменений (sync_site.applying - id базы-источника) метку заранее
+    # записывает sync.py, а триггер только переносит ее в журнал.
+    # Миграция передает свой список колонок, чтобы не зависеть от SYNC_COLUMNS
+    if columns is None:
+        columns = SYNC_COLUMNS[table]
+    values = sync_values(columns, "new")
+    stamp = f"""
+        UPDATE sync_key
+        SET version = version + 1,
+            origin = (SELECT site FROM sync_site),
+            changed_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+        WHERE tbl = '{table}' AND id = {{row}}.id AND (SELECT applying FROM sync_site) IS NULL;
+    """.strip()
+    log = f"""
+        INSERT INTO change_log(tbl, uid, op, data, version, origin, changed_at, peer)
+        SELECT '{table}', uid, '{{op}}', {{data}}, version, origin, changed_at, (SELECT applying FROM sync_site)
+        FROM sync_key
+        WHERE tbl = '{table}' AND id = {{row}}.id;
+    """.strip()
+    if when:
+        when = "\n    WHEN " + when
+
+    return f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_sync_insert
+    AFTER INSERT ON {table}{when}
+    BEGIN
+        INSERT OR IGNORE INTO sync_key(tbl, uid, id)
+        VALUES ('{table}', (SELECT site FROM sync_site) || ':' || new.id, new.id);
+        {stamp.format(row="new")}
+        {log.format(row="new", op="I", data=f"json_object({values})")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS {table}_sync_update
+    AFTER UPDATE ON {table}{when}
+    BEGIN
+        {stamp.format(row="new")}
+        {log.format(row="new", op="U", data=f"json_object({values})")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS {table}_sync_delete
+    AFTER DELETE ON {table}{when}
+    BEGIN
+        {stamp.format(row="old")}
+        {log.format(row="old", op="D", data="NULL")}
+        UPDATE sync_key SET id = NULL WHERE tbl = '{table}' AND id = old.id;
+    END;
+    """
+
+
+# изменения схемы базы; номер последней примененной миграции хранится
+# в PRAGMA user_version, поэтому каждая миграция выполняется один раз
+MIGRATIONS = [
+    # 1: сводная таблица количества происшествий и суммы ущерба
+    # по (месторождение, тип, год), которую поддерживают триггеры
+    """
+    CREATE TABLE IF NOT EXISTS emergency_rollup (
+        mestorozdenie_id INTEGER,
+        emergency_type_id INTEGER,
+        year INTEGER,
+        amount INTEGER NOT NULL DEFAULT 0,
+        injured_amount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (mestorozdenie_id, emergency_type_id, year)
+    );
+
+    DELETE FROM emergency_rollup;
+
+    INSERT INTO emergency_rollup(mestorozdenie_id, emergency_type_id, year, amount, injured_amount)
+    SELECT mestorozdenie_id, emergency_type_id, year, COUNT(*), IFNULL(SUM(injured_amount), 0)
+    FROM emergency_occurrence
+    GROUP BY mestorozdenie_id, emergency_type_id, year;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_insert
+    AFTER INSERT ON emergency_occurrence
+    BEGIN
+        INSERT OR IGNORE INTO emergency_rollup(mestorozdenie_id, emergency_type_id, year)
+        VALUES (new.mestorozdenie_id, new.emergency_type_id, new.year);
+
+        UPDATE emergency_rollup
+        SET amount = amount + 1, injured_amount = injured_amount + IFNULL(new.injured_amount, 0)
+        WHERE mestorozdenie_id IS new.mestorozdenie_id
+          AND emergency_type_id IS new.emergency_type_id
+          AND year IS new.year;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_delete
+    AFTER DELETE ON emergency_occurrence
+    BEGIN
+        UPDATE emergency_rollup
+        SET amount = amount - 1, injured_amount = injured_amount - IFNULL(old.injured_amount, 0)
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND year IS old.year;
+
+        DELETE FROM emergency_rollup
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND year IS old.year
+          AND amount <= 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_update
+    AFTER UPDATE OF mestorozdenie_id, emergency_type_id, year, injured_amount ON emergency_occurrence
+    BEGIN
+        UPDATE emergency_rollup
+        SET amount = amount - 1, injured_amount = injured_amount - IFNULL(old.injured_amount, 0)
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND year IS old.year;
+
+        INSERT OR IGNORE INTO emergency_rollup(mestorozdenie_id, emergency_type_id, year)
+        VALUES (new.mestorozdenie_id, new.emergency_type_id, new.year);
+
+        UPDATE emergency_rollup
+        SET amount = amount + 1, injured_amount = injured_amount + IFNULL(new.injured_amount, 0)
+        WHERE mestorozdenie_id IS new.mestorozdenie_id
+          AND emergency_type_id IS new.emergency_type_id
+          AND year IS new.year;
+
+        DELETE FROM emergency_rollup
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND year IS old.year
+          AND amount <= 0;
+    END;
+    """,
+
+    # 2: индексы под все варианты фильтра по месторождению и типу;
+    # year в конце индекса дает готовый порядок ORDER BY year DESC, id DESC
+    """
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_type_year
+    ON emergency_occurrence(mestorozdenie_id, emergency_type_id, year);
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_type_year
+    ON emergency_occurrence(emergency_type_id, year);
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_year
+    ON emergency_occurrence(mestorozdenie_id, year);
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_year
+    ON emergency_occurrence(year);
+    """,
+
+    # 3: полнотекстовый индекс комментариев. Таблица FTS5 хранит только
+    # индекс (content= - сами тексты остаются в emergency_occurrence),
+    # prefix= ускоряет поиск по первым 2-3 буквам слова при наборе
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS emergency_comment_fts USING fts5(
+        comment,
+        content='emergency_occurrence',
+        content_rowid='id',
+        prefix='2 3'
+    );
+
+    INSERT INTO emergency_comment_fts(emergency_comment_fts) VALUES ('rebuild');
+
+    CREATE TRIGGER IF NOT EXISTS emergency_comment_fts_insert
+    AFTER INSERT ON emergency_occurrence
+    BEGIN
+        INSERT INTO emergency_comment_fts(rowid, comment) VALUES (new.id, new.comment);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_comment_fts_delete
+    AFTER DELETE ON emergency_occurrence
+    BEGIN
+        INSERT INTO emergency_comment_fts(emergency_comment_fts, rowid, comment)
+        VALUES ('delete', old.id, old.comment);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_comment_fts_update
+    AFTER UPDATE OF comment ON emergency_occurrence
+    BEGIN
+        INSERT INTO emergency_comment_fts(emergency_comment_fts, rowid, comment)
+        VALUES ('delete', old.id, old.comment);
+        INSERT INTO emergency_comment_fts(rowid, comment) VALUES (new.id, new.comment);
+    END;
+    """,
+
+    # 4: пространственный индекс месторождений для выбора области на карте;
+    # месторождение - точка, т.е. прямоугольник нулевого размера
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS mestorozdenie_rtree USING rtree(
+        id, min_coord1, max_coord1, min_coord2, max_coord2
+    );
+
+    DELETE FROM mestorozdenie_rtree;
+
+    INSERT INTO mestorozdenie_rtree
+    SELECT id, coord1, coord1, coord2, coord2
+    FROM mestorozdenie
+    WHERE coord1 IS NOT NULL AND coord2 IS NOT NULL;
+
+    CREATE TRIGGER IF NOT EXISTS mestorozdenie_rtree_insert
+    AFTER INSERT ON mestorozdenie
+    WHEN new.coord1 IS NOT NULL AND new.coord2 IS NOT NULL
+    BEGIN
+        INSERT INTO mestorozdenie_rtree VALUES (new.id, new.coord1, new.coord1, new.coord2, new.coord2);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS mestorozdenie_rtree_delete
+    AFTER DELETE ON mestorozdenie
+    BEGIN
+        DELETE FROM mestorozdenie_rtree WHERE id = old.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS mestorozdenie_rtree_update
+    AFTER UPDATE OF id, coord1, coord2 ON mestorozdenie
+    BEGIN
+        DELETE FROM mestorozdenie_rtree WHERE id = old.id;
+
+        INSERT INTO mestorozdenie_rtree
+        SELECT new.id, new.coord1, new.coord1, new.coord2, new.coord2
+        WHERE new.coord1 IS NOT NULL AND new.coord2 IS NOT NULL;
+    END;
+    """,
+
+    # 5: индексы под сортировку таблицы по ущербу и комментарию при тех же
+    # вариантах фильтра, что и в миграции 2; выражения совпадают с queries.SORT_KEYS
+    """
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_type_injured
+    ON emergency_occurrence(mestorozdenie_id, emergency_type_id, IFNULL(injured_amount, 0));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_type_injured
+    ON emergency_occurrence(emergency_type_id, IFNULL(injured_amount, 0));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_injured
+    ON emergency_occurrence(mestorozdenie_id, IFNULL(injured_amount, 0));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_injured
+    ON emergency_occurrence(IFNULL(injured_amount, 0));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_type_comment
+    ON emergency_occurrence(mestorozdenie_id, emergency_type_id, IFNULL(comment, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_type_comment
+    ON emergency_occurrence(emergency_type_id, IFNULL(comment, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_comment
+    ON emergency_occurrence(mestorozdenie_id, IFNULL(comment, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_comment
+    ON emergency_occurrence(IFNULL(comment, ''));
+    """,
+
+    # 6: версия справочников для их кэша на диске (см. reference_cache.py):
+    # триггеры увеличивают version при любом изменении, а случайный token
+    # отличает эту базу от другой с тем же номером версии
+    """
+    CREATE TABLE IF NOT EXISTS reference_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        token TEXT NOT NULL,
+        version INTEGER NOT NULL
+    );
+
+    INSERT OR IGNORE INTO reference_version(id, token, version)
+    VALUES (1, lower(hex(randomblob(16))), 1);
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_mestorozdenie_insert
+    AFTER INSERT ON mestorozdenie
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_mestorozdenie_update
+    AFTER UPDATE ON mestorozdenie
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_mestorozdenie_delete
+    AFTER DELETE ON mestorozdenie
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_emergency_type_insert
+    AFTER INSERT ON emergency_type
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_emergency_type_update
+    AFTER UPDATE ON emergency_type
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reference_version_emergency_type_delete
+    AFTER DELETE ON emergency_type
+    BEGIN
+        UPDATE reference_version SET version = version + 1;
+    END;
+    """,
+
+    # 7: журнал изменений для синхронизации баз разных рудников (sync.py).
+    # sync_key - глобальный ключ каждой строки (uid) и метка ее последнего
+    # изменения; после удаления строки ключ остается с id = NULL, чтобы
+    # устаревшее изменение с другой базы не вернуло строку. Ключи и журнал
+    # строк, которые уже были в базе, заполняет sync_backfill
+    """
+    CREATE TABLE IF NOT EXISTS sync_site (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        site TEXT NOT NULL,
+        applying TEXT
+    );
+
+    INSERT OR IGNORE INTO sync_site(id, site) VALUES (1, lower(hex(randomblob(8))));
+
+    CREATE TABLE IF NOT EXISTS sync_key (
+        tbl TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        id INTEGER,
+        version INTEGER NOT NULL DEFAULT 0,
+        origin TEXT,
+        changed_at TEXT,
+        PRIMARY KEY (tbl, uid)
+    );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS sync_key_id ON sync_key(tbl, id);
+
+    -- seq растет монотонно (AUTOINCREMENT не переиспользует номера);
+    -- peer - база, от которой пришло изменение, NULL - сделано здесь
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        op TEXT NOT NULL,
+        data TEXT,
+        version INTEGER NOT NULL,
+        origin TEXT NOT NULL,
+        changed_at TEXT NOT NULL,
+        peer TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS change_log_uid ON change_log(tbl, uid, seq);
+
+    -- sent - до какого seq этой базы другая база подтвердила прием,
+    -- received - до какого seq другой базы ее изменения применены здесь
+    CREATE TABLE IF NOT EXISTS sync_peer (
+        site TEXT PRIMARY KEY,
+        sent INTEGER NOT NULL DEFAULT 0,
+        received INTEGER NOT NULL DEFAULT 0,
+        synced_at TEXT
+    );
+
+    -- обе базы изменили одну строку между синхронизациями: побеждает
+    -- изменение с большей меткой, проигравшее сохраняется здесь
+    CREATE TABLE IF NOT EXISTS sync_conflict (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        peer TEXT NOT NULL,
+        kept TEXT,
+        discarded TEXT,
+        detected_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    );
+    """
+    + sync_backfill("mestorozdenie", ("name", "coord1", "coord2"), natural=True)
+    + sync_backfill("emergency_type", ("name",), natural=True)
+    + sync_backfill(
+        "emergency_occurrence", ("mestorozdenie_id", "year", "injured_amount", "emergency_type_id", "comment"),
+    )
+    + sync_triggers("mestorozdenie", ("name", "coord1", "coord2"))
+    + sync_triggers("emergency_type", ("name",))
+    + sync_triggers(
+        "emergency_occurrence", ("mestorozdenie_id", "year", "injured_amount", "emergency_type_id", "comment"),
+    ),
+
+    # 8: дата и время происшествия. У строк, записанных до миграции,
+    # известен только год - occurred_at у них NULL; у новых year всегда
+    # равен году occurred_at. Сводка по месяцам (month - 'YYYY-MM') считается
+    # только по строкам с датой, кварталы складываются из месяцев, годы
+    # по-прежнему берутся из emergency_rollup.
+    # archive_partition - файлы-разделы со старыми годами (archive.py):
+    # перенос в раздел не попадает в журнал синхронизации (sync_site.archiving)
+    """
+    ALTER TABLE emergency_occurrence ADD COLUMN occurred_at TEXT;
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_occurred_at
+    ON emergency_occurrence(occurred_at);
+
+    CREATE TABLE IF NOT EXISTS emergency_rollup_month (
+        mestorozdenie_id INTEGER,
+        emergency_type_id INTEGER,
+        month TEXT,
+        amount INTEGER NOT NULL DEFAULT 0,
+        injured_amount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (mestorozdenie_id, emergency_type_id, month)
+    );
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_month_insert
+    AFTER INSERT ON emergency_occurrence
+    WHEN new.occurred_at IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO emergency_rollup_month(mestorozdenie_id, emergency_type_id, month)
+        VALUES (new.mestorozdenie_id, new.emergency_type_id, substr(new.occurred_at, 1, 7));
+
+        UPDATE emergency_rollup_month
+        SET amount = amount + 1, injured_amount = injured_amount + IFNULL(new.injured_amount, 0)
+        WHERE mestorozdenie_id IS new.mestorozdenie_id
+          AND emergency_type_id IS new.emergency_type_id
+          AND month = substr(new.occurred_at, 1, 7);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_month_delete
+    AFTER DELETE ON emergency_occurrence
+    WHEN old.occurred_at IS NOT NULL
+    BEGIN
+        UPDATE emergency_rollup_month
+        SET amount = amount - 1, injured_amount = injured_amount - IFNULL(old.injured_amount, 0)
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND month = substr(old.occurred_at, 1, 7);
+
+        DELETE FROM emergency_rollup_month
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND month = substr(old.occurred_at, 1, 7)
+          AND amount <= 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emergency_rollup_month_update
+    AFTER UPDATE OF mestorozdenie_id, emergency_type_id, occurred_at, injured_amount ON emergency_occurrence
+    BEGIN
+        UPDATE emergency_rollup_month
+        SET amount = amount - 1, injured_amount = injured_amount - IFNULL(old.injured_amount, 0)
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND month = substr(old.occurred_at, 1, 7);
+
+        INSERT OR IGNORE INTO emergency_rollup_month(mestorozdenie_id, emergency_type_id, month)
+        SELECT new.mestorozdenie_id, new.emergency_type_id, substr(new.occurred_at, 1, 7)
+        WHERE new.occurred_at IS NOT NULL;
+
+        UPDATE emergency_rollup_month
+        SET amount = amount + 1, injured_amount = injured_amount + IFNULL(new.injured_amount, 0)
+        WHERE mestorozdenie_id IS new.mestorozdenie_id
+          AND emergency_type_id IS new.emergency_type_id
+          AND month = substr(new.occurred_at, 1, 7);
+
+        DELETE FROM emergency_rollup_month
+        WHERE mestorozdenie_id IS old.mestorozdenie_id
+          AND emergency_type_id IS old.emergency_type_id
+          AND month = substr(old.occurred_at, 1, 7)
+          AND amount <= 0;
+    END;
+
+    ALTER TABLE sync_site ADD COLUMN archiving INTEGER NOT NULL DEFAULT 0;
+
+    DROP TRIGGER IF EXISTS emergency_occurrence_sync_insert;
+    DROP TRIGGER IF EXISTS emergency_occurrence_sync_update;
+    DROP TRIGGER IF EXISTS emergency_occurrence_sync_delete;
+
+    CREATE TABLE IF NOT EXISTS archive_partition (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        path TEXT NOT NULL UNIQUE,
+        first_year INTEGER,
+        last_year INTEGER,
+        rows INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    );
+    """
+    + sync_triggers(
+        "emergency_occurrence",
+        ("mestorozdenie_id", "year", "injured_amount", "emergency_type_id", "comment", "occurred_at"),
+        when="(SELECT archiving FROM sync_site) = 0",
+    ),
+
+    # 9: ключи строк, перенесенных в архив, помечаются archived: id у них
+    # остается (строка есть в разделе), но чужие изменения к ним sync.py не
+    # применяет, а записывает в sync_conflict. Строки, перенесенные до этой
+    # миграции, - это ключи с id, которого нет в основной таблице
+    """
+    ALTER TABLE sync_key ADD COLUMN archived INTEGER NOT NULL DEFAULT 0;
+
+    UPDATE sync_key SET archived = 1
+    WHERE tbl = 'emergency_occurrence'
+      AND id IS NOT NULL
+      AND id NOT IN (SELECT id FROM main.emergency_occurrence);
+    """,
+
+    # 10: колонка "Дата происшествия" сортируется по году и дате
+    # (queries.SORT_KEYS["year"]); новые индексы заменяют индексы миграции 2,
+    # выборки только по году идут по их началу
+    """
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_type_date
+    ON emergency_occurrence(mestorozdenie_id, emergency_type_id, year, IFNULL(occurred_at, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_type_date
+    ON emergency_occurrence(emergency_type_id, year, IFNULL(occurred_at, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_deposit_date
+    ON emergency_occurrence(mestorozdenie_id, year, IFNULL(occurred_at, ''));
+
+    CREATE INDEX IF NOT EXISTS emergency_occurrence_date
+    ON emergency_occurrence(year, IFNULL(occurred_at, ''));
+
+    DROP INDEX IF EXISTS emergency_occurrence_deposit_type_year;
+    DROP INDEX IF EXISTS emergency_occurrence_type_year;
+    DROP INDEX IF EXISTS emergency_occurrence_deposit_year;
+    DROP INDEX IF EXISTS emergency_occurrence_year;
+    """,
+]
+
+
+def migrate(engine):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.driver_connection
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        # функция для ключей строк в миграции 7
+        cursor.create_function("sync_hash", 1, sync_hash, deterministic=True)
+
+        for number, script in enumerate(MIGRATIONS[version:], version + 1):
+            # executescript сам коммитит открытую транзакцию, поэтому
+            # миграцию и новый номер версии оборачиваем в свою
+            cursor.executescript(f"""
+            BEGIN;
+            {script}
+            PRAGMA user_version = {number};
+            COMMIT;
+            """)
+
+        # соединение открылось до миграций, разделы архива подключаются заново
+        attach_partitions(cursor)
+    finally:
+        connection.close()
+
+
+
+def check_query_plans(engine):
+    # проверка при запуске: все варианты фильтра должны идти по индексу,
+    # полный просмотр таблицы или сортировка во временном дереве - повод
+    # проверить, применились ли миграции
+    problems = []
+
+    with session(engine) as s:
+        for deposit_id in (0, 1):
+            for emergency_type_id in (0, 1):
+                for key in SORT_KEYS:
+                    for after in (None, ((0,) * len(SORT_KEYS[key]), 0)):
+                        query, params = occurrence_query(deposit_id, emergency_type_id, after, limit=1, order=(key, True))
+                        plan = s.execute(text("EXPLAIN QUERY PLAN " + query), params)
+                        for r in plan:
+                            detail = r.detail
+                            scan = detail.startswith("SCAN") and "INDEX" not in detail
+                            if scan or "TEMP B-TREE" in detail:
+                                problems.append((query, detail))
+                                logger.warning("query plan uses %r: %s", detail, query)
+
+    return problems
+
+
+# функции доступа к данным; вызываются из пула потоков (workers.DataLoader),
+# поэтому каждая открывает свою сессию и не трогает объекты Qt
+
+@perf.instrument("query.reference")
+def load_mestorozdenie(engine):
+    deposits = {}
+
+    with session(engine) as s:
+
+        query = """
+        SELECT *
+        FROM mestorozdenie
+        """
+
+        rows = s.execute(text(query))
+        for r in rows:
+            deposits[r.id] = r
+
+    return deposits
+
+
+@perf.instrument("query.reference")
+def load_emergency_type(engine):
+    emergencyTypes = {}
+
+    with session(engine) as s:
+
+        query = """
+        SELECT *
+        FROM emergency_type
+        """
+
+        rows = s.execute(text(query))
+        for r in rows:
+            emergencyTypes[r.id] = r
+
+    return emergencyTypes
+
+
+@perf.instrument("query.reference")
+def load_references(engine, known=None):
+    # версия справочников (token, version) и сами справочники; если версия
+    # совпадает с known (из кэша на диске), таблицы не читаются - None
+    with session(engine) as s:
+        r = s.execute(text("SELECT token, version FROM reference_version")).one()
+
+    key = (r.token, r.version)
+    if key == known:
+        return None
+    return key, load_mestorozdenie(engine), load_emergency_type(engine)
+
+
+@perf.instrument("query.page")
+def load_occurrence_page(engine, deposit_id, emergency_type_id, after, limit, deposit_ids=None, columns=None, order=None):
+    query, params = occurrence_query(deposit_id, emergency_type_id, after, limit, deposit_ids, columns, order)
+
+    with session(engine) as s:
+        return s.execute(text(query), params).all()
+
+
+@perf.instrument("query.search")
+def search_occurrence_page(engine, search, deposit_id, emergency_type_id, offset, limit, deposit_ids=None, columns=None, order=None):
+    # страница результатов полнотекстового поиска по комментариям,
+    # в порядке релевантности; у строк есть поле highlight с метками совпадений
+    query, params = search_query(search, deposit_id, emergency_type_id, offset, limit, deposit_ids, columns, order)
+
+    with session(engine) as s:
+        return s.execute(text(query), params).all()
+
+
+@perf.instrument("query.region")
+def deposits_in_box(engine, min_coord1, max_coord1, min_coord2, max_coord2):
+    # id месторождений в прямоугольнике координат, по индексу mestorozdenie_rtree
+    with session(engine) as s:
+
+        query = """
+        SELECT id
+        FROM mestorozdenie_rtree
+        WHERE max_coord1 >= :min1 AND min_coord1 <= :max1
+          AND max_coord2 >= :min2 AND min_coord2 <= :max2
+        """
+
+        rows = s.execute(text(query), {
+            "min1": min_coord1,
+            "max1": max_coord1,
+            "min2": min_coord2,
+            "max2": max_coord2,
+        })
+        return frozenset(r.id for r in rows)
+
+
+@perf.instrument("query.region")
+def deposits_in_radius(engine, coord1, coord2, km):
+    # id месторождений не дальше km от точки: индекс отбирает кандидатов
+    # в описанном прямоугольнике, точное расстояние считается по координатам
+    min_coord1, max_coord1, min_coord2, max_coord2 = geo.radius_box(coord1, coord2, km)
+
+    with session(engine) as s:
+
+        query = """
+        SELECT m.id, m.coord1, m.coord2
+        FROM mestorozdenie_rtree AS r
+        JOIN mestorozdenie AS m ON m.id = r.id
+        WHERE r.max_coord1 >= :min1 AND r.min_coord1 <= :max1
+          AND r.max_coord2 >= :min2 AND r.min_coord2 <= :max2
+        """
+
+        rows = s.execute(text(query), {
+            "min1": min_coord1,
+            "max1": max_coord1,
+            "min2": min_coord2,
+            "max2": max_coord2,
+        })
+        return frozenset(
+            r.id for r in rows
+            if geo.distance_km(coord1, coord2, r.coord1, r.coord2) <= km
+        )
+
+
+# функции записи возвращают пару (старая строка, новая строка), чтобы
+# таблица и графики могли обновиться точечно, без перезагрузки
+
+@perf.instrument("query.insert")
+def insert_occurrence(engine, data):
+    with session(engine) as s:
+        query = """
+        INSERT INTO emergency_occurrence(mestorozdenie_id, year, injured_amount, emergency_type_id, comment, occurred_at)
+        VALUES (:did, :y, :i, :tid, :c, :o)
+        RETURNING *
+        """
+
+        new = s.execute(text(query), {
+            "did": data['deposit_id'],
+            "tid": data['type_id'],
+            "y": data['year'],
+            "i": data['injured'],
+            "c": data['comment'],
+            "o": data.get('occurred_at'),
+        }).one()
+        s.commit()
+
+    return None, new
+
+
+@perf.instrument("query.update")
+def update_occurrence(engine, occurrence_id, data):
+    with session(engine) as s:
+        old = s.execute(text("SELECT * FROM emergency_occurrence WHERE id = :id"), {"id": occurrence_id}).one()
+
+        query = """
+        UPDATE emergency_occurrence
+        SET year = :y, injured_amount = :i, emergency_type_id = :tid, comment = :c, occurred_at = :o
+        WHERE id = :id
+        RETURNING *
+        """
+
+        new = s.execute(text(query), {
+            "tid": data['type_id'],
+            "y": data['year'],
+            "i": data['injured'],
+            "c": data['comment'],
+            "o": data.get('occurred_at'),
+            "id": occurrence_id,
+        }).one()
+        s.commit()
+
+    return old, new
+
+
+@perf.instrument("query.delete")
+def delete_occurrence(engine, occurrence_id):
+    with session(engine) as s:
+        query = """
+        DELETE 
+        FROM emergency_occurrence 
+        WHERE id = :id
+        RETURNING *
+        """
+
+        old = s.execute(text(query), {"id": occurrence_id}).one()
+        s.commit()
+
+    return old, None
+
+
+# результат пакетной записи: пары (строка до, строка после) и глобальные
+# ключи синхронизации удаленных строк {id: uid}, по которым отмена удаления
+# возвращает строкам прежние ключи (см. миграцию 7)
+Changes = collections.namedtuple("Changes", "pairs keys")
+
+# поля пакетного изменения -> SET; при смене года дата сдвигается на
+# столько же лет (29 февраля в невисокосный год становится 1 марта).
+# В SET справа везде значения строки до изменения
+BULK_SET = {
+    "type_id": "emergency_type_id = :type_id",
+    "year": """year = :year,
+        occurred_at = CASE
+            WHEN occurred_at IS NULL THEN NULL
+            WHEN length(occurred_at) > 10 THEN strftime('%Y-%m-%d %H:%M', occurred_at, printf('%+d years', :year - year))
+            ELSE date(occurred_at, printf('%+d years', :year - year))
+        END""",
+    "injured": "injured_amount = :injured",
+}
+
+
+def executemany(s, query, params):
+    # пустой список параметров SQLAlchemy выполнил бы как один запрос без них
+    if params:
+        s.execute(text(query), params)
+
+
+def select_occurrences(s, ids):
+    rows = s.execute(
+        text("SELECT * FROM emergency_occurrence WHERE id IN (SELECT value FROM json_each(:ids))"),
+        {"ids": json.dumps(list(ids))},
+    )
+    return {r.id: r for r in rows}
+
+
+def sync_keys(s, ids):
+    rows = s.execute(
+        text("SELECT id, uid FROM sync_key WHERE tbl = 'emergency_occurrence' AND id IN (SELECT value FROM json_each(:ids))"),
+        {"ids": json.dumps(list(ids))},
+    )
+    return {r.id: r.uid for r in rows}
+
+
+@perf.instrument("query.update")
+def update_occurrences(engine, ids, changes):
+    # одно и то же изменение для многих строк: одна транзакция, executemany.
+    # changes - проверенные значения, только изменяемые поля из BULK_SET
+    query = (
+        "UPDATE emergency_occurrence SET "
+        + ", ".join(BULK_SET[name] for name in BULK_SET if name in changes)
+        + " WHERE id = :id"
+    )
+
+    with session(engine) as s:
+        old = select_occurrences(s, ids)
+        executemany(s, query, [{**changes, "id": occurrence_id} for occurrence_id in old])
+        new = select_occurrences(s, ids)
+        s.commit()
+
+    return Changes([(old[i], new.get(i)) for i in ids if i in old], {})
+
+
+@perf.instrument("query.delete")
+def delete_occurrences(engine, ids):
+    with session(engine) as s:
+        old = select_occurrences(s, ids)
+        keys = sync_keys(s, old)
+        executemany(s, "DELETE FROM emergency_occurrence WHERE id = :id", [{"id": i} for i in old])
+        s.commit()
+
+    return Changes([(old[i], None) for i in ids if i in old], keys)
+
+
+@perf.instrument("query.restore")
+def restore_occurrences(engine, changes):
+    # отмена записи: каждая строка возвращается к состоянию "до" - удаленные
+    # вставляются с прежними id и ключами синхронизации, добавленные удаляются,
+    # измененные получают прежние значения. Результат - Changes с обратными
+    # парами, его можно отменить так же
+    deleted, restored, reverted = [], [], []
+    for old, new in changes.pairs:
+        if old is None:
+            deleted.append({"id": new.id})
+        elif new is None:
+            restored.append(old._asdict())
+        else:
+            reverted.append(old._asdict())
+    ids = [(old or new).id for old, new in changes.pairs]
+    restored_ids = {row["id"] for row in restored}
+
+    with session(engine) as s:
+        current = select_occurrences(s, ids)
+        keys = sync_keys(s, [row["id"] for row in deleted])
+
+        executemany(s, "DELETE FROM emergency_occurrence WHERE id = :id", deleted)
+        # ключ-надгробие снова указывает на строку, и вставка записывается
+        # в журнал под прежним uid - на других базах строка вернется
+        executemany(
+            s, "UPDATE sync_key SET id = :id WHERE tbl = 'emergency_occurrence' AND uid = :uid AND id IS NULL",
+            [{"id": i, "uid": uid} for i, uid in changes.keys.items() if i in restored_ids],
+        )
+        executemany(
+            s,
+            f"INSERT INTO emergency_occurrence({', '.join(OCCURRENCE_COLUMNS)}) "
+            f"VALUES ({', '.join(':' + column for column in OCCURRENCE_COLUMNS)})",
+            restored,
+        )
+        executemany(
+            s,
+            "UPDATE emergency_occurrence SET "
+            + ", ".join(f"{column} = :{column}" for column in OCCURRENCE_COLUMNS if column != "id")
+            + " WHERE id = :id",
+            reverted,
+        )
+
+        new = select_occurrences(s, ids)
+        s.commit()
+
+    return Changes([(current.get(i), new.get(i)) for i in ids], keys)
@@ -0,0 +1,212 @@
+import argparse
+import csv
+
+from sqlalchemy import text
+
+import database
+from queries import occurrence_filter, occurrence_query, search_query
+
+CHUNK_SIZE = 10000
+
+OCCURRENCE_COLUMNS = [
+    "id", "Месторождение", "Год происшествия", "Сумма ущерба", "Тип происшествия", "Комментарий", "Дата и время",
+]
+ROLLUP_COLUMNS = ["Месторождение", "Тип происшествия", "Год", "Кол-во происшествий", "Сумма ущерба"]
+
+# типы колонок задаются явно (нужны для Parquet), иначе тип выводился бы
+# по первой пачке, и пустые комментарии в ней ломали бы схему файла
+OCCURRENCE_TYPES = ["int64", "string", "int64", "int64", "string", "string", "string"]
+ROLLUP_TYPES = ["string", "string", "int64", "int64", "int64"]
+
+
+# писатели форматов: строки приходят пачками, в памяти держится одна пачка.
+# openpyxl и pyarrow нужны только для своих форматов и импортируются по требованию
+
+class CsvWriter:
+    def __init__(self, path, columns, types) -> None:
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file, delimiter=";")
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class XlsxWriter:
+    # строк на листе Excel не больше 1 048 576 вместе с заголовком, а
+    # openpyxl этого не проверяет: дальше строки идут на следующий лист
+    MAX_ROWS = 1048576
+
+    def __init__(self, path, columns, types) -> None:
+        import openpyxl
+
+        self.path = path
+        self.columns = columns
+        # write_only: строки сразу сбрасываются во временный файл
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheets = 0
+        self.add_sheet()
+
+    def add_sheet(self):
+        self.sheets += 1
+        self.sheet = self.workbook.create_sheet(f"Лист {self.sheets}")
+        self.sheet.append(self.columns)
+        self.rows = 1
+
+    def write(self, rows):
+        for row in rows:
+            if self.rows == self.MAX_ROWS:
+                self.add_sheet()
+            self.sheet.append(row)
+            self.rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class ParquetWriter:
+    def __init__(self, path, columns, types) -> None:
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, type_) for name, type_ in zip(columns, types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        # каждая пачка - отдельная row group в файле
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)],
+            schema=self.schema,
+        )
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {
+    ".csv": CsvWriter,
+    ".xlsx": XlsxWriter,
+    ".parquet": ParquetWriter,
+}
+
+
+def open_writer(path, columns, types):
+    for extension, writer in WRITERS.items():
+        if path.lower().endswith(extension):
+            return writer(path, columns, types)
+    raise ValueError(f"Неизвестный формат файла: {path}")
+
+
+def names(rows):
+    return {r.id: r.name for r in rows.values()}
+
+
+def export_occurrences(
+    engine, path, deposit_id=0, emergency_type_id=0, progress=None, chunk_size=CHUNK_SIZE, archive=False,
+    search="", deposit_ids=None, columns=None, order=None,
+):
+    # строки читаются курсором по chunk_size и сразу пишутся в файл;
+    # archive - вместе со строками, перенесенными в разделы архива.
+    # Остальные параметры - как у таблицы в окне (ItemsModel.setFilter), чтобы
+    # в файл попали те же строки в том же порядке
+    deposits = names(database.load_mestorozdenie(engine))
+    emergencyTypes = names(database.load_emergency_type(engine))
+    table = "emergency_occurrence_all" if archive else "emergency_occurrence"
+
+    if search:
+        # полнотекстовый индекс есть только у основной таблицы
+        query, params = search_query(
+            search, deposit_id, emergency_type_id, deposit_ids=deposit_ids, columns=columns, order=order,
+        )
+        count_query = f"SELECT COUNT(*) FROM ({query})"
+    else:
+        conditions, params = occurrence_filter(deposit_id, emergency_type_id, deposit_ids, columns)
+        count_query = f"SELECT COUNT(*) FROM {table}"
+        if conditions:
+            count_query += " WHERE " + " AND ".join(conditions)
+        query, params = occurrence_query(
+            deposit_id, emergency_type_id, deposit_ids=deposit_ids, columns=columns, order=order, table=table,
+        )
+
+    writer = open_writer(path, OCCURRENCE_COLUMNS, OCCURRENCE_TYPES)
+    done = 0
+    try:
+        with engine.connect() as connection:
+            total = connection.execute(text(count_query), params).scalar()
+
+            result = connection.execution_options(stream_results=True).execute(text(query), params)
+            for rows in result.partitions(chunk_size):
+                writer.write([
+                    (
+                        r.id,
+                        deposits.get(r.mestorozdenie_id),
+                        r.year,
+                        r.injured_amount,
+                        emergencyTypes.get(r.emergency_type_id),
+                        r.comment,
+                        r.occurred_at,
+                    )
+                    for r in rows
+                ])
+                done += len(rows)
+                if progress:
+                    progress(done, total)
+    finally:
+        writer.close()
+
+    return done
+
+
+def export_rollup(engine, path, deposit_id=0, emergency_type_id=0, progress=None):
+    # данные графиков: кол-во происшествий и ущерб по месторождению, типу и году
+    deposits = names(database.load_mestorozdenie(engine))
+    emergencyTypes = names(database.load_emergency_type(engine))
+
+    conditions, params = occurrence_filter(deposit_id, emergency_type_id)
+    query = "SELECT mestorozdenie_id, emergency_type_id, year, amount, injured_amount FROM emergency_rollup"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY mestorozdenie_id, emergency_type_id, year"
+
+    with database.session(engine) as s:
+        rows = s.execute(text(query), params).all()
+
+    writer = open_writer(path, ROLLUP_COLUMNS, ROLLUP_TYPES)
+    try:
+        writer.write([
+            (deposits.get(r.mestorozdenie_id), emergencyTypes.get(r.emergency_type_id), r.year, r.amount, r.injured_amount)
+            for r in rows
+        ])
+    finally:
+        writer.close()
+
+    if progress:
+        progress(len(rows), len(rows))
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Экспорт происшествий в CSV, XLSX или Parquet")
+    parser.add_argument("path", help="файл .csv, .xlsx или .parquet")
+    parser.add_argument("--database", default="database.db")
+    parser.add_argument("--deposit", type=int, default=0, help="id месторождения")
+    parser.add_argument("--type", type=int, default=0, help="id типа происшествия")
+    parser.add_argument("--rollup", action="store_true", help="выгрузить данные графиков")
+    parser.add_argument("--archive", action="store_true", help="вместе с архивом (archive.py)")
+    args = parser.parse_args()
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+
+    if args.rollup:
+        count = export_rollup(engine, args.path, args.deposit, args.type)
+    else:
+        count = export_occurrences(engine, args.path, args.deposit, args.type, archive=args.archive)
+    print(f"Выгружено строк: {count}")
@@ -0,0 +1,29 @@
+import math
+
+# координаты месторождений: coord1 - широта, coord2 - долгота, в градусах
+EARTH_RADIUS_KM = 6371.0
+
+
+def distance_km(coord1, coord2, other_coord1, other_coord2):
+    # расстояние по большому кругу (формула гаверсинусов)
+    lat1, lon1, lat2, lon2 = map(math.radians, (coord1, coord2, other_coord1, other_coord2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_box(coord1, coord2, km):
+    # прямоугольник (min_coord1, max_coord1, min_coord2, max_coord2), в который
+    # заведомо попадает круг радиуса km; точную проверку делает distance_km.
+    # Переход через 180-й меридиан не учитывается
+    delta1 = math.degrees(km / EARTH_RADIUS_KM)
+    cos = math.cos(math.radians(coord1))
+    if cos < 1e-6 or delta1 >= 90:
+        delta2 = 180.0
+    else:
+        delta2 = min(180.0, math.degrees(km / (EARTH_RADIUS_KM * cos)))
+    return (
+        max(-90.0, coord1 - delta1),
+        min(90.0, coord1 + delta1),
+        max(-180.0, coord2 - delta2),
+        min(180.0, coord2 + delta2),
+    )
@@ -0,0 +1,227 @@
+import argparse
+import csv
+import itertools
+import json
+import re
+import time
+
+from sqlalchemy import text
+
+import database
+from validation import ValidationError, parse_injured, parse_occurred_at, parse_year
+
+BATCH_SIZE = 5000
+# сколько ошибок сохранять для отчета, чтобы память не росла на плохом файле
+MAX_ERRORS = 100
+# JSON-массив читается кусками такого размера (символов)
+CHUNK_SIZE = 1 << 16
+
+SPACE = re.compile(r"\s*")
+
+
+def json_record(value):
+    if not isinstance(value, dict):
+        return ValidationError(f"Ожидался объект JSON, а не {type(value).__name__}")
+    return value
+
+
+def read_json_array(f, chunk_size=CHUNK_SIZE):
+    # потоковый разбор массива объектов: в памяти только текущий элемент и
+    # остаток прочитанного куска. После синтаксической ошибки границы
+    # следующих элементов неизвестны, поэтому разбор на ней заканчивается
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    state = "start"
+    while True:
+        pos = SPACE.match(buf, pos).end()
+        if pos == len(buf) and not eof:
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+            continue
+        if pos == len(buf):
+            if state != "start":
+                yield ValidationError("Некорректный JSON: массив не закрыт")
+            return
+
+        char = buf[pos]
+        if state == "start":
+            if char != "[":
+                yield ValidationError("Некорректный JSON: ожидался массив")
+                return
+            pos, state = pos + 1, "first"
+            continue
+        if char == "]" and state != "value":
+            return
+        if state == "next":
+            if char != ",":
+                yield ValidationError("Некорректный JSON: ожидалась запятая")
+                return
+            pos, state = pos + 1, "value"
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # элемент обрезан концом куска - дочитываем и разбираем заново
+            truncated = e.pos >= len(buf) - 8 or e.msg.startswith("Unterminated string")
+            if eof or not truncated:
+                yield ValidationError(f"Некорректный JSON: {e.msg}")
+                return
+            end = None
+        if end is None or (end == len(buf) and not eof):
+            # число в конце куска тоже может продолжаться в следующем
+            chunk = f.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            continue
+        yield json_record(value)
+        pos, state = end, "next"
+
+
+def read_records(path):
+    # потоковое чтение CSV, JSONL или JSON-массива, файл целиком в память не загружается.
+    # Строка, которую не удалось разобрать, приходит как ValidationError и
+    # считается пропущенной, как запись с некорректными полями
+    if path.lower().endswith((".jsonl", ".json")):
+        with open(path, encoding="utf-8-sig") as f:
+            first = f.read(1)
+            while first.isspace():
+                first = f.read(1)
+            f.seek(0)
+            if first == "[":
+                yield from read_json_array(f)
+                return
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json_record(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        yield ValidationError(f"Некорректный JSON: {e.msg}")
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            yield from csv.DictReader(f)
+
+
+def load_names(engine):
+    # (название -> id, множество id) для месторождений и типов происшествий
+    deposits = database.load_mestorozdenie(engine)
+    emergencyTypes = database.load_emergency_type(engine)
+    return (
+        ({r.name: r.id for r in deposits.values()}, set(deposits)),
+        ({r.name: r.id for r in emergencyTypes.values()}, set(emergencyTypes)),
+    )
+
+
+def resolve(record, names, ids, id_field, name_field, title):
+    # ссылку можно задать числовым id или названием из справочника
+    value = record.get(id_field)
+    if value not in (None, ""):
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValidationError(f"Некорректный id ({title}): {value!r}")
+        if value not in ids:
+            raise ValidationError(f"Нет в справочнике ({title}): {value}")
+        return value
+
+    name = (record.get(name_field) or "").strip()
+    if name not in names:
+        raise ValidationError(f"Нет в справочнике ({title}): {name!r}")
+    return names[name]
+
+
+def to_params(record, deposits, emergencyTypes):
+    names, ids = deposits
+    deposit_id = resolve(record, names, ids, "mestorozdenie_id", "deposit", "месторождение")
+    names, ids = emergencyTypes
+    type_id = resolve(record, names, ids, "emergency_type_id", "emergency_type", "тип происшествия")
+
+    # дата необязательна; если она есть, год можно не указывать
+    occurred_at = parse_occurred_at(record.get("occurred_at"))
+    if occurred_at is not None and record.get("year") in (None, ""):
+        year = int(occurred_at[:4])
+    else:
+        year = parse_year(record.get("year"))
+    if occurred_at is not None and int(occurred_at[:4]) != year:
+        raise ValidationError(f"Год {year} не совпадает с датой {occurred_at}")
+
+    return {
+        "did": deposit_id,
+        "tid": type_id,
+        "y": year,
+        "i": parse_injured(record.get("injured_amount")),
+        "c": record.get("comment") or "",
+        "o": occurred_at,
+    }
+
+
+def import_records(engine, records, batch_size=BATCH_SIZE):
+    # записи проверяются и вставляются пачками по batch_size строк,
+    # каждая пачка - одна транзакция с executemany
+    deposits, emergencyTypes = load_names(engine)
+
+    query = text("""
+    INSERT INTO emergency_occurrence(mestorozdenie_id, year, injured_amount, emergency_type_id, comment, occurred_at)
+    VALUES (:did, :y, :i, :tid, :c, :o)
+    """)
+
+    imported = 0
+    skipped = 0
+    errors = []
+    started = time.perf_counter()
+
+    records = enumerate(records, 1)
+    while True:
+        chunk = list(itertools.islice(records, batch_size))
+        if not chunk:
+            break
+
+        batch = []
+        for number, record in chunk:
+            try:
+                if isinstance(record, ValidationError):
+                    raise record
+                batch.append(to_params(record, deposits, emergencyTypes))
+            except ValidationError as e:
+                skipped += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append(f"строка {number}: {e}")
+
+        if batch:
+            with database.session(engine) as s:
+                s.execute(query, batch)
+                s.commit()
+            imported += len(batch)
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        "imported": imported,
+        "skipped": skipped,
+        "errors": errors,
+        "seconds": elapsed,
+        "rows_per_second": imported / elapsed if elapsed else 0.0,
+    }
+
+
+def import_file(engine, path, batch_size=BATCH_SIZE):
+    return import_records(engine, read_records(path), batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Импорт происшествий из CSV, JSONL или JSON")
+    parser.add_argument("path", help="файл .csv, .jsonl или .json (массив объектов)")
+    parser.add_argument("--database", default="database.db")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+
+    result = import_file(engine, args.path, args.batch_size)
+    for error in result["errors"]:
+        print(error)
+    print(
+        f"Импортировано: {result['imported']}, пропущено: {result['skipped']}, "
+        f"{result['seconds']:.1f} с, {result['rows_per_second']:.0f} строк/с"
+    )
@@ -1,27 +1,297 @@
-import collections
+import time
+
+# момент запуска: от него считается время до первой отрисовки окна
+STARTED = time.perf_counter()
+
+import bisect
+import heapq
+import html
 from statistics import mean
 import sys
-from PySide2.QtWidgets import QApplication, QMainWindow,QDialog, QMessageBox
-from PySide2 import QtCore, QtWidgets
+from PySide2.QtWidgets import QApplication, QMainWindow,QDialog, QMessageBox, QFileDialog
+from PySide2 import QtCore, QtGui, QtWidgets
 from mainwindow import Ui_MainWindow
 from edit_dialog import Ui_Dialog
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import Session
-from PySide2.QtCharts import QtCharts
+import analytics
+import perf
+import reference_cache
+import validation
+from map_panel import MapDock
+from perf_panel import PerfDock
+from pivot_panel import PivotDock
+from queries import DEFAULT_ORDER, HIGHLIGHT_CLOSE, HIGHLIGHT_OPEN, ColumnFilter
+from analytics import Cube
+from charts import BarChart, LineChart, PieChart
+from workers import DataLoader
+from refresh import RefreshScheduler
+from store import OccurrenceStore
+
+# модули работы с базой тянут SQLAlchemy (~0.3 с на импорт) и загружаются
+# при первом обращении - уже после того, как окно показано (MainWindow.start)
+database = perf.lazy_import("database")
+exporter = perf.lazy_import("exporter")
+importer = perf.lazy_import("importer")
 # from PySide2.QtCharts import QtCharts
 # raphicsView
 
+# сколько последних записей можно отменить
+UNDO_LIMIT = 50
+
+# роль с текстом комментария, в котором отмечены совпадения поиска
+HighlightRole = QtCore.Qt.ItemDataRole.UserRole + 1
+
+
+def date_text(occurred_at):
+    # 'YYYY-MM-DD HH:MM' (или только дата) -> 'DD.MM.YYYY HH:MM'
+    text = f"{occurred_at[8:10]}.{occurred_at[5:7]}.{occurred_at[:4]}"
+    return f"{text} {occurred_at[11:16]}" if len(occurred_at) > 10 else text
+
+
+def highlight_html(marked):
+    return html.escape(marked).replace(HIGHLIGHT_OPEN, "<b>").replace(HIGHLIGHT_CLOSE, "</b>")
+
+
+class HighlightDelegate(QtWidgets.QStyledItemDelegate):
+    # рисует комментарий с выделенными жирным совпадениями поиска
+    def paint(self, painter, option, index):
+        marked = index.data(HighlightRole)
+        if not marked:
+            super().paint(painter, option, index)
+            return
+
+        options = QtWidgets.QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        options.text = ""
+        style = options.widget.style() if options.widget else QApplication.style()
+        style.drawControl(QtWidgets.QStyle.CE_ItemViewItem, options, painter, options.widget)
+
+        document = QtGui.QTextDocument()
+        document.setDocumentMargin(0)
+        document.setDefaultFont(options.font)
+        document.setHtml(highlight_html(marked))
+
+        rect = style.subElementRect(QtWidgets.QStyle.SE_ItemViewItemText, options, options.widget)
+        painter.save()
+        painter.translate(rect.left(), rect.top() + (rect.height() - document.size().height()) / 2)
+        painter.setClipRect(QtCore.QRectF(0, 0, rect.width(), rect.height()))
+        document.drawContents(painter)
+        painter.restore()
+
+
+class Descending:
+    # обертка для ключа bisect по списку, отсортированному по убыванию
+    __slots__ = ("value",)
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
 class ItemsModel(QtCore.QAbstractTableModel):
-    def __init__(self, *args, **kwargs) -> None:
+    # сколько строк подгружать за один раз при прокрутке
+    PAGE_SIZE = 200
+
+    # колонки, по которым сортирует база (queries.SORT_KEYS), и значение ключа
+    # для строки - то же, что выражение ORDER BY; месторождение и тип
+    # сортировать нечем, они выбираются фильтрами
+    SORT_COLUMNS = {1: "year", 2: "injured_amount", 4: "comment"}
+    SORT_VALUES = {
+        "year": lambda row: (row.year, row.occurred_at or ""),
+        "injured_amount": lambda row: (row.injured_amount or 0,),
+        "comment": lambda row: (row.comment or "",),
+    }
+
+    # страница загружена (в том числе пустая)
+    pageLoaded = QtCore.Signal()
+    # страница не загрузилась (исключение)
+    pageFailed = QtCore.Signal(object)
+
+    def __init__(self, engine, loader, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.items = []
+        self.engine = engine
+        self.loader = loader
+        # загруженные строки хранятся по колонкам, см. store.OccurrenceStore
+        self.items = OccurrenceStore()
+        self.deposit_id = 0
+        self.emergency_type_id = 0
+        # месторождения выбранной на карте области, None - все
+        self.deposit_ids = None
+        # queries.ColumnFilter или None
+        self.column_filter = None
+        # (ключ сортировки, по убыванию); None - порядок по умолчанию
+        # (по году для таблицы, по релевантности для поиска)
+        self.order = None
+        # текст полнотекстового поиска по комментариям, "" - без поиска
+        self.search = ""
+        # id строки -> комментарий с метками совпадений
+        self.highlights = {}
+        self.has_more = False
+        # страница уже запрошена в фоне, ждем ответа
+        self.fetching = False
         # self.regions = {}
 
-    def setItems(self, items):
+    @perf.instrument("model.reset")
+    def setFilter(self, deposit_id, emergency_type_id, search="", deposit_ids=None, column_filter=None, order=None):
         self.beginResetModel()
-        self.items = items
+        self.deposit_id = deposit_id
+        self.emergency_type_id = emergency_type_id
+        self.deposit_ids = deposit_ids
+        self.column_filter = column_filter
+        self.order = order
+        self.search = search
+        self.items = OccurrenceStore()
+        self.highlights = {}
+        self.has_more = True
+        self.fetching = False
         self.endResetModel()
-    
+
+        # первую страницу грузим сразу, остальные - по мере прокрутки;
+        # страница для прежнего фильтра, если она еще грузится, будет отброшена
+        self.fetchMore(QtCore.QModelIndex())
+
+    def canFetchMore(self, parent: QtCore.QModelIndex) -> bool:
+        if parent.isValid():
+            return False
+        return self.has_more and not self.fetching
+
+    def fetchMore(self, parent: QtCore.QModelIndex):
+        if parent.isValid() or not self.has_more or self.fetching:
+            return
+
+        self.fetching = True
+
+        if self.search:
+            # результаты поиска идут по релевантности, поэтому страницы - по смещению
+            self.loader.submit(
+                database.search_occurrence_page, self.engine, self.search,
+                self.deposit_id, self.emergency_type_id, len(self.items), self.PAGE_SIZE,
+                deposit_ids=self.deposit_ids, columns=self.column_filter, order=self.order,
+                channel="items", on_done=self.appendPage, on_error=self.on_page_error,
+            )
+            return
+
+        after = None
+        if self.items:
+            last = self.items[-1]
+            key, _ = self.order or DEFAULT_ORDER
+            after = (self.SORT_VALUES[key](last), last.id)
+
+        self.loader.submit(
+            database.load_occurrence_page, self.engine,
+            self.deposit_id, self.emergency_type_id, after, self.PAGE_SIZE,
+            deposit_ids=self.deposit_ids, columns=self.column_filter, order=self.order,
+            channel="items", on_done=self.appendPage, on_error=self.on_page_error,
+        )
+
+    def on_page_error(self, error):
+        # следующая прокрутка запросит страницу снова
+        self.fetching = False
+        self.pageFailed.emit(error)
+
+    def appendPage(self, rows):
+        self.fetching = False
+        self.has_more = len(rows) == self.PAGE_SIZE
+        if not rows:
+            self.pageLoaded.emit()
+            return
+
+        with perf.timed("model.materialize"):
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items) + len(rows) - 1)
+            self.items.extend(rows)
+            if self.search:
+                self.highlights.update((r.id, r.highlight) for r in rows)
+            self.endInsertRows()
+        self.pageLoaded.emit()
+
+    def rowKey(self, row):
+        # строки отсортированы по (ключ сортировки, id)
+        key, descending = self.order or DEFAULT_ORDER
+        value = (self.SORT_VALUES[key](row), row.id)
+        return Descending(value) if descending else value
+
+    def matches(self, row):
+        if self.deposit_id and row.mestorozdenie_id != self.deposit_id:
+            return False
+        if self.deposit_ids is not None and row.mestorozdenie_id not in self.deposit_ids:
+            return False
+        columns = self.column_filter
+        if columns is not None:
+            injured = row.injured_amount or 0
+            if columns.year_from is not None and row.year < columns.year_from:
+                return False
+            if columns.year_to is not None and row.year > columns.year_to:
+                return False
+            if columns.injured_from is not None and injured < columns.injured_from:
+                return False
+            if columns.injured_to is not None and injured > columns.injured_to:
+                return False
+        if self.emergency_type_id and row.emergency_type_id != self.emergency_type_id:
+            return False
+        return True
+
+    def findRow(self, row):
+        pos = bisect.bisect_left(self.items, self.rowKey(row), key=self.rowKey)
+        if pos < len(self.items) and self.items[pos].id == row.id:
+            return pos
+        return -1
+
+    def applyChanges(self, pairs):
+        # пакет изменений (пары как в applyChange) одним сбросом модели,
+        # а не сигналом на каждую строку
+        if len(pairs) == 1:
+            self.applyChange(*pairs[0])
+            return
+        if self.search:
+            self.setFilter(self.deposit_id, self.emergency_type_id, self.search, self.deposit_ids, self.column_filter, self.order)
+            return
+
+        removed = {self.findRow(old) for old, _ in pairs if old is not None}
+        kept = [self.items[i] for i in range(len(self.items)) if i not in removed]
+        added = sorted((new for _, new in pairs if new is not None and self.matches(new)), key=self.rowKey)
+        if self.has_more:
+            # строки за пределами загруженной части придут со следующими страницами
+            last = self.rowKey(kept[-1]) if kept else None
+            added = [row for row in added if last is not None and self.rowKey(row) < last]
+
+        self.beginResetModel()
+        self.items = OccurrenceStore(heapq.merge(kept, added, key=self.rowKey))
+        self.endResetModel()
+
+    def applyChange(self, old, new):
+        # точечное обновление после записи: old - строка до изменения
+        # (None при добавлении), new - после (None при удалении)
+        if self.search:
+            # место строки в результатах поиска определяет ранжирование FTS5,
+            # поэтому поиск просто выполняется заново
+            self.setFilter(self.deposit_id, self.emergency_type_id, self.search, self.deposit_ids, self.column_filter, self.order)
+            return
+
+        pos = self.findRow(old) if old is not None else -1
+
+        if pos >= 0 and new is not None and self.matches(new) and self.rowKey(old) == self.rowKey(new):
+            self.items[pos] = new
+            self.dataChanged.emit(self.index(pos, 0), self.index(pos, self.columnCount() - 1))
+            return
+
+        if pos >= 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), pos, pos)
+            del self.items[pos]
+            self.endRemoveRows()
+
+        if new is not None and self.matches(new):
+            pos = bisect.bisect_left(self.items, self.rowKey(new), key=self.rowKey)
+            # строка за пределами загруженной части придет со следующей страницей
+            if pos == len(self.items) and self.has_more:
+                return
+            self.beginInsertRows(QtCore.QModelIndex(), pos, pos)
+            self.items.insert(pos, new)
+            self.endInsertRows()
+
     def setEmergencyType(self, emergencyTypes):
         self.beginResetModel()
         self.emergencyTypes = emergencyTypes
@@ -32,10 +302,14 @@ class ItemsModel(QtCore.QAbstractTableModel):
         self.deposits = deposits
         self.endResetModel()
 
-    def rowCount(self, *args, **kwargs) -> int:
+    def rowCount(self, parent=QtCore.QModelIndex(), *args, **kwargs) -> int:
+        if parent.isValid():
+            return 0
         return len(self.items)
     
-    def columnCount(self, *args, **kwargs) -> int:
+    def columnCount(self, parent=QtCore.QModelIndex(), *args, **kwargs) -> int:
+        if parent.isValid():
+            return 0
         return 5
     
     def data(self, index: QtCore.QModelIndex, role: QtCore.Qt.ItemDataRole):
@@ -43,27 +317,33 @@ class ItemsModel(QtCore.QAbstractTableModel):
             return
         
         if role == QtCore.Qt.ItemDataRole.DisplayRole:
-            emergency_occurrence_info = self.items[index.row()]
+            # значения берем прямо из колонок, без сборки строки целиком
+            row = index.row()
+            columns = self.items.columns
             col = index.column()
             if col == 0:
-                return self.deposits[emergency_occurrence_info.mestorozdenie_id].name
+                return self.deposits[columns["mestorozdenie_id"][row]].name
             elif col == 1:
-                return f'{emergency_occurrence_info.year}'
+                # у старых записей известен только год
+                occurred_at = self.items.dates[row]
+                return date_text(occurred_at) if occurred_at else columns["year"][row]
             elif col == 2:
-                return f'{emergency_occurrence_info.injured_amount}'
+                return columns["injured_amount"][row]
             elif col == 3:
-                return self.emergencyTypes[emergency_occurrence_info.emergency_type_id].name
+                return self.emergencyTypes[columns["emergency_type_id"][row]].name
             elif col == 4:
-                return f'{emergency_occurrence_info.comment}'
+                return self.items.comments[row]
         elif role == QtCore.Qt.ItemDataRole.UserRole:
             return self.items[index.row()]
+        elif role == HighlightRole and index.column() == 4 and self.highlights:
+            return self.highlights.get(self.items.columns["id"][index.row()])
 
     def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: QtCore.Qt.ItemDataRole):
         if role == QtCore.Qt.ItemDataRole.DisplayRole:
             if orientation == QtCore.Qt.Orientation.Horizontal:
                 return {
                     0: "Месторождение",
-                    1: "Год происшествия",
+                    1: "Дата происшествия",
                     2: "Сумма ущерба",
                     3: "Тип происшествия",
                     4: "Комментарий",
@@ -78,20 +358,62 @@ class EditDialog(QDialog):
         self.ui.btnAdd.clicked.connect(self.accept)
         self.ui.btnCancel.clicked.connect(self.reject)
 
-        print(deposits)
         for d in deposits.values():
             self.ui.cmbDeposit.addItem(d.name, d)
         
-        print(emergencyTypes)
         for t in emergencyTypes.values():
             self.ui.cmbType.addItem(t.name, t)
 
+        # дата и время рядом с годом; без них у происшествия известен только год,
+        # с ними год берется из даты
+        self.chkDate = QtWidgets.QCheckBox("Дата и время", self)
+        self.dtOccurred = QtWidgets.QDateTimeEdit(QtCore.QDateTime.currentDateTime(), self)
+        self.dtOccurred.setCalendarPopup(True)
+        self.dtOccurred.setDisplayFormat("dd.MM.yyyy HH:mm")
+        self.dtOccurred.setDateRange(
+            QtCore.QDate(validation.MIN_YEAR, 1, 1), QtCore.QDate(QtCore.QDate.currentDate().year(), 12, 31),
+        )
+        self.dtOccurred.setEnabled(False)
+        self.chkDate.toggled.connect(self.on_date_toggled)
+        self.dtOccurred.dateTimeChanged.connect(self.on_date_changed)
+
+        row = QtWidgets.QHBoxLayout()
+        self.ui.gridLayout.removeWidget(self.ui.txtYear)
+        row.addWidget(self.ui.txtYear)
+        row.addWidget(self.chkDate)
+        row.addWidget(self.dtOccurred)
+        self.ui.gridLayout.addLayout(row, 5, 0, 1, 1)
+
+    def on_date_toggled(self, checked):
+        self.dtOccurred.setEnabled(checked)
+        self.ui.txtYear.setEnabled(not checked)
+        if checked:
+            self.on_date_changed(self.dtOccurred.dateTime())
+
+    def on_date_changed(self, value):
+        self.ui.txtYear.setText(str(value.date().year()))
+
+    def occurred_at(self):
+        if not self.chkDate.isChecked():
+            return None
+        return self.dtOccurred.dateTime().toString("yyyy-MM-dd HH:mm")
+
+    def accept(self):
+        # ввод проверяется до записи в базу; с ошибкой диалог не закрывается
+        try:
+            self.get_data()
+        except validation.ValidationError as e:
+            QMessageBox.warning(self, "Проверка данных", str(e))
+            return
+        super().accept()
+
     def get_data(self):
         return {
             "deposit_id": self.ui.cmbDeposit.currentData().id,
             "type_id": self.ui.cmbType.currentData().id,
-            "year": self.ui.txtYear.text(),
-            "injured": self.ui.txtInjured.text(),
+            "year": validation.parse_year(self.ui.txtYear.text()),
+            "occurred_at": self.occurred_at(),
+            "injured": validation.parse_injured(self.ui.txtInjured.text()),
             "comment": self.ui.txtComment.text(),        
         }
 
@@ -101,9 +423,7 @@ class UpdateDialog(EditDialog):
 
         self.ui.btnAdd.setText('Изменить')
         self.ui.cmbDeposit.setEnabled(False)
-        print(init_data)
         mestorozdenie_name = deposits[init_data.mestorozdenie_id].name
-        print(mestorozdenie_name)
         self.ui.cmbDeposit.setCurrentText(mestorozdenie_name)
 
         type_name = emergencyTypes[init_data.emergency_type_id].name
@@ -112,191 +432,297 @@ class UpdateDialog(EditDialog):
         self.ui.txtComment.setText(str(init_data.comment))
         self.ui.txtYear.setText(str(init_data.year))
         self.ui.txtInjured.setText(str(init_data.injured_amount))
+        if init_data.occurred_at:
+            self.dtOccurred.setDateTime(QtCore.QDateTime.fromString(init_data.occurred_at[:16], "yyyy-MM-dd HH:mm"))
+            self.chkDate.setChecked(True)
+
+class BulkEditDialog(QDialog):
+    # одно изменение для всех выделенных записей: отмеченные поля
+    # записываются во все строки, остальные остаются как были
+    def __init__(self, emergencyTypes, count, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.setWindowTitle(f"Изменить записи: {count}")
+        layout = QtWidgets.QFormLayout(self)
+
+        self.chkType = QtWidgets.QCheckBox("Тип происшествия", self)
+        self.cmbType = QtWidgets.QComboBox(self)
+        for t in emergencyTypes.values():
+            self.cmbType.addItem(t.name, t)
+
+        self.chkYear = QtWidgets.QCheckBox("Год происшествия", self)
+        self.txtYear = QtWidgets.QLineEdit(self)
+        self.chkInjured = QtWidgets.QCheckBox("Сумма ущерба", self)
+        self.txtInjured = QtWidgets.QLineEdit(self)
+
+        for check, edit in ((self.chkType, self.cmbType), (self.chkYear, self.txtYear), (self.chkInjured, self.txtInjured)):
+            edit.setEnabled(False)
+            check.toggled.connect(edit.setEnabled)
+            layout.addRow(check, edit)
+
+        buttons = QtWidgets.QDialogButtonBox(self)
+        buttons.addButton("Изменить", QtWidgets.QDialogButtonBox.AcceptRole)
+        buttons.addButton("Отмена", QtWidgets.QDialogButtonBox.RejectRole)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def accept(self):
+        try:
+            self.get_data()
+        except validation.ValidationError as e:
+            QMessageBox.warning(self, "Проверка данных", str(e))
+            return
+        super().accept()
+
+    def get_data(self):
+        # только отмеченные поля, см. database.BULK_SET
+        changes = {}
+        if self.chkType.isChecked():
+            changes["type_id"] = self.cmbType.currentData().id
+        if self.chkYear.isChecked():
+            changes["year"] = validation.parse_year(self.txtYear.text())
+        if self.chkInjured.isChecked():
+            changes["injured"] = validation.parse_injured(self.txtInjured.text())
+        if not changes:
+            raise validation.ValidationError("Отметьте хотя бы одно поле")
+        return changes
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, engine=None):
         super(MainWindow, self).__init__()
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
         self.setWindowTitle("Учет происшествий")
 
-        self.engine = create_engine("sqlite+pysqlite:///database.db", echo=True)
-
-        self.model = ItemsModel()
+        # запуск по этапам: сначала окно с пустой таблицей, а соединение с базой,
+        # справочники и данные - в start() после первой отрисовки
+        self.engine = engine
+        self.first_paint_at = None
+        self.first_page_at = None
+
+        # все обращения к базе идут в фоновых потоках, чтобы окно не зависало
+        self.loader = DataLoader(parent=self)
+        self.deposits = None
+        self.emergencyTypes = None
+        self.rollup = None
+        # сводка по месяцам для графиков по кварталам и месяцам
+        # (analytics.PeriodRollup), загружается при первом переключении шага
+        self.periodRollup = None
+        # шаг времени графиков, ключ analytics.GRANULARITIES
+        self.granularity = "year"
+        self.data_by_deposits = None
+        # analytics.Trends для тех же рядов, None - тренды выключены
+        self.trends = None
+        # месторождения области, выбранной на карте (None - без ограничения)
+        self.region = None
+
+        # графики создаются при первой отрисовке (когда пришли данные)
+        # и дальше только обновляются
+        self.lineChart = None
+        self.pieChart = None
+        self.barChart = None
+
+        # изменения фильтров и данных собираются в один отложенный проход
+        self.refresh = RefreshScheduler(prepare=self.prepare_charts, parent=self)
+        self.refresh.register("items", self.items_inputs, self.draw_items)
+        self.refresh.register("line", self.chart_inputs, self.draw_line_chart)
+        self.refresh.register("pie", self.pie_inputs, self.draw_pie_chart)
+        self.refresh.register("bar", self.chart_inputs, self.draw_bar_chart)
+        self.refresh.register("map", self.map_inputs, self.draw_map)
+        self.refresh.register("pivot", self.pivot_inputs, self.draw_pivot)
+
+        self.model = ItemsModel(self.engine, self.loader)
         self.ui.tblItems.setModel(self.model)
 
         # чтобы авторесайзить
         self.ui.tblItems.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
-
-        self.load_emergency_type()
-        self.load_mestorozdenie()
-        
-        self.load_emergency_occurrence()
+        self.ui.tblItems.setItemDelegateForColumn(4, HighlightDelegate(self.ui.tblItems))
+        # выделение нескольких строк для пакетного изменения и удаления
+        self.ui.tblItems.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.ui.tblItems.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+
+        # поиск по комментариям между фильтрами месторождения и типа; запрос
+        # уходит после паузы в наборе (см. RefreshScheduler.DELAY) и выполняется
+        # в фоне, ответ на устаревший текст отбрасывается
+        self.txtSearch = QtWidgets.QLineEdit(self.ui.centralwidget)
+        self.txtSearch.setPlaceholderText("Поиск по комментариям")
+        self.txtSearch.setClearButtonEnabled(True)
+        self.ui.gridLayout.addWidget(self.txtSearch, 1, 1, 1, 1)
+
+        # фильтры колонок над таблицей: диапазоны года и суммы ущерба
+        # (фильтр комментария - это поле поиска)
+        self.columnFilters = {}
+        filters = QtWidgets.QHBoxLayout()
+        for name, text in (
+            ("year_from", "Год с"),
+            ("year_to", "Год по"),
+            ("injured_from", "Ущерб от"),
+            ("injured_to", "Ущерб до"),
+        ):
+            edit = QtWidgets.QLineEdit(self.ui.centralwidget)
+            edit.setPlaceholderText(text)
+            edit.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp(r"\d{0,18}"), edit))
+            edit.textChanged.connect(lambda: self.refresh.schedule("items"))
+            filters.addWidget(edit)
+            self.columnFilters[name] = edit
+        self.ui.gridLayout.removeWidget(self.ui.tblItems)
+        self.ui.gridLayout.addLayout(filters, 2, 0, 1, 3)
+        self.ui.gridLayout.addWidget(self.ui.tblItems, 3, 0, 1, 3)
+
+        # сортировка по щелчку на заголовке выполняется в базе, а не в модели
+        self.order = None
+        header = self.ui.tblItems.horizontalHeader()
+        header.setSectionsClickable(True)
+        header.setSortIndicatorShown(False)
+        header.sortIndicatorChanged.connect(self.on_sort_changed)
+
+        # время до первой страницы таблицы - второй замер запуска
+        self.model.pageLoaded.connect(self.on_first_page)
+        self.model.pageFailed.connect(self.on_page_failed)
 
         self.ui.cmbDeposit.currentIndexChanged.connect(self.load_emergency_occurrence)
         self.ui.cmbType.currentIndexChanged.connect(self.load_emergency_occurrence)
+        self.txtSearch.textChanged.connect(self.on_search_changed)
         self.ui.btnAdd.clicked.connect(self.on_btnAdd_click)
         self.ui.btnRemove.clicked.connect(self.on_btnRemove_click)
         self.ui.btnEdit.clicked.connect(self.on_btnEdit_click)
+
+        menu = self.ui.menubar.addMenu("Файл")
+        menu.addAction("Импорт происшествий...").triggered.connect(self.on_import_click)
+        menu.addAction("Экспорт таблицы...").triggered.connect(self.on_export_click)
+        menu.addAction("Экспорт данных графиков...").triggered.connect(self.on_export_rollup_click)
+
+        # отмена записей: [(название, database.Changes)], последняя - в конце
+        self.undoStack = []
+        edit_menu = self.ui.menubar.addMenu("Правка")
+        self.undoAction = edit_menu.addAction("Отменить")
+        self.undoAction.setShortcut(QtGui.QKeySequence.Undo)
+        self.undoAction.triggered.connect(self.on_undo_click)
+        self.updateUndoAction()
+
+        # панель замеров производительности, открывается из меню "Вид"
+        self.perfDock = PerfDock(self)
+        self.addDockWidget(QtCore.Qt.DockWidgetArea.BottomDockWidgetArea, self.perfDock)
+        self.perfDock.hide()
+        self.ui.statusbar.addPermanentWidget(self.perfDock.status_label)
+        view_menu = self.ui.menubar.addMenu("Вид")
+        view_menu.addAction(self.perfDock.toggleViewAction())
+
+        # карта месторождений; выбранная на ней область фильтрует таблицу и графики
+        self.mapDock = MapDock(self)
+        self.addDockWidget(QtCore.Qt.DockWidgetArea.RightDockWidgetArea, self.mapDock)
+        self.mapDock.hide()
+        self.mapDock.boxSelected.connect(self.on_map_box_selected)
+        self.mapDock.radiusSelected.connect(self.on_map_radius_selected)
+        self.mapDock.cleared.connect(lambda: self.setRegion(None))
+        self.mapDock.visibilityChanged.connect(lambda visible: visible and self.refresh.schedule("map"))
+        view_menu.addAction(self.mapDock.toggleViewAction())
+
+        # сводная таблица по любым двум измерениям из куба self.rollup
+        self.pivotDock = PivotDock(self)
+        self.addDockWidget(QtCore.Qt.DockWidgetArea.BottomDockWidgetArea, self.pivotDock)
+        self.pivotDock.hide()
+        self.pivotDock.changed.connect(lambda: self.refresh.schedule("pivot"))
+        self.pivotDock.visibilityChanged.connect(lambda visible: visible and self.refresh.schedule("pivot"))
+        view_menu.addAction(self.pivotDock.toggleViewAction())
+
+        # скользящее среднее и аномальные годы поверх графиков
+        self.trendsAction = view_menu.addAction("Тренды и аномалии")
+        self.trendsAction.setCheckable(True)
+        self.trendsAction.setChecked(analytics.numpy is not None)
+        self.trendsAction.setEnabled(analytics.numpy is not None)
+        self.trendsAction.toggled.connect(lambda: self.refresh.invalidate("line", "bar"))
+
+        # шаг времени линейного и столбчатого графиков; кварталы и месяцы
+        # считаются только по записям с датой
+        step_menu = view_menu.addMenu("Шаг графиков")
+        steps = QtWidgets.QActionGroup(self)
+        for granularity, text in (("year", "Год"), ("quarter", "Квартал"), ("month", "Месяц")):
+            action = step_menu.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(granularity == self.granularity)
+            action.triggered.connect(lambda checked, granularity=granularity: self.setGranularity(granularity))
+            steps.addAction(action)
+
+        # индикатор хода выгрузки в строке состояния
+        self.progress = QtWidgets.QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.hide()
+        self.ui.statusbar.addPermanentWidget(self.progress)
     
+    @perf.instrument("chart.bar")
     def draw_bar_chart(self):
-        self.data_by_deposits = {}
-        
-        years = set()
-        for row in self.rows:
-            items = self.data_by_deposits.setdefault(row.mestorozdenie_id, {})
-            items[row.year] = items.get(row.year, 0) + 1
-            years.add(row.year)
-
-        years = sorted(years)
-        print('YEARS:', years)
-
-        series = QtCharts.QHorizontalStackedBarSeries()
-        series.setLabelsPrecision(20)
-        series.setLabelsFormat("@value")
-
-        for mestorozdenie_id, mestorozdenie_info in self.data_by_deposits.items():
-            mestorozdenie = self.deposits[mestorozdenie_id]
-            bar_set = QtCharts.QBarSet(mestorozdenie.name)
-            for year in years:
-                value = mestorozdenie_info.get(year, 0)
-                bar_set.append(value) 
-            bar_set.setLabelColor("#000")
-            series.append(bar_set)
-
-        series.setLabelsVisible(True)
-        # series.setLabelsPosition(QtCharts.QAbstractBarSeries.LabelsPosition.LabelsCenter)
-
-        chart = QtCharts.QChart()
-        chart.addSeries(series)
-
-        chart.createDefaultAxes()
-        
-        axis = QtCharts.QBarCategoryAxis()
-        axis.append([str(i) for i in years])
-        series.attachAxis(axis)
-        chart.setAxisY(axis)
-
-        chart.axisX().setLabelFormat("%i")
-        chart.setAnimationOptions(QtCharts.QChart.AnimationOption.SeriesAnimations)
-
-        self.ui.graphicsView3.setChart(chart)
-
+        if self.barChart is None:
+            self.barChart = BarChart(self.ui.graphicsView3)
+        self.barChart.update(self.data_by_deposits, self.deposits, self.trends, self.granularity)
 
+    @perf.instrument("chart.pie")
     def draw_pie_chart(self):
-        series = QtCharts.QPieSeries()
-
-        for mestorozdenie_id, mestorozdenie_data in self.data_by_deposits.items():
-            mestorozdenie_name = self.deposits[mestorozdenie_id].name
-
-            count = len(mestorozdenie_data)
-            series.append(f"{mestorozdenie_name}", count)
-
-        series.setLabelsVisible()
-
-        chart = QtCharts.QChart()
-        chart.addSeries(series)
-        chart.createDefaultAxes()
-        chart.setAnimationOptions(QtCharts.QChart.AnimationOption.SeriesAnimations)
-
-        self.ui.graphicsView2.setChart(chart)
-
+        if self.pieChart is None:
+            self.pieChart = PieChart(self.ui.graphicsView2)
+        self.pieChart.update(self.data_by_deposits, self.deposits)
 
+    @perf.instrument("chart.line")
     def draw_line_chart(self):
-        self.data_by_deposits = {}
-
-        chart = QtCharts.QChart()
-
-        for row in self.rows:
-            items = self.data_by_deposits.setdefault(row.mestorozdenie_id, [])
-            items.append(row)
-
-        for mestorozdenie_id, mestorozdenie_data in self.data_by_deposits.items():
-
-            mestorozdenie_name = self.deposits[mestorozdenie_id].name
-
-            # создаем последовательность точек для вывода 
-            series = QtCharts.QLineSeries()
-            # даем ей название
-            series.setName(mestorozdenie_name)
-            # включаем отображение точек
-            series.setPointsVisible(True)
-
-            # создаем словарь для подсчета количества происшествий по годам
-            count_by_year = collections.Counter(row.year for row in mestorozdenie_data)
-
-            # добавляем точки на график
-            for year, count in count_by_year.items():
-                series.append(year, count)
-
-            # добавляем последовательность точек на график
-            chart.addSeries(series)
-
-        # активируем отображение осей
-        chart.createDefaultAxes()
-        chart.axisX().setTitleText("Год")
-        chart.axisX().setLabelFormat("%i")
-        chart.axisX().setMax(chart.axisX().max() + 1)
-        chart.axisX().setMin(chart.axisX().min() - 1)
-
-        chart.axisY().setLabelFormat("%i")
-        chart.axisY().setTitleText("Кол-во происшествий")
-        chart.axisY().setMax(chart.axisY().max() + 10)
-        chart.axisY().setMin(0)
-
-        # подключаем график к форме
-        self.ui.graphicsView.setChart(chart)
+        if self.lineChart is None:
+            self.lineChart = LineChart(self.ui.graphicsView)
+        self.lineChart.update(self.data_by_deposits, self.deposits, self.trends, self.granularity)
 
+    def selectedItems(self):
+        # выделенные строки таблицы по порядку; без выделения - текущая
+        rows = sorted(index.row() for index in self.ui.tblItems.selectionModel().selectedRows())
+        if not rows and self.ui.tblItems.currentIndex().isValid():
+            rows = [self.ui.tblItems.currentIndex().row()]
+        return [self.model.items[row] for row in rows]
 
     def on_btnEdit_click(self):
-        item = self.ui.tblItems.currentIndex()
-        init_data = item.data(QtCore.Qt.ItemDataRole.UserRole)
+        items = self.selectedItems()
+        if not items:
+            return
 
-        dialog = UpdateDialog(self.deposits, self.emergencyTypes, init_data)
-        r = dialog.exec()
-        if r == 0:
+        if len(items) == 1:
+            init_data = items[0]
+            dialog = UpdateDialog(self.deposits, self.emergencyTypes, init_data)
+            r = dialog.exec()
+            if r == 0:
+                return
+
+            data = dialog.get_data()
+            self.loader.submit(
+                database.update_occurrence, self.engine, init_data.id, data,
+                on_done=lambda result: self.on_data_changed(result, "изменение записи"),
+                on_error=lambda error: self.on_write_error("изменение записи", error),
+            )
             return
-        
-        data = dialog.get_data()
 
-        with Session(self.engine)  as s:
-            query = """
-            UPDATE emergency_occurrence
-            SET year = :y, injured_amount = :i, emergency_type_id = :tid, comment = :c
-            WHERE id = :id
-            """
-
-            s.execute(text(query), {
-                "tid": data['type_id'],
-                "y": data['year'],
-                "i": data['injured'],
-                "c": data['comment'],
-                "id": init_data.id,
-            })
-            s.commit()
+        dialog = BulkEditDialog(self.emergencyTypes, len(items))
+        if dialog.exec() == 0:
+            return
 
-        self.load_emergency_occurrence()
+        # все строки меняются одной транзакцией, таблица и графики обновляются один раз
+        title = f"изменение записей ({len(items)})"
+        self.loader.submit(
+            database.update_occurrences, self.engine, [item.id for item in items], dialog.get_data(),
+            on_done=lambda changes: self.on_changes_done(changes, title),
+            on_error=lambda error: self.on_write_error(title, error),
+        )
 
     def on_btnRemove_click(self):
-        item = self.ui.tblItems.currentIndex()
-        data = item.data(QtCore.Qt.ItemDataRole.UserRole)
+        items = self.selectedItems()
+        if not items:
+            return
 
-        r = QMessageBox.question(self, "Подтверждение", "Точно ли вы хотите удалить запись?")
+        question = "Точно ли вы хотите удалить запись?" if len(items) == 1 else f"Точно ли вы хотите удалить записи ({len(items)})?"
+        r = QMessageBox.question(self, "Подтверждение", question)
         if r == QMessageBox.StandardButton.No:
             return
 
-        with Session(self.engine) as s:
-            query = """
-            DELETE 
-            FROM emergency_occurrence 
-            WHERE id = :id
-            """
-
-            s.execute(text(query), {"id": data.id})
-            s.commit()
-
-        self.load_emergency_occurrence()
-        # self.load_years()
+        title = "удаление записи" if len(items) == 1 else f"удаление записей ({len(items)})"
+        self.loader.submit(
+            database.delete_occurrences, self.engine, [item.id for item in items],
+            on_done=lambda changes: self.on_changes_done(changes, title),
+            on_error=lambda error: self.on_write_error(title, error),
+        )
 
     def on_btnAdd_click(self):
         dialog = EditDialog(self.deposits, self.emergencyTypes)
@@ -305,27 +731,140 @@ class MainWindow(QMainWindow):
             return
 
         data = dialog.get_data()
-        with Session(self.engine) as s:
-            query = """
-            INSERT INTO emergency_occurrence(mestorozdenie_id, year, injured_amount, emergency_type_id, comment)
-            VALUES (:did, :y, :i, :tid, :c)
-            """
-
-            s.execute(text(query), {
-                "did": data['deposit_id'],
-                "tid": data['type_id'],
-                "y": data['year'],
-                "i": data['injured'],
-                "c": data['comment'],
-            })
-            s.commit()
-
-        # self.load_emergency_type()
-        # self.load_mestorozdenie()
-        self.load_emergency_occurrence()
-        
+        self.loader.submit(
+            database.insert_occurrence, self.engine, data,
+            on_done=lambda result: self.on_data_changed(result, "добавление записи"),
+            on_error=lambda error: self.on_write_error("добавление записи", error),
+        )
+
+    def on_write_error(self, title, error):
+        # запись не сохранена: строку могла удалить синхронизация или база
+        # занята дольше таймаута. Таблица перечитывается, чтобы показать
+        # текущее состояние базы
+        QMessageBox.critical(self, "Запись", f"Не удалось выполнить {title}:\n{error}")
+        self.refresh.invalidate("items")
+
+    def on_data_changed(self, result, title=None):
+        # результат записи одной строки - пара (старая строка, новая строка)
+        self.on_changes_done(database.Changes([result], {}), title)
+
+    def on_changes_done(self, changes, title=None):
+        # таблица и сводки обновляются по всем строкам пакета, а графики
+        # перерисовываются один раз; title - название для меню "Отменить"
+        self.model.applyChanges(changes.pairs)
+        for old, new in changes.pairs:
+            if self.rollup is not None:
+                self.rollup.apply(old, new)
+            if self.periodRollup is not None:
+                self.periodRollup.apply(old, new)
+        self.refresh.schedule("line", "pie", "bar", "map", "pivot")
+
+        if title is not None:
+            self.undoStack.append((title, changes))
+            del self.undoStack[:-UNDO_LIMIT]
+            self.updateUndoAction()
+
+    def updateUndoAction(self):
+        if self.undoStack:
+            self.undoAction.setText(f"Отменить: {self.undoStack[-1][0]}")
+        else:
+            self.undoAction.setText("Отменить")
+        self.undoAction.setEnabled(bool(self.undoStack))
 
-    def load_emergency_occurrence(self):
+    def on_undo_click(self):
+        if not self.undoStack:
+            return
+        title, changes = self.undoStack.pop()
+        self.updateUndoAction()
+        self.loader.submit(
+            database.restore_occurrences, self.engine, changes,
+            on_done=self.on_changes_done,
+            on_error=lambda error: self.on_undo_error(title, changes, error),
+        )
+
+    def on_undo_error(self, title, changes, error):
+        # отмена не удалась - ее можно повторить
+        self.undoStack.append((title, changes))
+        self.updateUndoAction()
+        QMessageBox.critical(self, "Отмена", f"Не удалось отменить {title}:\n{error}")
+
+    def on_import_click(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Импорт происшествий", "", "CSV, JSONL, JSON (*.csv *.jsonl *.json)")
+        if not path:
+            return
+
+        self.ui.statusbar.showMessage("Импорт происшествий...")
+        self.loader.submit(importer.import_file, self.engine, path, on_done=self.on_import_done, on_error=self.on_import_error)
+
+    def on_import_done(self, result):
+        self.ui.statusbar.clearMessage()
+
+        message = (
+            f"Импортировано: {result['imported']}, пропущено: {result['skipped']}\n"
+            f"{result['rows_per_second']:.0f} строк/с"
+        )
+        if result["errors"]:
+            message += "\n\n" + "\n".join(result["errors"][:10])
+        QMessageBox.information(self, "Импорт", message)
+        self.reload_imported()
+
+    def on_import_error(self, error):
+        self.ui.statusbar.clearMessage()
+        QMessageBox.critical(self, "Импорт", f"Не удалось импортировать файл:\n{error}")
+        # пачки до ошибки уже записаны
+        self.reload_imported()
+
+    def reload_imported(self):
+        # после массовой вставки проще перечитать сводку и таблицу целиком
+        self.load_rollup()
+        self.periodRollup = None
+        if self.granularity != "year":
+            self.load_period_rollup()
+        self.refresh.invalidate("items")
+
+    def on_export_click(self):
+        # в файл - строки таблицы: с поиском, фильтрами колонок, областью
+        # на карте и сортировкой
+        self.export(
+            exporter.export_occurrences, "Экспорт таблицы",
+            search=self.model.search,
+            deposit_ids=self.model.deposit_ids,
+            columns=self.model.column_filter,
+            order=self.model.order,
+        )
+
+    def on_export_rollup_click(self):
+        self.export(exporter.export_rollup, "Экспорт данных графиков")
+
+    def export(self, fn, title, **options):
+        path, _ = QFileDialog.getSaveFileName(self, title, "", "CSV (*.csv);;Excel (*.xlsx);;Parquet (*.parquet)")
+        if not path:
+            return
+
+        self.progress.setValue(0)
+        self.progress.show()
+        self.ui.statusbar.showMessage(f"{title}...")
+
+        deposit_id, emergencyType_id = self.current_filter()
+        self.loader.submit(
+            fn, self.engine, path, deposit_id, emergencyType_id, **options,
+            on_done=self.on_export_done, on_error=self.on_export_error, on_progress=self.on_export_progress,
+        )
+
+    def on_export_progress(self, done, total):
+        self.progress.setMaximum(max(total, 1))
+        self.progress.setValue(done)
+
+    def on_export_done(self, count):
+        self.progress.hide()
+        self.ui.statusbar.showMessage(f"Выгружено строк: {count}", 5000)
+
+    def on_export_error(self, error):
+        self.progress.hide()
+        self.ui.statusbar.clearMessage()
+        QMessageBox.critical(self, "Экспорт", f"Не удалось выгрузить данные:\n{error}")
+
+    def current_filter(self):
         deposits_data = self.ui.cmbDeposit.currentData()
         emergencyTypes_data = self.ui.cmbType.currentData()
 
@@ -340,67 +879,274 @@ class MainWindow(QMainWindow):
         else:
             emergencyType_id = 0
 
-        self.rows = []
+        return deposit_id, emergencyType_id
 
-        with Session(self.engine) as s:
-
-            query = """
-            SELECT *
-            FROM emergency_occurrence
-            WHERE (:mid = 0 OR mestorozdenie_id = :mid) AND (:tid = 0 OR emergency_type_id = :tid)
-            ORDER BY  year DESC
-            """
+    def load_emergency_occurrence(self):
+        self.refresh.schedule()
+
+    def on_search_changed(self):
+        # графики от поиска не зависят
+        self.refresh.schedule("items")
+
+    def current_search(self):
+        return self.txtSearch.text().strip()
+
+    def current_column_filter(self):
+        values = {name: int(edit.text()) if edit.text() else None for name, edit in self.columnFilters.items()}
+        column_filter = ColumnFilter(**values)
+        return None if column_filter == ColumnFilter() else column_filter
+
+    def on_sort_changed(self, section, order):
+        key = ItemsModel.SORT_COLUMNS.get(section)
+        header = self.ui.tblItems.horizontalHeader()
+        if key is None:
+            # по этой колонке не сортируем - возвращаем прежний индикатор
+            header.blockSignals(True)
+            if self.order is None:
+                header.setSortIndicatorShown(False)
+            else:
+                column = {v: k for k, v in ItemsModel.SORT_COLUMNS.items()}[self.order[0]]
+                header.setSortIndicator(column, QtCore.Qt.DescendingOrder if self.order[1] else QtCore.Qt.AscendingOrder)
+            header.blockSignals(False)
+            return
 
-            rows = s.execute(text(query), {"mid": deposit_id, "tid": emergencyType_id})
-            for r in rows:
-                print(r)
-                self.rows.append(r)
-        
-     
-        self.model.setItems(self.rows)
-        self.draw_line_chart()
-        self.draw_pie_chart()
-        self.draw_bar_chart()
+        header.setSortIndicatorShown(True)
+        self.order = (key, order == QtCore.Qt.DescendingOrder)
+        self.refresh.schedule("items")
 
-    def load_mestorozdenie(self):
-        self.deposits = {}
+    def items_inputs(self):
+        if self.deposits is None or self.emergencyTypes is None:
+            return None
+        return (*self.current_filter(), self.current_search(), self.region, self.current_column_filter(), self.order)
 
-        with Session(self.engine) as s:
+    def draw_items(self):
+        self.model.setFilter(*self.items_inputs())
 
-            query = """
-            SELECT *
-            FROM mestorozdenie
-            """
+    def prepare_charts(self):
+        # рисуем, только когда есть и справочники, и сводная таблица
+        if self.rollup is None or self.deposits is None:
+            self.data_by_deposits = None
+            return
 
-            rows = s.execute(text(query))
-            for r in rows:
-                self.deposits[r.id] = r
+        deposit_id, emergencyType_id = self.current_filter()
+
+        # графики строятся по сводной таблице, а не по строкам происшествий;
+        # по кварталам и месяцам - по сводке за месяцы
+        rollup, options = self.rollup, {}
+        if self.granularity != "year":
+            rollup, options = self.periodRollup, {"granularity": self.granularity}
+            if rollup is None:
+                self.data_by_deposits = None
+                return
+
+        self.data_by_deposits = rollup.count_by_deposits(deposit_id, emergencyType_id, self.region, **options)
+        self.trends = None
+        if self.trendsAction.isChecked():
+            self.trends = rollup.trends_by_deposits(deposit_id, emergencyType_id, self.region, **options)
+
+    def chart_inputs(self):
+        return self.data_by_deposits
+
+    def pie_inputs(self):
+        # круговой диаграмме нужны только итоги по месторождениям
+        if self.data_by_deposits is None:
+            return None
+        return analytics.pie_totals(self.data_by_deposits)
+
+    def map_inputs(self):
+        # скрытую карту не перерисовываем, она обновится при показе
+        if self.rollup is None or self.deposits is None or not self.mapDock.isVisible():
+            return None
+        _, emergencyType_id = self.current_filter()
+        return self.rollup.totals_by_deposit(emergencyType_id)
+
+    def draw_map(self):
+        _, emergencyType_id = self.current_filter()
+        self.mapDock.show_heat(self.deposits, self.rollup.totals_by_deposit(emergencyType_id))
+
+    def pivot_inputs(self):
+        if self.rollup is None or self.deposits is None or self.emergencyTypes is None:
+            return None
+        if not self.pivotDock.isVisible():
+            return None
+        # куб меняется на месте, поэтому сравниваем его версию
+        return self.pivotDock.layout_inputs(), self.current_filter(), self.rollup, self.rollup.version
+
+    def draw_pivot(self):
+        rows, columns, measure = self.pivotDock.layout_inputs()
+        deposit_id, emergencyType_id = self.current_filter()
+        pivot = self.rollup.pivot(rows, columns, measure, deposit=deposit_id, type=emergencyType_id)
+        self.pivotDock.show_pivot(pivot, self.pivot_label)
+
+    def pivot_label(self, dimension, value):
+        if dimension == "deposit":
+            return self.deposits[value].name if value in self.deposits else f"#{value}"
+        if dimension == "type":
+            return self.emergencyTypes[value].name if value in self.emergencyTypes else f"#{value}"
+        return str(value)
+
+    def on_map_box_selected(self, min_coord1, max_coord1, min_coord2, max_coord2):
+        self.loader.submit(
+            database.deposits_in_box, self.engine, min_coord1, max_coord1, min_coord2, max_coord2,
+            channel="region", on_done=self.setRegion,
+        )
+
+    def on_map_radius_selected(self, coord1, coord2, km):
+        self.loader.submit(
+            database.deposits_in_radius, self.engine, coord1, coord2, km,
+            channel="region", on_done=self.setRegion,
+        )
+
+    def setRegion(self, deposit_ids):
+        self.loader.cancel("region")
+        self.region = deposit_ids
+        self.mapDock.set_selection(deposit_ids)
+        self.refresh.schedule("items", "line", "pie", "bar")
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_at is None:
+            self.first_paint_at = time.perf_counter()
+            perf.timings.record("startup.first_paint", STARTED, self.first_paint_at - STARTED)
+            # база подключается, когда окно уже нарисовано
+            QtCore.QTimer.singleShot(0, self.start)
+
+    def start(self):
+        self.engine = self.engine or database.create_database_engine()
+        self.model.engine = self.engine
+
+        # первый запуск на большой базе обновляет ее минутами (полнотекстовый
+        # индекс, индексы, ключи синхронизации), поэтому миграции идут в фоне,
+        # а окно до их окончания недоступно
+        self.centralWidget().setEnabled(False)
+        self.ui.menubar.setEnabled(False)
+        self.ui.statusbar.showMessage("Обновление базы данных...")
+        self.progress.setRange(0, 0)
+        self.progress.show()
+        self.loader.submit(database.migrate, self.engine, on_done=self.on_migrated, on_error=self.on_migrate_error)
+
+    def on_migrated(self, _):
+        self.progress.hide()
+        self.ui.statusbar.clearMessage()
+        self.centralWidget().setEnabled(True)
+        self.ui.menubar.setEnabled(True)
+
+        # таблица происшествий загрузится, когда придут оба справочника;
+        # из кэша они берутся сразу, база лишь подтверждает их версию
+        self.reference_cache = reference_cache.cache_path(self.engine.url.database)
+        cached = reference_cache.load(self.reference_cache) if self.reference_cache else None
+        if cached is not None:
+            self.reference_key, deposits, emergencyTypes = cached
+            self.setMestorozdenie(deposits)
+            self.setEmergencyType(emergencyTypes)
+        else:
+            self.reference_key = None
+        self.load_references()
+
+    def on_migrate_error(self, error):
+        self.progress.hide()
+        self.ui.statusbar.clearMessage()
+        QMessageBox.critical(self, "База данных", f"Не удалось обновить базу данных:\n{error}")
+
+    def on_page_failed(self, error):
+        self.ui.statusbar.showMessage(f"Не удалось загрузить записи: {error}", 10000)
+
+    def on_first_page(self):
+        self.model.pageLoaded.disconnect(self.on_first_page)
+        self.first_page_at = time.perf_counter()
+        perf.timings.record("startup.first_page", STARTED, self.first_page_at - STARTED)
+        if self.first_paint_at is not None:
+            self.ui.statusbar.showMessage(
+                f"Запуск: окно {(self.first_paint_at - STARTED) * 1000:.0f} мс, "
+                f"данные {(self.first_page_at - STARTED) * 1000:.0f} мс",
+                10000,
+            )
+
+        # загрузка куба и проверка планов запросов в фоне отнимали бы
+        # у первой страницы процессор, поэтому они начинаются после нее
+        self.load_rollup()
+        # проверка планов - только предупреждения в журнал, ее можно не ждать
+        self.loader.submit(database.check_query_plans, self.engine)
+
+    def load_references(self):
+        self.loader.submit(
+            database.load_references, self.engine, self.reference_key,
+            channel="references", on_done=self.setReferences,
+        )
+
+    def setReferences(self, result):
+        # None - кэш на диске совпал с базой
+        if result is None:
+            return
+        self.reference_key, deposits, emergencyTypes = result
+        self.setMestorozdenie(deposits)
+        self.setEmergencyType(emergencyTypes)
+        # в подписях графиков могли поменяться названия
+        self.refresh.invalidate("line", "pie", "bar", "map", "pivot")
+        if self.reference_cache:
+            reference_cache.save(self.reference_cache, self.reference_key, deposits, emergencyTypes)
+
+    def load_rollup(self):
+        self.loader.submit(Cube.load, self.engine, channel="rollup", on_done=self.setRollup)
+
+    def setRollup(self, rollup):
+        self.rollup = rollup
+        self.refresh.schedule("line", "pie", "bar", "map", "pivot")
+
+    def load_period_rollup(self):
+        self.loader.submit(analytics.PeriodRollup.load, self.engine, channel="period_rollup", on_done=self.setPeriodRollup)
+
+    def setPeriodRollup(self, rollup):
+        self.periodRollup = rollup
+        self.refresh.schedule("line", "pie", "bar")
+
+    def setGranularity(self, granularity):
+        self.granularity = granularity
+        if granularity != "year" and self.periodRollup is None and self.engine is not None:
+            self.load_period_rollup()
+        # те же данные при другом шаге рисуются по-другому
+        self.refresh.invalidate("line", "pie", "bar")
+
+    def fillCombo(self, combo, title, rows):
+        # справочник может прийти второй раз (из кэша, потом из базы) -
+        # список заполняется заново, выбранное значение сохраняется по id
+        current = combo.currentData()
+        combo.blockSignals(True)
+        combo.clear()
+        combo.addItem(title)
+        for r in rows.values():
+                combo.addItem(r.name, r)
+        if current is not None and current.id in rows:
+            combo.setCurrentIndex(list(rows).index(current.id) + 1)
+        combo.blockSignals(False)
+
+    def setMestorozdenie(self, deposits):
+        self.deposits = deposits
 
-        self.ui.cmbDeposit.addItem("Все месторождения")
-        for r in self.deposits.values():
-                self.ui.cmbDeposit.addItem(r.name, r)
         self.model.setDeposit(self.deposits)
+        self.fillCombo(self.ui.cmbDeposit, "Все месторождения", self.deposits)
+        self.on_reference_loaded()
 
-    def load_emergency_type(self):
-        self.emergencyTypes = {}
-
-        with Session(self.engine) as s:
+    def setEmergencyType(self, emergencyTypes):
+        self.emergencyTypes = emergencyTypes
 
-            query = """
-            SELECT *
-            FROM emergency_type
-            """
+        self.model.setEmergencyType(self.emergencyTypes)
+        self.fillCombo(self.ui.cmbType, "Все виды происшествий", self.emergencyTypes)
+        self.on_reference_loaded()
 
-            rows = s.execute(text(query))
-            for r in rows:
-                self.emergencyTypes[r.id] = r
+    def on_reference_loaded(self):
+        if self.deposits is None or self.emergencyTypes is None:
+            return
+        self.load_emergency_occurrence()
+        self.refresh.flush()
 
-        self.ui.cmbType.addItem("Все виды происшествий")
-        for r in self.emergencyTypes.values():
-                self.ui.cmbType.addItem(r.name, r)
-        self.model.setEmergencyType(self.emergencyTypes)
+    def closeEvent(self, event):
+        # дожидаемся фоновых запросов, чтобы они не писали в закрытое окно
+        self.loader.shutdown()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
+    perf.start_session()
     app = QApplication(sys.argv)
 
     window = MainWindow()
@@ -0,0 +1,192 @@
+import math
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+import geo
+
+
+def heat_color(intensity):
+    # от синего (мало происшествий) к красному (много)
+    return QtGui.QColor.fromHsvF((1 - intensity) * 0.66, 0.9, 0.95, 0.85)
+
+
+class MapView(QtWidgets.QGraphicsView):
+    # месторождения на плоскости: x - долгота (coord2), y - широта (coord1)
+    # со знаком минус, чтобы север был сверху. Точки не масштабируются
+    # вместе с картой, колесо мыши меняет масштаб
+    boxSelected = QtCore.Signal(float, float, float, float)
+    pointClicked = QtCore.Signal(float, float)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.setScene(QtWidgets.QGraphicsScene(self))
+        self.setRenderHint(QtGui.QPainter.Antialiasing)
+        self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
+        self.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
+        # пока масштаб не меняли колесом, карта вписывается в окно
+        self.zoomed = False
+
+    def fit(self):
+        if self.scene().items():
+            self.fitInView(self.scene().itemsBoundingRect().adjusted(-1, -1, 1, 1), QtCore.Qt.KeepAspectRatio)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if not self.zoomed:
+            self.fit()
+
+    def wheelEvent(self, event):
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        self.zoomed = True
+        self.scale(factor, factor)
+
+    def mouseReleaseEvent(self, event):
+        # после отпускания кнопки рамки выделения уже нет
+        rect = self.rubberBandRect()
+        super().mouseReleaseEvent(event)
+
+        if rect.width() > 2 and rect.height() > 2:
+            box = self.mapToScene(rect).boundingRect()
+            self.boxSelected.emit(-box.bottom(), -box.top(), box.left(), box.right())
+        else:
+            point = self.mapToScene(event.pos())
+            self.pointClicked.emit(-point.y(), point.x())
+
+
+class MapDock(QtWidgets.QDockWidget):
+    # карта месторождений с интенсивностью происшествий и выбором области
+    # (прямоугольник или радиус вокруг точки) для фильтра таблицы и графиков
+    boxSelected = QtCore.Signal(float, float, float, float)
+    radiusSelected = QtCore.Signal(float, float, float)
+    cleared = QtCore.Signal()
+
+    POINT_SIZE = 6
+    MAX_POINT_SIZE = 20
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__("Карта", *args, **kwargs)
+        self.setObjectName("mapDock")
+
+        self.cmbMode = QtWidgets.QComboBox()
+        self.cmbMode.addItems(["Прямоугольник", "Радиус"])
+        self.cmbMode.setToolTip("Прямоугольник - выделение рамкой, радиус - щелчок по карте")
+
+        self.spnRadius = QtWidgets.QSpinBox()
+        self.spnRadius.setRange(1, 20000)
+        self.spnRadius.setValue(500)
+        self.spnRadius.setSuffix(" км")
+
+        self.btnClear = QtWidgets.QPushButton("Сбросить")
+        self.btnClear.clicked.connect(self.on_clear_click)
+
+        self.label = QtWidgets.QLabel()
+
+        self.view = MapView()
+        self.view.boxSelected.connect(self.on_box_selected)
+        self.view.pointClicked.connect(self.on_point_clicked)
+
+        tools = QtWidgets.QHBoxLayout()
+        tools.addWidget(self.cmbMode)
+        tools.addWidget(self.spnRadius)
+        tools.addWidget(self.btnClear)
+        tools.addStretch()
+        tools.addWidget(self.label)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(tools)
+        layout.addWidget(self.view)
+        widget = QtWidgets.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.deposits = None
+        # id месторождения -> точка на карте
+        self.points = {}
+        self.selection = None
+        # контур выбранной области
+        self.outline = None
+
+    def on_box_selected(self, min_coord1, max_coord1, min_coord2, max_coord2):
+        if self.cmbMode.currentIndex() != 0:
+            return
+        self.set_outline(QtCore.QRectF(min_coord2, -max_coord1, max_coord2 - min_coord2, max_coord1 - min_coord1), ellipse=False)
+        self.boxSelected.emit(min_coord1, max_coord1, min_coord2, max_coord2)
+
+    def on_point_clicked(self, coord1, coord2):
+        if self.cmbMode.currentIndex() != 1:
+            return
+        km = self.spnRadius.value()
+        # на карте круг выглядит эллипсом, вытянутым по долготе
+        min_coord1, max_coord1, min_coord2, max_coord2 = geo.radius_box(coord1, coord2, km)
+        self.set_outline(QtCore.QRectF(min_coord2, -max_coord1, max_coord2 - min_coord2, max_coord1 - min_coord1), ellipse=True)
+        self.radiusSelected.emit(coord1, coord2, km)
+
+    def on_clear_click(self):
+        self.set_outline(None)
+        self.cleared.emit()
+
+    def set_outline(self, rect, ellipse=False):
+        if self.outline is not None:
+            self.view.scene().removeItem(self.outline)
+            self.outline = None
+        if rect is None:
+            return
+
+        pen = QtGui.QPen(QtCore.Qt.black, 0, QtCore.Qt.DashLine)
+        if ellipse:
+            self.outline = self.view.scene().addEllipse(rect, pen)
+        else:
+            self.outline = self.view.scene().addRect(rect, pen)
+        self.outline.setZValue(1)
+
+    def set_deposits(self, deposits):
+        self.deposits = deposits
+        scene = self.view.scene()
+        for point in self.points.values():
+            scene.removeItem(point)
+        self.points = {}
+
+        for d in deposits.values():
+            if d.coord1 is None or d.coord2 is None:
+                continue
+            size = self.POINT_SIZE
+            point = scene.addEllipse(-size / 2, -size / 2, size, size)
+            point.setPos(d.coord2, -d.coord1)
+            # размер точки - в пикселях экрана, а не в градусах
+            point.setFlag(QtWidgets.QGraphicsItem.ItemIgnoresTransformations)
+            self.points[d.id] = point
+
+        self.view.zoomed = False
+        self.view.fit()
+        self.set_selection(self.selection)
+
+    def show_heat(self, deposits, totals):
+        # totals - {месторождение: кол-во происшествий}; точки создаются один
+        # раз на справочник, дальше меняются только их цвет и размер
+        if deposits is not self.deposits:
+            self.set_deposits(deposits)
+
+        peak = math.log1p(max(totals.values(), default=0)) or 1
+        for mestorozdenie_id, point in self.points.items():
+            count = totals.get(mestorozdenie_id, 0)
+            intensity = math.log1p(count) / peak
+            size = self.POINT_SIZE + (self.MAX_POINT_SIZE - self.POINT_SIZE) * intensity
+            point.setRect(-size / 2, -size / 2, size, size)
+            point.setBrush(heat_color(intensity))
+            point.setZValue(intensity)
+            point.setToolTip(f"{deposits[mestorozdenie_id].name}: {count}")
+
+    def set_selection(self, deposit_ids):
+        # выбранные месторождения обводятся, остальные рисуются без контура
+        self.selection = deposit_ids
+        selected = QtGui.QPen(QtCore.Qt.black, 2)
+        for mestorozdenie_id, point in self.points.items():
+            if deposit_ids is not None and mestorozdenie_id in deposit_ids:
+                point.setPen(selected)
+            else:
+                point.setPen(QtCore.Qt.NoPen)
+
+        if deposit_ids is None:
+            self.label.setText("")
+        else:
+            self.label.setText(f"Выбрано месторождений: {len(deposit_ids)}")
@@ -0,0 +1,149 @@
+import atexit
+import bisect
+import collections
+import cProfile
+import functools
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+# замеры времени горячих участков. Выключены по умолчанию: тогда
+# декоратор и контекстный менеджер стоят одну проверку флага.
+# ACCIDENTS_PERF=1 - собирать замеры с запуска,
+# ACCIDENTS_TRACE=файл.json - писать события в формате Chrome trace (chrome://tracing),
+# ACCIDENTS_PROFILE=файл.prof - профилировать GUI-поток через cProfile
+enabled = os.environ.get("ACCIDENTS_PERF") == "1"
+
+# сколько последних замеров хранить на каждый участок
+HISTORY = 500
+# границы корзин гистограммы, мс
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Timings:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=HISTORY))
+        self.trace = None
+        self.started = time.perf_counter()
+
+    def record(self, name, started, elapsed):
+        with self.lock:
+            self.samples[name].append(elapsed)
+            if self.trace is not None:
+                self.trace.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (started - self.started) * 1e6,
+                    "dur": elapsed * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                })
+
+    def summary(self):
+        # {участок: {last, median, p95, count, histogram}}, времена в мс
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+
+        result = {}
+        for name, values in sorted(samples.items()):
+            ordered = sorted(values)
+            histogram = [0] * (len(BUCKETS) + 1)
+            for value in values:
+                histogram[bisect.bisect_left(BUCKETS, value * 1000)] += 1
+            result[name] = {
+                "last": values[-1] * 1000,
+                "median": ordered[len(ordered) // 2] * 1000,
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                "count": len(values),
+                "histogram": histogram,
+            }
+        return result
+
+    def start_trace(self, path):
+        self.trace = []
+        atexit.register(self.write_trace, path)
+
+    def write_trace(self, path):
+        with self.lock:
+            events = list(self.trace or [])
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+timings = Timings()
+
+
+class timed:
+    # with perf.timed("query.page"): ...
+    __slots__ = ("name", "started")
+
+    def __init__(self, name) -> None:
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            timings.record(self.name, self.started, time.perf_counter() - self.started)
+
+
+def instrument(name):
+    # декоратор для функций и методов
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.record(name, started, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def set_enabled(value):
+    global enabled
+    enabled = value
+
+
+def start_session():
+    # включение трассировки и профилирования по переменным окружения
+    trace_path = os.environ.get("ACCIDENTS_TRACE")
+    if trace_path:
+        set_enabled(True)
+        timings.start_trace(trace_path)
+
+    profile_path = os.environ.get("ACCIDENTS_PROFILE")
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+        atexit.register(stop)
+
+
+def lazy_import(name):
+    # модуль загружается при первом обращении к его атрибутам - так тяжелые
+    # зависимости (SQLAlchemy) не задерживают запуск
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,74 @@
+from PySide2 import QtCore, QtWidgets
+
+import perf
+
+SPARK = " ▁▂▃▄▅▆▇█"
+
+
+def sparkline(histogram):
+    peak = max(histogram) or 1
+    return "".join(SPARK[round(value / peak * (len(SPARK) - 1))] for value in histogram)
+
+
+class PerfDock(QtWidgets.QDockWidget):
+    # панель с последними замерами perf.timings; пока панель открыта,
+    # замеры включены, обновление - раз в секунду
+    COLUMNS = ["Участок", "Последний, мс", "Медиана, мс", "95%, мс", "Замеров", "Гистограмма"]
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__("Производительность", *args, **kwargs)
+        self.setObjectName("perfDock")
+
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        self.table.setToolTip("Гистограмма: " + ", ".join(f"<{b}" for b in perf.BUCKETS) + " мс и больше")
+        self.setWidget(self.table)
+
+        # краткая сводка для строки состояния главного окна
+        self.status_label = QtWidgets.QLabel()
+
+        # замеры, включенные переменной окружения, не выключаются вместе с панелью
+        self.always_enabled = perf.enabled
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.update_timings)
+
+        self.visibilityChanged.connect(self.on_visibility_changed)
+
+    def on_visibility_changed(self, visible):
+        perf.set_enabled(visible or self.always_enabled)
+        self.status_label.setVisible(visible)
+        if visible:
+            self.update_timings()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def update_timings(self):
+        summary = perf.timings.summary()
+
+        self.table.setRowCount(len(summary))
+        for row, (name, values) in enumerate(summary.items()):
+            cells = [
+                name,
+                f"{values['last']:.1f}",
+                f"{values['median']:.1f}",
+                f"{values['p95']:.1f}",
+                str(values["count"]),
+                sparkline(values["histogram"]),
+            ]
+            for col, value in enumerate(cells):
+                self.table.setItem(row, col, QtWidgets.QTableWidgetItem(value))
+
+        page = summary.get("query.page")
+        charts = sum(summary[name]["last"] for name in summary if name.startswith("chart."))
+        parts = []
+        if page:
+            parts.append(f"страница {page['last']:.1f} мс")
+        if charts:
+            parts.append(f"графики {charts:.1f} мс")
+        self.status_label.setText(" · ".join(parts))
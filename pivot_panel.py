@@ -0,0 +1,129 @@
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from analytics import DIMENSIONS, MEASURES
+
+DIMENSION_NAMES = {"deposit": "Месторождение", "type": "Тип происшествия", "year": "Год"}
+MEASURE_NAMES = {"amount": "Кол-во происшествий", "injured": "Сумма ущерба"}
+TOTAL = "Итого"
+
+
+class PivotModel(QtCore.QAbstractTableModel):
+    # сводная таблица analytics.Pivot; последняя строка и колонка - итоги
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.pivot = None
+        self.row_labels = []
+        self.column_labels = []
+
+    def setPivot(self, pivot, row_labels, column_labels):
+        self.beginResetModel()
+        self.pivot = pivot
+        self.row_labels = row_labels + [TOTAL]
+        self.column_labels = column_labels + [TOTAL]
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex(), *args, **kwargs) -> int:
+        if parent.isValid() or self.pivot is None:
+            return 0
+        return len(self.row_labels)
+
+    def columnCount(self, parent=QtCore.QModelIndex(), *args, **kwargs) -> int:
+        if parent.isValid() or self.pivot is None:
+            return 0
+        return len(self.column_labels)
+
+    def data(self, index: QtCore.QModelIndex, role: QtCore.Qt.ItemDataRole):
+        if not index.isValid():
+            return
+
+        pivot = self.pivot
+        row, col = index.row(), index.column()
+        total_row = row == len(pivot.rows)
+        total_column = col == len(pivot.columns)
+
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            if total_row and total_column:
+                return pivot.total
+            if total_row:
+                return pivot.column_totals.get(pivot.columns[col], 0)
+            if total_column:
+                return pivot.row_totals.get(pivot.rows[row], 0)
+            return pivot.values.get((pivot.rows[row], pivot.columns[col]), 0)
+        elif role == QtCore.Qt.ItemDataRole.FontRole and (total_row or total_column):
+            font = QtGui.QFont()
+            font.setBold(True)
+            return font
+
+    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: QtCore.Qt.ItemDataRole):
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            if orientation == QtCore.Qt.Orientation.Horizontal:
+                return self.column_labels[section]
+            return self.row_labels[section]
+
+
+class PivotDock(QtWidgets.QDockWidget):
+    # сводная таблица по любой паре измерений; сами числа берутся
+    # из куба analytics.Cube главного окна
+    changed = QtCore.Signal()
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__("Сводная таблица", *args, **kwargs)
+        self.setObjectName("pivotDock")
+
+        self.cmbRows = QtWidgets.QComboBox()
+        self.cmbColumns = QtWidgets.QComboBox()
+        for name in DIMENSIONS:
+            self.cmbRows.addItem(DIMENSION_NAMES[name], name)
+            self.cmbColumns.addItem(DIMENSION_NAMES[name], name)
+        self.cmbColumns.setCurrentIndex(DIMENSIONS.index("year"))
+
+        self.cmbMeasure = QtWidgets.QComboBox()
+        for name in MEASURES:
+            self.cmbMeasure.addItem(MEASURE_NAMES[name], name)
+
+        for combo in (self.cmbRows, self.cmbColumns, self.cmbMeasure):
+            combo.currentIndexChanged.connect(self.on_combo_changed)
+
+        self.model = PivotModel(self)
+        self.table = QtWidgets.QTableView()
+        self.table.setModel(self.model)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+
+        tools = QtWidgets.QHBoxLayout()
+        tools.addWidget(QtWidgets.QLabel("Строки:"))
+        tools.addWidget(self.cmbRows)
+        tools.addWidget(QtWidgets.QLabel("Колонки:"))
+        tools.addWidget(self.cmbColumns)
+        tools.addWidget(QtWidgets.QLabel("Показатель:"))
+        tools.addWidget(self.cmbMeasure)
+        tools.addStretch()
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(tools)
+        layout.addWidget(self.table)
+        widget = QtWidgets.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+    def on_combo_changed(self):
+        # одно измерение не может стоять и в строках, и в колонках:
+        # тогда колонки переключаются на следующее свободное
+        if self.cmbRows.currentIndex() == self.cmbColumns.currentIndex():
+            self.cmbColumns.blockSignals(True)
+            self.cmbColumns.setCurrentIndex((self.cmbRows.currentIndex() + 1) % len(DIMENSIONS))
+            self.cmbColumns.blockSignals(False)
+        self.changed.emit()
+
+    def layout_inputs(self):
+        # (строки, колонки, показатель)
+        return self.cmbRows.currentData(), self.cmbColumns.currentData(), self.cmbMeasure.currentData()
+
+    def show_pivot(self, pivot, label):
+        # label(измерение, значение) -> подпись строки или колонки
+        rows, columns, _ = self.layout_inputs()
+        self.model.setPivot(
+            pivot,
+            [label(rows, value) for value in pivot.rows],
+            [label(columns, value) for value in pivot.columns],
+        )
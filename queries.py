@@ -0,0 +1,141 @@
+# сборка SQL для выборки происшествий: в запрос попадают только те условия,
+# которые реально заданы, чтобы SQLite мог выбрать подходящий индекс
+# (форма "(:mid = 0 OR mestorozdenie_id = :mid)" индексы не использует)
+
+import collections
+import json
+
+# фильтры колонок таблицы: диапазоны года и суммы ущерба, None - без границы
+ColumnFilter = collections.namedtuple(
+    "ColumnFilter", "year_from year_to injured_from injured_to", defaults=(None, None, None, None),
+)
+
+# ключи сортировки таблицы -> выражения ORDER BY (перед id). NULL заменяется
+# значением, чтобы keyset-пагинация по (ключ, id) не теряла строки; индексы
+# миграций 5 и 10 построены по этим же выражениям. Внутри года строки идут
+# по дате и времени, строки без даты - как с пустой датой
+SORT_KEYS = {
+    "year": ("year", "IFNULL(occurred_at, '')"),
+    "injured_amount": ("IFNULL(injured_amount, 0)",),
+    "comment": ("IFNULL(comment, '')",),
+}
+# (ключ, по убыванию)
+DEFAULT_ORDER = ("year", True)
+
+
+def occurrence_filter(deposit_id=0, emergency_type_id=0, deposit_ids=None, columns=None):
+    conditions = []
+    params = {}
+
+    if deposit_id:
+        conditions.append("mestorozdenie_id = :mid")
+        params["mid"] = deposit_id
+
+    # набор месторождений (область на карте) передается одним параметром
+    # JSON, чтобы текст запроса не зависел от числа месторождений
+    if deposit_ids is not None:
+        conditions.append("mestorozdenie_id IN (SELECT value FROM json_each(:mids))")
+        params["mids"] = json.dumps(sorted(deposit_ids))
+
+    if emergency_type_id:
+        conditions.append("emergency_type_id = :tid")
+        params["tid"] = emergency_type_id
+
+    if columns is not None:
+        for name, expression, operator in (
+            ("year_from", "year", ">="),
+            ("year_to", "year", "<="),
+            ("injured_from", SORT_KEYS["injured_amount"][0], ">="),
+            ("injured_to", SORT_KEYS["injured_amount"][0], "<="),
+        ):
+            value = getattr(columns, name)
+            if value is not None:
+                conditions.append(f"{expression} {operator} :{name}")
+                params[name] = value
+
+    return conditions, params
+
+
+def order_by(order):
+    key, descending = order or DEFAULT_ORDER
+    direction = "DESC" if descending else "ASC"
+    return ", ".join(f"{expression} {direction}" for expression in (*SORT_KEYS[key], "id"))
+
+
+def occurrence_query(
+    deposit_id=0, emergency_type_id=0, after=None, limit=None, deposit_ids=None, columns=None, order=None,
+    table="emergency_occurrence",
+):
+    # table - emergency_occurrence или emergency_occurrence_all (вместе с архивом,
+    # см. database.attach_partitions)
+    conditions, params = occurrence_filter(deposit_id, emergency_type_id, deposit_ids, columns)
+    key, descending = order or DEFAULT_ORDER
+
+    # keyset-пагинация по (ключ сортировки, id): продолжаем после последней
+    # загруженной строки; after - (значения выражений SORT_KEYS[key], id)
+    if after is not None:
+        values, params["after_id"] = after
+        names = [f":after_key{i}" for i in range(len(values))]
+        conditions.append(
+            f"({', '.join(SORT_KEYS[key])}, id) {'<' if descending else '>'} ({', '.join(names)}, :after_id)"
+        )
+        params.update((name[1:], value) for name, value in zip(names, values))
+
+    query = f"SELECT * FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + order_by(order)
+
+    if limit is not None:
+        query += " LIMIT :limit"
+        params["limit"] = limit
+
+    return query, params
+
+
+# метки начала и конца совпадения в тексте, который возвращает highlight();
+# управляющие символы не встречаются в комментариях, поэтому текст можно
+# безопасно экранировать и только потом заменить метки на разметку
+HIGHLIGHT_OPEN = "\x02"
+HIGHLIGHT_CLOSE = "\x03"
+
+
+def fts_query(search):
+    # ввод пользователя -> выражение FTS5: каждое слово берется в кавычки,
+    # чтобы операторы и спецсимволы FTS5 не ломали запрос, а последнее
+    # слово ищется по префиксу - поиск работает по мере набора
+    terms = ['"' + word.replace('"', '""') + '"' for word in search.split()]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_query(search, deposit_id=0, emergency_type_id=0, offset=0, limit=None, deposit_ids=None, columns=None, order=None):
+    # без явной сортировки результаты идут по релевантности
+    conditions, params = occurrence_filter(deposit_id, emergency_type_id, deposit_ids, columns)
+    conditions.insert(0, "emergency_comment_fts MATCH :match")
+    params["match"] = fts_query(search)
+    params["open"] = HIGHLIGHT_OPEN
+    params["close"] = HIGHLIGHT_CLOSE
+
+    query = (
+        "SELECT emergency_occurrence.*, "
+        "highlight(emergency_comment_fts, 0, :open, :close) AS highlight "
+        "FROM emergency_comment_fts "
+        "JOIN emergency_occurrence ON emergency_occurrence.id = emergency_comment_fts.rowid "
+        "WHERE " + " AND ".join(conditions)
+    )
+    if order is None:
+        # rank - встроенная оценка bm25, чем меньше, тем точнее совпадение
+        query += " ORDER BY emergency_comment_fts.rank, year DESC, IFNULL(occurred_at, '') DESC, id DESC"
+    else:
+        # во внешнем запросе comment однозначно означает колонку emergency_occurrence
+        query = "SELECT * FROM (" + query + ") ORDER BY " + order_by(order)
+
+    if limit is not None:
+        query += " LIMIT :limit OFFSET :offset"
+        params["limit"] = limit
+        params["offset"] = offset
+
+    return query, params
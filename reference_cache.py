@@ -0,0 +1,51 @@
+import collections
+import json
+import os
+
+# кэш справочников mestorozdenie и emergency_type на диске рядом с базой:
+# при запуске комбобоксы заполняются из него сразу, а база только
+# подтверждает, что версия справочников (таблица reference_version) та же
+FORMAT = 1
+
+# строки в том же виде, что SELECT * из таблиц справочников
+Deposit = collections.namedtuple("Deposit", "id name coord1 coord2")
+EmergencyType = collections.namedtuple("EmergencyType", "id name")
+
+
+def cache_path(database_path):
+    # для базы в памяти кэш не ведется
+    if not database_path or database_path == ":memory:":
+        return None
+    return database_path + ".references.json"
+
+
+def load(path):
+    # (версия, месторождения, типы) или None, если кэша нет или он испорчен
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != FORMAT:
+            return None
+        key = tuple(data["key"])
+        deposits = {row[0]: Deposit(*row) for row in data["mestorozdenie"]}
+        emergencyTypes = {row[0]: EmergencyType(*row) for row in data["emergency_type"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return key, deposits, emergencyTypes
+
+
+def save(path, key, deposits, emergencyTypes):
+    data = {
+        "format": FORMAT,
+        "key": list(key),
+        "mestorozdenie": [[getattr(r, name) for name in Deposit._fields] for r in deposits.values()],
+        "emergency_type": [[getattr(r, name) for name in EmergencyType._fields] for r in emergencyTypes.values()],
+    }
+    # запись через временный файл, чтобы другой запуск не прочитал половину
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        pass
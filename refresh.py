@@ -0,0 +1,67 @@
+from PySide2 import QtCore
+
+import perf
+
+
+class RefreshScheduler(QtCore.QObject):
+    # отложенное обновление представлений: сигналы, пришедшие подряд
+    # в пределах DELAY мс, сливаются в один проход, а представление
+    # перерисовывается, только если его входные данные изменились
+    DELAY = 100
+
+    def __init__(self, prepare=None, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # вызывается один раз перед проходом, чтобы общие для
+        # нескольких представлений данные считались однократно
+        self.prepare = prepare
+        # имя -> (функция входных данных, функция отрисовки)
+        self.views = {}
+        # имя -> входные данные последней отрисовки
+        self.inputs = {}
+        self.pending = set()
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.DELAY)
+        self.timer.timeout.connect(self.run)
+
+    def register(self, name, inputs, draw):
+        self.views[name] = (inputs, draw)
+
+    def schedule(self, *names):
+        self.pending.update(names or self.views)
+        # каждый новый сигнал откладывает проход еще на DELAY мс
+        self.timer.start()
+
+    def invalidate(self, *names):
+        # следующий проход перерисует представления даже при тех же данных
+        for name in names or list(self.inputs):
+            self.inputs.pop(name, None)
+        self.schedule(*names)
+
+    def flush(self):
+        # выполнить отложенный проход сейчас, не дожидаясь таймера
+        # (например, при запуске, когда ждать следующих сигналов незачем)
+        self.timer.stop()
+        self.run()
+
+    @perf.instrument("refresh.pass")
+    def run(self):
+        names, self.pending = self.pending, set()
+
+        if self.prepare:
+            self.prepare()
+
+        for name, (inputs, draw) in self.views.items():
+            if name not in names:
+                continue
+
+            value = inputs()
+            # данных еще нет (например, справочники грузятся)
+            if value is None:
+                continue
+            if name in self.inputs and self.inputs[name] == value:
+                continue
+
+            self.inputs[name] = value
+            draw()
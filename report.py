@@ -0,0 +1,38 @@
+import argparse
+import csv
+import json
+import sys
+
+import analytics
+import database
+
+
+def write_csv(stats, out):
+    writer = csv.writer(out, delimiter=";")
+    writer.writerow(["Месторождение", "Год", "Кол-во происшествий"])
+    for deposit in stats["deposits"]:
+        for year, count in deposit["by_year"].items():
+            writer.writerow([deposit["name"], year, count])
+
+
+if __name__ == "__main__":
+    # отчет по тем же данным, что и графики главного окна, без запуска Qt
+    parser = argparse.ArgumentParser(description="Статистика происшествий")
+    parser.add_argument("--database", default="database.db")
+    parser.add_argument("--deposit", type=int, default=0, help="id месторождения")
+    parser.add_argument("--type", type=int, default=0, help="id типа происшествия")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    args = parser.parse_args()
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+
+    rollup = analytics.Rollup.load(engine)
+    deposits = database.load_mestorozdenie(engine)
+    stats = analytics.statistics(rollup, deposits, args.deposit, args.type)
+
+    if args.format == "json":
+        json.dump(stats, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        write_csv(stats, sys.stdout)
@@ -0,0 +1,137 @@
+import collections
+import itertools
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# строка происшествия в том же виде, что и строка из запроса SELECT *
+Occurrence = collections.namedtuple(
+    "Occurrence", "id mestorozdenie_id year injured_amount emergency_type_id comment occurred_at",
+)
+
+# числовые колонки и типы array: идентификаторы, год - int32,
+# id и сумма ущерба - int64, чтобы не переполниться
+COLUMNS = {
+    "id": "q",
+    "mestorozdenie_id": "i",
+    "year": "i",
+    "injured_amount": "q",
+    "emergency_type_id": "i",
+}
+
+
+def to_int(value):
+    # в колонку array не положить None или текст, хранится 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class OccurrenceStore:
+    # компактное хранилище строк происшествий по колонкам: вместо объекта
+    # на каждую строку - по одному array на колонку, списки комментариев
+    # и дат (у строк, где известен только год, дата - None).
+    # Снаружи ведет себя как список строк (len, [], insert, del), поэтому
+    # модель таблицы работает с ним так же, как со списком
+    CHUNK_SIZE = 10000
+
+    def __init__(self, rows=()) -> None:
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        self.comments = []
+        self.dates = []
+        self.extend(rows)
+
+    def __len__(self) -> int:
+        return len(self.comments)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return Occurrence(
+            self.columns["id"][i],
+            self.columns["mestorozdenie_id"][i],
+            self.columns["year"][i],
+            self.columns["injured_amount"][i],
+            self.columns["emergency_type_id"][i],
+            self.comments[i],
+            self.dates[i],
+        )
+
+    def __setitem__(self, i, row):
+        for name, column in self.columns.items():
+            column[i] = to_int(getattr(row, name))
+        self.comments[i] = self.intern(row.comment)
+        self.dates[i] = row.occurred_at
+
+    def __delitem__(self, i):
+        for column in self.columns.values():
+            del column[i]
+        del self.comments[i]
+        del self.dates[i]
+
+    def insert(self, i, row):
+        for name, column in self.columns.items():
+            column.insert(i, to_int(getattr(row, name)))
+        self.comments.insert(i, self.intern(row.comment))
+        self.dates.insert(i, row.occurred_at)
+
+    def append(self, row):
+        self.insert(len(self), row)
+
+    def extend(self, rows):
+        # строки добавляются пачками, по колонке за раз
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.CHUNK_SIZE))
+            if not chunk:
+                break
+
+            # транспонируем пачку: строки запроса и Occurrence - кортежи с _fields
+            values_by_name = dict(zip(chunk[0]._fields, zip(*chunk)))
+
+            for name, column in self.columns.items():
+                values = values_by_name[name]
+                try:
+                    values = array(column.typecode, values)
+                except (TypeError, OverflowError):
+                    values = array(column.typecode, map(to_int, values))
+                column.extend(values)
+
+            self.comments.extend(map(self.intern, values_by_name["comment"]))
+            self.dates.extend(values_by_name["occurred_at"])
+
+    @staticmethod
+    def intern(comment):
+        # одинаковые комментарии (в том числе пустые) хранятся одной строкой
+        if isinstance(comment, str):
+            return sys.intern(comment)
+        return comment
+
+    def column(self, name):
+        # колонка как массив numpy без копирования; массив нельзя держать
+        # дольше вызова - пока он жив, array не может менять размер
+        return numpy.frombuffer(self.columns[name], dtype=self.columns[name].typecode)
+
+    def filter(self, deposit_id=0, emergency_type_id=0):
+        # позиции строк, подходящих под фильтр
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            if deposit_id:
+                mask &= self.column("mestorozdenie_id") == deposit_id
+            if emergency_type_id:
+                mask &= self.column("emergency_type_id") == emergency_type_id
+            return numpy.flatnonzero(mask)
+
+        deposits = self.columns["mestorozdenie_id"]
+        types = self.columns["emergency_type_id"]
+        return [
+            i for i in range(len(self))
+            if (not deposit_id or deposits[i] == deposit_id)
+            and (not emergency_type_id or types[i] == emergency_type_id)
+        ]
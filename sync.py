@@ -0,0 +1,451 @@
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# версия формата пакета изменений
+FORMAT = 1
+# справочники применяются раньше происшествий, которые на них ссылаются
+TABLES = ("mestorozdenie", "emergency_type", "emergency_occurrence")
+BATCH_SIZE = 5000
+DEFAULT_PORT = 8765
+
+
+class SyncError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def raw_connection(engine):
+    # журнал и ключи читаются и пишутся пачками через sqlite3 напрямую,
+    # как в database.migrate
+    connection = engine.raw_connection()
+    try:
+        yield connection.driver_connection
+    finally:
+        connection.close()
+
+
+def site_id(connection):
+    return connection.execute("SELECT site FROM sync_site").fetchone()[0]
+
+
+def peer_state(connection, peer):
+    # (sent, received) для другой базы, (0, 0) - синхронизации еще не было
+    row = connection.execute("SELECT sent, received FROM sync_peer WHERE site = ?", (peer,)).fetchone()
+    return row if row is not None else (0, 0)
+
+
+def renew_site(engine):
+    # после копирования файла базы у копии тот же id, что и у оригинала;
+    # новый id нужен, чтобы их новые строки не получили одинаковые uid
+    with raw_connection(engine) as connection:
+        connection.execute("UPDATE sync_site SET site = lower(hex(randomblob(8)))")
+        connection.commit()
+        return site_id(connection)
+
+
+def export_changes(engine, peer=None):
+    # пакет изменений для другой базы: все, что она еще не подтвердила,
+    # кроме пришедшего от нее самой. От каждой строки - только последнее
+    # изменение, поэтому размер пакета зависит от числа измененных строк
+    with raw_connection(engine) as connection:
+        site = site_id(connection)
+        sent, received = peer_state(connection, peer)
+        until = connection.execute("SELECT IFNULL(MAX(seq), 0) FROM change_log").fetchone()[0]
+
+        rows = connection.execute("""
+        SELECT tbl, uid, op, data, version, origin, changed_at
+        FROM change_log
+        WHERE seq IN (
+            SELECT MAX(seq)
+            FROM change_log
+            WHERE seq > :sent AND seq <= :until AND (:peer IS NULL OR IFNULL(peer, '') != :peer)
+            GROUP BY tbl, uid
+        )
+        ORDER BY seq
+        """, {"sent": sent, "until": until, "peer": peer}).fetchall()
+
+    return {
+        "format": FORMAT,
+        "site": site,
+        "peer": peer,
+        "since": sent,
+        "until": until,
+        # до какого seq получателя его изменения уже применены здесь
+        "acknowledged": received,
+        "changes": [
+            {
+                "tbl": tbl,
+                "uid": uid,
+                "op": op,
+                "data": json.loads(data) if data is not None else None,
+                "version": version,
+                "origin": origin,
+                "changed_at": changed_at,
+            }
+            for tbl, uid, op, data, version, origin, changed_at in rows
+        ],
+    }
+
+
+def stamp(version, changed_at, origin):
+    # метка изменения строки: побеждает строка, которую чаще меняли, при
+    # равенстве - измененная позже, при одинаковом времени - по id базы
+    return version, changed_at or "", origin or ""
+
+
+def last_change(connection, table, uid):
+    row = connection.execute("""
+    SELECT op, data, version, origin, changed_at
+    FROM change_log
+    WHERE tbl = ? AND uid = ?
+    ORDER BY seq DESC
+    LIMIT 1
+    """, (table, uid)).fetchone()
+    if row is None:
+        return None
+    op, data, version, origin, changed_at = row
+    return {
+        "op": op,
+        "data": json.loads(data) if data is not None else None,
+        "version": version,
+        "origin": origin,
+        "changed_at": changed_at,
+    }
+
+
+def local_ids(connection, table, uids):
+    # uid -> id строки в этой базе (None у удаленных)
+    rows = connection.execute(
+        "SELECT uid, id FROM sync_key WHERE tbl = ? AND uid IN (SELECT value FROM json_each(?))",
+        (table, json.dumps(list(uids))),
+    )
+    return dict(rows)
+
+
+def add_conflict(connection, conflicts, table, uid, peer, kept, discarded):
+    # повторно пришедший пакет не должен записывать тот же конфликт снова:
+    # пока источник не подтвердил прием, строка остается в pending, а
+    # проигравшее изменение приходит с прежней меткой
+    row = (table, uid, peer, json.dumps(kept), json.dumps(discarded))
+    if row in conflicts or connection.execute(
+        "SELECT 1 FROM sync_conflict WHERE tbl = ? AND uid = ? AND peer = ? AND kept IS ? AND discarded IS ?", row,
+    ).fetchone():
+        return
+    conflicts.append(row)
+
+
+def apply_batch(connection, table, changes, peer, pending, result):
+    columns = database.SYNC_COLUMNS[table]
+
+    rows = connection.execute(
+        "SELECT uid, id, version, changed_at, origin, archived FROM sync_key "
+        "WHERE tbl = ? AND uid IN (SELECT value FROM json_each(?))",
+        (table, json.dumps([change["uid"] for change in changes])),
+    ).fetchall()
+    keys = {uid: (id_, stamp(version, changed_at, origin)) for uid, id_, version, changed_at, origin, _ in rows}
+    # строки, перенесенные в разделы архива (archive.py)
+    archived = {uid for uid, *_, flag in rows if flag}
+
+    # ссылки на справочники приходят глобальными uid
+    references = {}
+    for column in columns:
+        if column in database.SYNC_REFERENCES:
+            uids = {change["data"][column] for change in changes if change["data"] is not None}
+            references[column] = local_ids(connection, database.SYNC_REFERENCES[column], uids - {None})
+
+    next_id = None
+    stamps, updates, inserts, deletes, tombstones, conflicts = [], [], [], [], [], []
+
+    for change in changes:
+        uid = change["uid"]
+        remote = stamp(change["version"], change["changed_at"], change["origin"])
+        local_id, local = keys.get(uid, (None, None))
+        # строка менялась и здесь, и там с прошлой синхронизации
+        conflict = (table, uid) in pending and local != remote and change["op"] != "I"
+        remote_change = {name: change[name] for name in ("op", "data", "version", "origin", "changed_at")}
+
+        if local is not None and local >= remote:
+            result["skipped"] += 1
+            if conflict:
+                add_conflict(connection, conflicts, table, uid, peer, last_change(connection, table, uid), remote_change)
+            continue
+
+        if uid in archived:
+            # строки в основной таблице нет: изменение не применяется и не
+            # двигает метку, а сохраняется как конфликт для ручного разбора
+            result["skipped"] += 1
+            add_conflict(connection, conflicts, table, uid, peer, last_change(connection, table, uid), remote_change)
+            continue
+
+        if conflict:
+            add_conflict(connection, conflicts, table, uid, peer, remote_change, last_change(connection, table, uid))
+
+        version, changed_at, origin = change["version"], change["changed_at"], change["origin"]
+        if change["op"] == "D":
+            if local_id is None:
+                # строки здесь нет: остается только ключ-надгробие
+                tombstones.append((table, uid, version, origin, changed_at, peer))
+            else:
+                stamps.append((table, uid, local_id, version, origin, changed_at))
+                deletes.append((local_id,))
+        else:
+            data = change["data"]
+            # у пакетов баз без миграции 8 нет occurred_at - такая колонка станет NULL
+            values = [
+                references[column].get(data[column]) if column in references else data.get(column)
+                for column in columns
+            ]
+            if local_id is None:
+                if next_id is None:
+                    next_id = connection.execute(
+                        f"SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = '{table}'), 0), "
+                        f"IFNULL((SELECT MAX(id) FROM {table}), 0)) + 1"
+                    ).fetchone()[0]
+                local_id, next_id = next_id, next_id + 1
+                inserts.append((local_id, *values))
+            else:
+                updates.append((*values, local_id))
+            stamps.append((table, uid, local_id, version, origin, changed_at))
+
+        result["applied"] += 1
+
+    # сначала метки в sync_key, потом сами строки: триггеры журнала
+    # берут метку оттуда и записывают изменение с peer источника
+    connection.executemany("""
+    INSERT INTO sync_key(tbl, uid, id, version, origin, changed_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(tbl, uid) DO UPDATE
+    SET id = excluded.id, version = excluded.version, origin = excluded.origin, changed_at = excluded.changed_at
+    """, stamps)
+    connection.executemany(
+        f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?", updates,
+    )
+    connection.executemany(
+        f"INSERT INTO {table}(id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})", inserts,
+    )
+    connection.executemany(f"DELETE FROM {table} WHERE id = ?", deletes)
+
+    connection.executemany("""
+    INSERT INTO sync_key(tbl, uid, id, version, origin, changed_at)
+    VALUES (?1, ?2, NULL, ?3, ?4, ?5)
+    ON CONFLICT(tbl, uid) DO UPDATE
+    SET id = NULL, version = excluded.version, origin = excluded.origin, changed_at = excluded.changed_at
+    """, [row[:5] for row in tombstones])
+    connection.executemany("""
+    INSERT INTO change_log(tbl, uid, op, data, version, origin, changed_at, peer)
+    VALUES (?, ?, 'D', NULL, ?, ?, ?, ?)
+    """, tombstones)
+
+    connection.executemany(
+        "INSERT INTO sync_conflict(tbl, uid, peer, kept, discarded) VALUES (?, ?, ?, ?, ?)", conflicts,
+    )
+    result["conflicts"] += len(conflicts)
+
+
+def apply_changes(engine, changes, batch_size=BATCH_SIZE):
+    # пакет применяется одной транзакцией, строки одной таблицы - пачками
+    # по batch_size через executemany. Изменение применяется, только если
+    # его метка больше метки строки здесь, поэтому повторный пакет ничего не меняет
+    if changes.get("format") != FORMAT:
+        raise SyncError(f"Неизвестный формат пакета: {changes.get('format')!r}")
+
+    result = {"changes": len(changes["changes"]), "applied": 0, "skipped": 0, "conflicts": 0}
+    started = time.perf_counter()
+    peer = changes["site"]
+
+    with raw_connection(engine) as connection:
+        site = site_id(connection)
+        if peer == site:
+            raise SyncError("У баз одинаковый id, у копии его нужно обновить (sync.py site --renew)")
+        if changes["peer"] not in (None, site):
+            raise SyncError(f"Пакет подготовлен для другой базы: {changes['peer']}")
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            sent, _ = peer_state(connection, peer)
+            # строки, измененные здесь и еще не подтвержденные источником пакета.
+            # Вставка (здесь или там) конфликтом не считается: изменить строку
+            # можно только после того, как вставка пришла, - в том числе записи
+            # миграции 7 о строках, которые уже были в базе
+            pending = set(connection.execute(
+                "SELECT DISTINCT tbl, uid FROM change_log WHERE seq > ? AND IFNULL(peer, '') != ? AND op != 'I'",
+                (sent, peer),
+            ))
+
+            connection.execute("UPDATE sync_site SET applying = ?", (peer,))
+            for table in TABLES:
+                rows = (change for change in changes["changes"] if change["tbl"] == table)
+                while True:
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch:
+                        break
+                    apply_batch(connection, table, batch, peer, pending, result)
+            connection.execute("UPDATE sync_site SET applying = NULL")
+
+            connection.execute("""
+            INSERT INTO sync_peer(site, sent, received, synced_at)
+            VALUES (?, ?, ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+            ON CONFLICT(site) DO UPDATE
+            SET sent = MAX(sent, excluded.sent),
+                received = MAX(received, excluded.received),
+                synced_at = excluded.synced_at
+            """, (peer, changes["acknowledged"], changes["until"]))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def acknowledge(engine, peer, seq):
+    with raw_connection(engine) as connection:
+        connection.execute("UPDATE sync_peer SET sent = MAX(sent, ?) WHERE site = ?", (seq, peer))
+        connection.commit()
+
+
+def write_changes(changes, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(changes, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def read_changes(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# обмен через сокет: сообщения - JSON по одному в строке.
+# Клиент и сервер представляются, клиент отправляет свой пакет, сервер
+# применяет его и отвечает своим, клиент подтверждает прием
+
+def send(stream, message):
+    stream.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise SyncError("Соединение закрыто другой стороной")
+    return json.loads(line)
+
+
+def hello(engine):
+    with raw_connection(engine) as connection:
+        return {"format": FORMAT, "site": site_id(connection)}
+
+
+def exchange_client(engine, stream):
+    send(stream, hello(engine))
+    peer = receive(stream)["site"]
+
+    send(stream, export_changes(engine, peer))
+    changes = receive(stream)
+    result = apply_changes(engine, changes)
+    send(stream, {"acknowledged": changes["until"]})
+    return peer, result
+
+
+def exchange_server(engine, stream):
+    peer = receive(stream)["site"]
+    send(stream, hello(engine))
+
+    result = apply_changes(engine, receive(stream))
+    changes = export_changes(engine, peer)
+    send(stream, changes)
+    acknowledge(engine, peer, receive(stream)["acknowledged"])
+    return peer, result
+
+
+def connect(engine, host, port=DEFAULT_PORT, timeout=60):
+    with socket.create_connection((host, port), timeout=timeout) as sock, sock.makefile("rwb") as stream:
+        return exchange_client(engine, stream)
+
+
+def serve(engine, host="127.0.0.1", port=DEFAULT_PORT, on_done=None):
+    # сеансы обслуживаются по одному: пакеты все равно применяются
+    # к одной базе последовательно
+    with socket.create_server((host, port)) as server:
+        while True:
+            sock, address = server.accept()
+            with sock, sock.makefile("rwb") as stream:
+                try:
+                    peer, result = exchange_server(engine, stream)
+                except (SyncError, OSError, ValueError, KeyError, sqlite3.Error) as e:
+                    # в том числе "database is locked": пакет откатывается,
+                    # сервер ждет следующего клиента
+                    logger.warning("синхронизация с %s не удалась: %s", address, e)
+                    continue
+            if on_done:
+                on_done(peer, result)
+
+
+def describe(peer, result):
+    return (
+        f"{peer}: изменений {result['changes']}, применено {result['applied']}, "
+        f"пропущено {result['skipped']}, конфликтов {result['conflicts']}, {result['seconds']:.2f} с"
+    )
+
+
+if __name__ == "__main__":
+    # синхронизация копий базы на разных рудниках: передаются только
+    # изменения с прошлого обмена, через файл или сокет
+    parser = argparse.ArgumentParser(description="Синхронизация баз происшествий")
+    parser.add_argument("--database", default="database.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    site_parser = commands.add_parser("site", help="id этой базы")
+    site_parser.add_argument("--renew", action="store_true", help="новый id (для скопированного файла базы)")
+
+    export_parser = commands.add_parser("export", help="выгрузить изменения в файл")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--peer", help="id базы-получателя; без него выгружается весь журнал")
+
+    import_parser = commands.add_parser("import", help="применить изменения из файла")
+    import_parser.add_argument("path")
+
+    serve_parser = commands.add_parser("serve", help="ждать подключений других баз")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+
+    connect_parser = commands.add_parser("connect", help="обменяться изменениями с базой на сервере")
+    connect_parser.add_argument("--host", default="127.0.0.1")
+    connect_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = database.create_database_engine(f"sqlite+pysqlite:///{args.database}")
+    database.migrate(engine)
+
+    if args.command == "site":
+        if args.renew:
+            print(renew_site(engine))
+        else:
+            with raw_connection(engine) as connection:
+                print(site_id(connection))
+    elif args.command == "export":
+        changes = export_changes(engine, args.peer)
+        write_changes(changes, args.path)
+        print(f"Выгружено изменений: {len(changes['changes'])}")
+    elif args.command == "import":
+        changes = read_changes(args.path)
+        print(describe(changes["site"], apply_changes(engine, changes)))
+    elif args.command == "serve":
+        serve(engine, args.host, args.port, on_done=lambda peer, result: print(describe(peer, result)))
+    else:
+        print(describe(*connect(engine, args.host, args.port)))
@@ -0,0 +1,58 @@
+import datetime
+
+MIN_YEAR = 1900
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def parse_year(value):
+    try:
+        year = int(str(value).strip())
+    except ValueError:
+        raise ValidationError(f"Некорректный год: {value!r}")
+
+    if not MIN_YEAR <= year <= datetime.date.today().year:
+        raise ValidationError(f"Год вне допустимого диапазона: {year}")
+    return year
+
+
+def parse_injured(value):
+    text = "" if value is None else str(value).strip()
+    if not text:
+        return 0
+
+    try:
+        injured = int(text)
+    except ValueError:
+        raise ValidationError(f"Некорректная сумма ущерба: {value!r}")
+
+    if injured < 0:
+        raise ValidationError(f"Сумма ущерба не может быть отрицательной: {injured}")
+    return injured
+
+
+# форматы даты и времени происшествия на входе; в базе - 'YYYY-MM-DD HH:MM'
+# или 'YYYY-MM-DD', если время неизвестно
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%d.%m.%Y %H:%M")
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y")
+
+
+def parse_occurred_at(value):
+    # None - дата не указана
+    text = "" if value is None else str(value).strip()
+    if not text:
+        return None
+
+    for formats, output in ((DATETIME_FORMATS, "%Y-%m-%d %H:%M"), (DATE_FORMATS, "%Y-%m-%d")):
+        for pattern in formats:
+            try:
+                occurred_at = datetime.datetime.strptime(text, pattern)
+            except ValueError:
+                continue
+            # год проверяется так же, как отдельное поле года
+            parse_year(occurred_at.year)
+            return occurred_at.strftime(output)
+
+    raise ValidationError(f"Некорректная дата: {value!r}")
@@ -0,0 +1,110 @@
+import itertools
+import logging
+
+from PySide2 import QtCore
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSignals(QtCore.QObject):
+    # request_id, результат, исключение (None, если все прошло успешно)
+    done = QtCore.Signal(int, object, object)
+    # request_id, сделано, всего
+    progress = QtCore.Signal(int, int, int)
+
+
+class Worker(QtCore.QRunnable):
+    def __init__(self, request_id, fn, *args, **kwargs) -> None:
+        super().__init__()
+        self.request_id = request_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        # сигналы создаются в GUI-потоке, поэтому обработчики
+        # вызываются через очередь событий главного окна
+        self.signals = WorkerSignals()
+
+    def report_progress(self, done, total):
+        self.signals.progress.emit(self.request_id, done, total)
+
+    def run(self):
+        result = error = None
+
+        # отмененный до старта запрос в базу не ходит
+        if not self.cancelled:
+            try:
+                result = self.fn(*self.args, **self.kwargs)
+            except Exception as e:
+                error = e
+
+        self.signals.done.emit(self.request_id, result, error)
+
+
+class DataLoader(QtCore.QObject):
+    # выполняет обращения к базе в пуле потоков и возвращает результат
+    # в GUI-поток. Запросы одного канала (например, "items") вытесняют
+    # друг друга: ответ на устаревший запрос просто отбрасывается
+
+    def __init__(self, pool=None, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.pool = pool or QtCore.QThreadPool.globalInstance()
+        self.ids = itertools.count(1)
+        # канал -> id последнего запроса
+        self.latest = {}
+        # id запроса -> (канал, worker, on_done, on_error, on_progress)
+        self.requests = {}
+
+    def submit(self, fn, *args, channel=None, on_done=None, on_error=None, on_progress=None, **kwargs):
+        # если задан on_progress, функция получает аргумент progress(done, total)
+        request_id = next(self.ids)
+
+        if channel is not None:
+            self.cancel(channel)
+            self.latest[channel] = request_id
+
+        worker = Worker(request_id, fn, *args, **kwargs)
+        worker.signals.done.connect(self.on_done)
+        if on_progress:
+            worker.kwargs["progress"] = worker.report_progress
+            worker.signals.progress.connect(self.on_progress)
+        self.requests[request_id] = (channel, worker, on_done, on_error, on_progress)
+        self.pool.start(worker)
+
+        return request_id
+
+    def cancel(self, channel):
+        request_id = self.latest.pop(channel, None)
+        if request_id in self.requests:
+            self.requests[request_id][1].cancelled = True
+
+    def is_current(self, request_id):
+        channel = self.requests[request_id][0]
+        return channel is None or self.latest.get(channel) == request_id
+
+    def on_done(self, request_id, result, error):
+        if request_id not in self.requests:
+            return
+
+        current = self.is_current(request_id)
+        channel, worker, on_done, on_error, _ = self.requests.pop(request_id)
+        if not current:
+            return
+        self.latest.pop(channel, None)
+
+        if error is not None:
+            if on_error:
+                on_error(error)
+            else:
+                logger.error("request %s failed", request_id, exc_info=error)
+        elif on_done:
+            on_done(result)
+
+    def on_progress(self, request_id, done, total):
+        if request_id in self.requests and self.is_current(request_id):
+            self.requests[request_id][4](done, total)
+
+    def shutdown(self):
+        for channel in list(self.latest):
+            self.cancel(channel)
+        self.pool.waitForDone()